@@ -0,0 +1,69 @@
+"""
+asyncio variant of the read functions of query_func, so a page can start its independent reads together.
+
+Every public read function of query_func has a coroutine counterpart with the same name and arguments here,
+running on a bounded pool of threads that each keep their own read connections open:
+
+    totals, counts = await asyncio.gather(async_query.get_doctor_totals(doctor_id),
+                                          async_query.get_doctor_test_type_counts(doctor_id))
+
+Streamlit scripts are synchronous, so pages use load_concurrently, which takes (function, *args) tuples of the
+regular query_func functions and returns their results in order. query_func itself is unchanged. Writes are not
+wrapped: they stay on the caller's thread, after the reads they depend on.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+import query_func
+from data_service import WRITE_PREFIXES, exposed_functions
+
+# Threads, hence open read connections per shard, shared by every session of the process
+READ_CONNECTIONS = int(os.environ.get('HEALTH_MONITORING_READ_CONNECTIONS', 4))
+
+_executor = ThreadPoolExecutor(max_workers=READ_CONNECTIONS, thread_name_prefix='read',
+                               initializer=query_func.use_persistent_connections)
+
+
+async def run_in_pool(function, *args, **kwargs):
+    """
+    Runs a blocking function on the read connection pool and waits for it without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(function, *args, **kwargs))
+
+
+def _coroutine(function):
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run_in_pool(function, *args, **kwargs)
+    return wrapper
+
+
+# One coroutine per read function, e.g. get_appointments_by_patient
+for _name, _function in exposed_functions(vars(query_func)).items():
+    if not _name.startswith(WRITE_PREFIXES):
+        globals()[_name] = _coroutine(_function)
+
+
+def run(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code such as a Streamlit script.
+    """
+    return asyncio.run(coroutine)
+
+
+def load_concurrently(*calls):
+    """
+    Runs independent reads at the same time and returns their results in the order of calls.
+
+    Parameters:
+        calls (tuple): (function, *args) tuples, e.g. (get_doctor_totals, doctor_id).
+
+    Returns:
+        list: The result of every call.
+    """
+    async def gather():
+        return await asyncio.gather(*(run_in_pool(function, *args) for function, *args in calls))
+    return run(gather())
@@ -0,0 +1,263 @@
+"""
+Online backups of the database files, taken while the application is running.
+
+Copying health_monitoring.db with cp can produce a torn copy when a doctor writes in the middle of it. Snapshots here
+use the SQLite online backup API, which copies a consistent image, a few pages per step with a pause in between so
+the application's queries and writes are not stalled for the whole copy.
+
+A snapshot is a directory backups/<YYYYmmdd-HHMMSS>/ holding one copy per shard and a manifest.json. Every copy is
+checked with PRAGMA integrity_check before the snapshot is kept, and only the newest snapshots are kept.
+
+    python backup.py snapshot [--keep 14]
+    python backup.py schedule --every 60 [--keep 24]     (takes a snapshot every 60 minutes until stopped)
+    python backup.py list
+    python backup.py verify backups/20241201-120000
+    python backup.py restore backups/20241201-120000 restored/
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+import shard_router
+
+BACKUP_DIR = 'backups'
+SNAPSHOT_NAME_FORMAT = '%Y%m%d-%H%M%S'
+MANIFEST = 'manifest.json'
+
+# Pages copied per step and pause between steps. 256 pages of 4 KB = 1 MB per step.
+DEFAULT_PAGES_PER_STEP = 256
+DEFAULT_PAUSE = 0.005
+# A write by another connection restarts the backup from the first page. Every restart makes the steps 4 times
+# larger, leaving fewer gaps for writes to land in. After MAX_RESTARTS the copy is done in a single step, which
+# blocks writers for its duration unless the database is in WAL mode.
+MAX_RESTARTS = 5
+
+
+class BackupError(Exception):
+    """
+    A snapshot could not be taken, failed verification, or cannot be restored.
+    """
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backup_file(source_path, destination_path, pages_per_step=DEFAULT_PAGES_PER_STEP, pause=DEFAULT_PAUSE):
+    """
+    Copies a live database file with the online backup API, pages_per_step pages at a time.
+
+    Returns:
+        dict: Statistics of the copy: pages, steps, restarts, seconds.
+    """
+    stats = {'pages': 0, 'steps': 0, 'restarts': 0}
+    previous_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal previous_remaining
+        stats['pages'] = total
+        stats['steps'] += 1
+        if previous_remaining is not None and remaining > previous_remaining:
+            raise _Restarted()
+        previous_remaining = remaining
+        if remaining and pause:
+            time.sleep(pause)  # Lets queued queries and writes run between steps
+
+    started = time.perf_counter()
+    source = sqlite3.connect(source_path)
+    destination = sqlite3.connect(destination_path)
+    try:
+        while True:
+            previous_remaining = None
+            try:
+                source.backup(destination, pages=pages_per_step, progress=progress)
+                break
+            except _Restarted:
+                stats['restarts'] += 1
+                pages_per_step = -1 if stats['restarts'] >= MAX_RESTARTS else pages_per_step * 4
+    finally:
+        destination.close()
+        source.close()
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def verify_file(path):
+    """
+    Runs PRAGMA integrity_check on a database file.
+
+    Returns:
+        list of str: The problems found, empty when the file is fine.
+    """
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        messages = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as error:
+        messages = [str(error)]
+    finally:
+        connection.close()
+    return [] if messages == ['ok'] else messages
+
+
+def _read_manifest(snapshot):
+    with open(os.path.join(snapshot, MANIFEST), encoding='utf-8') as file:
+        return json.load(file)
+
+
+def take_snapshot(directory=BACKUP_DIR, keep=None, pages_per_step=DEFAULT_PAGES_PER_STEP, pause=DEFAULT_PAUSE):
+    """
+    Backs up every shard into a new snapshot directory, verifies the copies and applies the retention.
+
+    Parameters:
+        directory (str): Where snapshots are kept.
+        keep (int): Number of snapshots to keep, the oldest are deleted. None keeps every snapshot.
+
+    Returns:
+        str: The path of the snapshot.
+    """
+    snapshot = os.path.join(directory, datetime.now().strftime(SNAPSHOT_NAME_FORMAT))
+    if os.path.exists(snapshot):
+        raise BackupError(f'{snapshot} already exists')
+    os.makedirs(snapshot)
+
+    files = []
+    try:
+        for index, source_path in enumerate(shard_router.shard_paths()):
+            name = f'{index}_{os.path.basename(source_path)}'
+            stats = backup_file(source_path, os.path.join(snapshot, name), pages_per_step, pause)
+            problems = verify_file(os.path.join(snapshot, name))
+            if problems:
+                raise BackupError(f'{name} failed the integrity check: {problems[:5]}')
+            files.append({'file': name, 'source': source_path, **stats})
+    except Exception:
+        shutil.rmtree(snapshot, ignore_errors=True)  # Never leave a partial snapshot behind
+        raise
+
+    with open(os.path.join(snapshot, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'files': files}, file, indent=2)
+    if keep is not None:
+        prune_snapshots(directory, keep)
+    return snapshot
+
+
+def list_snapshots(directory=BACKUP_DIR):
+    """
+    Returns the complete snapshots (those with a manifest) in directory, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory))
+        if os.path.isfile(os.path.join(directory, name, MANIFEST))
+    ]
+
+
+def prune_snapshots(directory=BACKUP_DIR, keep=14):
+    """
+    Deletes every snapshot but the newest keep ones. Returns the deleted paths.
+    """
+    snapshots = list_snapshots(directory)
+    expired = snapshots[:max(len(snapshots) - keep, 0)]
+    for snapshot in expired:
+        shutil.rmtree(snapshot)
+    return expired
+
+
+def verify_snapshot(snapshot):
+    """
+    Checks every file of a snapshot.
+
+    Returns:
+        dict: file name -> list of problems, empty lists when the snapshot is fine.
+    """
+    return {entry['file']: verify_file(os.path.join(snapshot, entry['file'])) for entry in _read_manifest(snapshot)['files']}
+
+
+def restore_snapshot(snapshot, directory):
+    """
+    Restores a snapshot into new files in directory, never over existing files. The files keep their snapshot
+    names, prefixed with the shard index, so shards with the same file name in different directories stay apart.
+    Point HEALTH_MONITORING_SHARDS (or database.DB_PATH for a single file) at the returned paths once the
+    application is stopped.
+
+    Returns:
+        list of str: The restored files, in shard order.
+    """
+    entries = _read_manifest(snapshot)['files']
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, entry['file']) for entry in entries]
+    for path in paths:
+        if os.path.exists(path):
+            raise BackupError(f'{path} already exists')
+
+    for entry, path in zip(entries, paths):
+        source = os.path.join(snapshot, entry['file'])
+        problems = verify_file(source)
+        if problems:
+            raise BackupError(f'{source} failed the integrity check: {problems[:5]}')
+        backup_file(source, path, pages_per_step=-1, pause=0)
+        if verify_file(path):
+            raise BackupError(f'The restored {path} failed the integrity check')
+    return paths
+
+
+def run_schedule(every_minutes, directory=BACKUP_DIR, keep=24, **kwargs):
+    """
+    Takes a snapshot every every_minutes minutes until interrupted. A failed snapshot is reported and the
+    schedule continues.
+    """
+    while True:
+        started = time.monotonic()
+        try:
+            snapshot = take_snapshot(directory, keep, **kwargs)
+            print(f'{datetime.now():%Y-%m-%d %H:%M:%S} snapshot {snapshot}')
+        except (BackupError, sqlite3.Error, OSError) as error:
+            print(f'{datetime.now():%Y-%m-%d %H:%M:%S} snapshot failed: {error}')
+        time.sleep(max(every_minutes * 60 - (time.monotonic() - started), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--directory', default=BACKUP_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = commands.add_parser('snapshot')
+    snapshot_parser.add_argument('--keep', type=int)
+    schedule_parser = commands.add_parser('schedule')
+    schedule_parser.add_argument('--every', type=float, required=True, help='Minutes between snapshots')
+    schedule_parser.add_argument('--keep', type=int, default=24)
+    commands.add_parser('list')
+    verify_parser = commands.add_parser('verify')
+    verify_parser.add_argument('snapshot')
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('snapshot')
+    restore_parser.add_argument('target')
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        print(take_snapshot(args.directory, args.keep))
+    elif args.command == 'schedule':
+        try:
+            run_schedule(args.every, args.directory, args.keep)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'list':
+        for snapshot in list_snapshots(args.directory):
+            manifest = _read_manifest(snapshot)
+            print(f"{snapshot}  {manifest['created']}  {len(manifest['files'])} file(s)")
+    elif args.command == 'verify':
+        results = verify_snapshot(args.snapshot)
+        for name, problems in results.items():
+            print(f"{name}: {'ok' if not problems else '; '.join(problems[:5])}")
+        if any(results.values()):
+            raise SystemExit(1)
+    elif args.command == 'restore':
+        paths = restore_snapshot(args.snapshot, args.target)
+        print('HEALTH_MONITORING_SHARDS=' + ','.join(paths))
+
+
+if __name__ == '__main__':
+    main()
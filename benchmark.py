@@ -0,0 +1,1204 @@
+"""
+Benchmarks for the data layer.
+
+Every benchmark builds a synthetic database in a temporary directory (the real health_monitoring.db is never touched),
+points database.DB_PATH at it and times the query functions against it.
+
+Usage:
+    python benchmark.py cohort --lab-results 10000000
+    python benchmark.py cohort --keep bench.db      (keep the generated database for later runs)
+    python benchmark.py cohort --reuse bench.db     (skip generation)
+    python benchmark.py reminders --appointments 20000000
+    python benchmark.py async-sections --patients 2000   (exits with status 1 unless the concurrent loads are faster)
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import database
+
+FIRST_NAMES = ["Ahmet", "Ayşe", "Mehmet", "Fatma", "Ali", "Zeynep", "Mustafa", "Elif", "Hasan", "Emine", "John", "Jane"]
+LAST_NAMES = ["Yılmaz", "Kaya", "Demir", "Çelik", "Şahin", "Yıldız", "Öztürk", "Aydın", "Doe", "Arslan"]
+SPECIALIZATIONS = ["Kulak Burun Boğaz", "Nöroloji", "Ortopedi", "Kardiyoloji", "Dahiliye", "Göz"]
+TEST_TYPES = [
+    (1, "MR", "Manyetik Rezonans Görüntüleme"),
+    (2, "Röntgen", "Kemik Yapılarının Görüntülenmesi"),
+    (3, "Tomografi", "Bilgisayarlı Tomografi Taraması"),
+    (4, "Kan Tahlili", "Kan Testi"),
+]
+ANALYTE_RANGES = {"T1": (0, 200), "T2": (0, 200), "CRP": (0, 100), "B12": (100, 900), "Mg": (1, 3), "Fe": (20, 200)}
+COMMENTS = ["overall acceptable", "needs follow-up", "values are within range", "repeat test in 3 months",
+            "Lungs are clear, no issues", "Leg injury, may need surgery", "B12 is low"]
+NOTE_SENTENCES = [
+    "Blood pressure {}/{} mmHg, pulse {} bpm.", "CRP {} mg/L, B12 {} pg/mL, ferritin {} ng/mL.",
+    "Patient reports intermittent headache for {} days, no nausea or visual disturbance.",
+    "Lungs are clear on auscultation, no wheezing or crackles.", "Abdomen soft and non-tender, bowel sounds normal.",
+    "Continue current medication, dose reviewed and unchanged.", "Advised to reduce salt intake and walk {} minutes a day.",
+    "Control visit in {} weeks with repeat blood tests.", "Leg injury healing well, wound clean and dry.",
+    "Referred to physiotherapy for {} sessions.", "No known allergies, smokes {} cigarettes a day.",
+    "Weight {} kg, height {} cm.", "Complains of lower back pain for {} weeks, worse in the morning.",
+    "Sleep quality poor, about {} hours a night.", "Blood sugar {} mg/dL fasting, HbA1c to be repeated.",
+    "Family history of hypertension and type 2 diabetes.", "Patient informed about the results and the treatment plan.",
+    "Knee range of motion {} degrees, mild swelling.", "Start {} mg once daily after breakfast.",
+    "Chest X-ray shows no acute findings.",
+]
+MEDICINE_STEMS = ["Amoksi", "Parase", "Ibupro", "Sefu", "Metfo", "Atorva", "Losar", "Omepra", "Panto", "Levo",
+                  "Klari", "Azitro", "Sertra", "Essita", "Ramip", "Amlo", "Bisop", "Furo", "Predni", "Deksa"]
+MEDICINE_ENDINGS = ["sil", "tamol", "fen", "roksim", "rmin", "statin", "tan", "zol", "prazol", "floksasin"]
+BATCH_SIZE = 50000
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _random_datetime(rng, start, days):
+    moment = start + timedelta(days=rng.randrange(days), hours=rng.randrange(9, 18), minutes=rng.choice((0, 30)))
+    return moment
+
+
+def generate_database(path, patients=10000, doctors=100, appointments=100000, lab_results=100000,
+                      medical_records=20000, prescriptions=20000, seed=372):
+    """
+    Creates a database at path with the application schema and random data of the requested size.
+    """
+    rng = random.Random(seed)
+    database.DB_PATH = path
+    database.create_tables()
+
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    cursor = connection.cursor()
+    start = datetime.now() - timedelta(days=365)
+    patient_ids = [10000000000 + i for i in range(patients)]
+
+    cursor.executemany('INSERT INTO DoctorsSpecializations (Specialization) VALUES (?)',
+                       [(name,) for name in SPECIALIZATIONS])
+    cursor.executemany('INSERT INTO TestTypes (TestTypeID, TestType, Description) VALUES (?, ?, ?)', TEST_TYPES)
+    cursor.executemany('''
+        INSERT INTO Doctors (FirstName, LastName, SpecializationID, ContactInfo, HireDate, Username, Password)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.randrange(len(SPECIALIZATIONS)) + 1,
+         f"doctor{i}@example.com", "2020-01-01", f"doctor{i}", "password")
+        for i in range(doctors)
+    ])
+    cursor.executemany('''
+        INSERT INTO Patients (NationalID, FirstName, LastName, DateOfBirth, Gender, ContactInfo, CreatedAt, Username, Password)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (patient_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), "1990-01-01", None,
+         f"patient{patient_id}@example.com", "2024-01-01", f"patient{patient_id}", "password")
+        for patient_id in patient_ids
+    ])
+
+    def appointment_rows():
+        for _ in range(appointments):
+            slot = database.appointment_slot(_random_datetime(rng, start, 395))
+            yield (rng.choice(patient_ids), rng.randrange(doctors) + 1, database.slot_to_text(slot), "checkup", slot)
+
+    for batch in _batches(appointment_rows()):
+        cursor.executemany('''
+            INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot) VALUES (?, ?, ?, ?, ?)
+        ''', batch)
+
+    def lab_result_rows():
+        for _ in range(lab_results):
+            test_type_id = rng.randrange(4) + 1
+            data = {"doctor_comment": rng.choice(COMMENTS)}
+            for analyte in database.TEST_TYPE_ANALYTES[test_type_id]:
+                low, high = ANALYTE_RANGES[analyte]
+                data[analyte] = round(rng.uniform(low, high), 1)
+            moment = _random_datetime(rng, start, 365)
+            yield (rng.choice(patient_ids), rng.randrange(doctors) + 1, test_type_id,
+                   rng.randrange(max(appointments, 1)) + 1, json.dumps(data), f"{moment:%Y-%m-%d %H:%M:%S}")
+
+    for batch in _batches(lab_result_rows()):
+        cursor.executemany('''
+            INSERT INTO LabResults (PatientID, DoctorID, TestTypeID, AppointmentID, ResultData, TestDate)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', batch)
+
+    def medical_record_rows():
+        for _ in range(medical_records):
+            moment = _random_datetime(rng, start, 365)
+            yield (rng.choice(patient_ids), rng.randrange(doctors) + 1, "Diagnosis", rng.choice(COMMENTS),
+                   " ".join(rng.choice(COMMENTS) for _ in range(5)), f"{moment:%Y-%m-%d %H:%M:%S}",
+                   rng.randrange(max(appointments, 1)) + 1)
+
+    for batch in _batches(medical_record_rows()):
+        cursor.executemany('''
+            INSERT INTO MedicalRecords (PatientID, DoctorID, Diagnosis, Treatment, Notes, CreatedDate, AppointmentID)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+
+    medicines = ["Parol", "Aspirin", "Augmentin", "Majezik", "Nexium", "Coraspin", "Arveles", "Dolorex"] + [
+        f"{stem}{ending} {strength} mg" for stem in MEDICINE_STEMS for ending in MEDICINE_ENDINGS for strength in (5, 10, 20, 50, 100)
+    ]
+
+    def typed(name):
+        # One line in ten is typed with a spelling variant the catalog migration folds together
+        if rng.random() < 0.9:
+            return name
+        return rng.choice((name.lower(), name.upper(), f" {name}  ", name.replace(" ", "  ")))
+
+    for prescription_id in range(1, prescriptions + 1):
+        moment = _random_datetime(rng, start, 365)
+        cursor.execute('''
+            INSERT INTO Prescriptions (PrescriptionID, PatientID, DoctorID, AppointmentID, PrescribedDate)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (prescription_id, rng.choice(patient_ids), rng.randrange(doctors) + 1,
+              rng.randrange(max(appointments, 1)) + 1, f"{moment:%Y-%m-%d}"))
+        cursor.executemany('''
+            INSERT INTO PrescriptionDetails (PrescriptionID, MedicineName, Dosage, Instructions) VALUES (?, ?, ?, ?)
+        ''', [(prescription_id, typed(rng.choice(medicines)), "1x1", "after meals") for _ in range(rng.randrange(1, 4))])
+
+    connection.commit()
+    connection.close()
+    database.migrate()
+
+
+def time_call(function, *args, repeat=5, **kwargs):
+    """
+    Calls function repeat times and returns (median milliseconds, last result).
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+
+def report(label, milliseconds, extra=""):
+    print(f"{label:<60} {milliseconds:>10.2f} ms  {extra}")
+
+
+# ** Benchmarks **
+
+def bench_cohort(args):
+    from cohort_query import find_cohort, days_ago
+
+    since = days_ago(30)
+    cases = [
+        ("Fe < 30", dict(value_conditions=[("Fe", "<", 30)])),
+        ("Fe < 30 in the last 30 days", dict(value_conditions=[("Fe", "<", 30)], since=since)),
+        ("Kan Tahlili, CRP > 90, doctor 1", dict(value_conditions=[("CRP", ">", 90)], test_type_id=4, doctor_id=1)),
+        ("CRP change > 50 (pandas window)", dict(change_conditions=[("CRP", ">", 50)], test_type_id=4)),
+        ("Fe < 30 and CRP change > 50", dict(value_conditions=[("Fe", "<", 30)],
+                                             change_conditions=[("CRP", ">", 50)], test_type_id=4)),
+    ]
+    for label, kwargs in cases:
+        milliseconds, (patients, total) = time_call(find_cohort, repeat=args.repeat, page_size=50, **kwargs)
+        report(f"find_cohort: {label}", milliseconds, f"{total} patients")
+
+    # Baseline: what the same question costs today, looping get_lab_results_by_patient over every patient
+    from query_func import get_lab_results_by_patient
+    connection = sqlite3.connect(database.DB_PATH)
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients LIMIT 1000')]
+    connection.close()
+
+    def loop_patients():
+        matching = 0
+        for patient_id in patient_ids:
+            for result in get_lab_results_by_patient(patient_id):
+                if json.loads(result.result_data).get("Fe", 1000) < 30:
+                    matching += 1
+                    break
+        return matching
+
+    milliseconds, _ = time_call(loop_patients, repeat=1)
+    report(f"baseline: per-patient loop, first {len(patient_ids)} patients", milliseconds)
+
+
+def bench_lab_fields(args):
+    from query_func import get_lab_results_by_patient, get_lab_result_fields_by_patient, get_lab_result_values_by_patient
+
+    connection = sqlite3.connect(database.DB_PATH)
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients LIMIT 500')]
+
+    def python_parsing():
+        for patient_id in patient_ids:
+            for result in get_lab_results_by_patient(patient_id):
+                data = json.loads(result.result_data)
+                data.get("doctor_comment"), data.get("CRP")
+
+    def sql_extraction():
+        for patient_id in patient_ids:
+            get_lab_result_fields_by_patient(patient_id, ["doctor_comment", "CRP"])
+
+    def sql_all_values():
+        for patient_id in patient_ids:
+            get_lab_result_values_by_patient(patient_id)
+
+    milliseconds, _ = time_call(python_parsing, repeat=args.repeat)
+    report(f"get_lab_results_by_patient + json.loads, {len(patient_ids)} patients", milliseconds)
+    milliseconds, _ = time_call(sql_extraction, repeat=args.repeat)
+    report(f"SQL-side extraction of 2 fields, {len(patient_ids)} patients", milliseconds)
+    milliseconds, _ = time_call(sql_all_values, repeat=args.repeat)
+    report(f"SQL-side extraction of all fields, {len(patient_ids)} patients", milliseconds)
+
+    def count(sql):
+        return connection.execute(sql).fetchone()[0]
+
+    # NOT INDEXED forces the full scan a plain json_extract filter needs
+    for label, sql in [
+        ("json_extract filter, full scan", "SELECT COUNT(*) FROM LabResults NOT INDEXED WHERE json_extract(ResultData, '$.Fe') < 30"),
+        ("generated column filter, indexed", "SELECT COUNT(*) FROM LabResults WHERE FeValue < 30"),
+        ("json_extract range, full scan", "SELECT COUNT(*) FROM LabResults NOT INDEXED WHERE json_extract(ResultData, '$.CRP') BETWEEN 50 AND 51"),
+        ("generated column range, indexed", "SELECT COUNT(*) FROM LabResults WHERE CRPValue BETWEEN 50 AND 51"),
+    ]:
+        milliseconds, rows = time_call(count, sql, repeat=args.repeat)
+        report(label, milliseconds, f"{rows} rows")
+    connection.close()
+
+
+def bench_slots(args):
+    from query_func import (get_appointments_by_doctor, get_appointments_by_doctor_between,
+                            get_doctor_booked_slots, is_doctor_slot_booked)
+
+    connection = sqlite3.connect(database.DB_PATH)
+    # Text-column counterpart of idx_appointments_doctor_slot, so both sides are indexed
+    connection.execute('CREATE INDEX IF NOT EXISTS bench_appointments_doctor_date ON Appointments (DoctorID, AppointmentDate)')
+    connection.commit()
+    doctor_id = 1
+    day = connection.execute('SELECT substr(AppointmentDate, 1, 10) FROM Appointments WHERE DoctorID = ? LIMIT 1',
+                             (doctor_id,)).fetchone()[0]
+    appointment_date = connection.execute('SELECT AppointmentDate FROM Appointments WHERE DoctorID = ? LIMIT 1',
+                                          (doctor_id,)).fetchone()[0]
+    start_slot, end_slot = database.day_slot_range(day)
+    week_end_slot = start_slot + 7 * database.MINUTES_PER_DAY
+
+    def query(sql, params):
+        return connection.execute(sql, params).fetchall()
+
+    cases = [
+        ("ORDER BY AppointmentDate (text)",
+         query, ('SELECT AppointmentID FROM Appointments WHERE DoctorID = ? ORDER BY AppointmentDate', (doctor_id,))),
+        ("ORDER BY AppointmentSlot (integer)",
+         query, ('SELECT AppointmentID FROM Appointments WHERE DoctorID = ? ORDER BY AppointmentSlot', (doctor_id,))),
+        ("one week, text range",
+         query, ('SELECT AppointmentID FROM Appointments WHERE DoctorID = ? AND AppointmentDate >= ? AND AppointmentDate < ?',
+                 (doctor_id, day, database.slot_to_text(week_end_slot)))),
+        ("one week, integer range",
+         query, ('SELECT AppointmentID FROM Appointments WHERE DoctorID = ? AND AppointmentSlot >= ? AND AppointmentSlot < ?',
+                 (doctor_id, start_slot, week_end_slot))),
+    ]
+    for label, function, call_args in cases:
+        milliseconds, rows = time_call(function, *call_args, repeat=args.repeat)
+        report(label, milliseconds, f"{len(rows)} rows")
+
+    # Page-level helpers: what all_appointments_page / appointments_page did before and do now
+    def old_day_filter():
+        return [a for a in get_appointments_by_doctor(doctor_id) if a.appointment_date.startswith(day)]
+
+    def old_slot_check():
+        return any(a.appointment_date == appointment_date for a in get_appointments_by_doctor(doctor_id))
+
+    for label, function, call_args in [
+        ("day filter: full history + startswith", old_day_filter, ()),
+        ("day filter: get_appointments_by_doctor_between", get_appointments_by_doctor_between,
+         (doctor_id, start_slot, end_slot)),
+        ("booked hours of a day: get_doctor_booked_slots", get_doctor_booked_slots, (doctor_id, start_slot, end_slot)),
+        ("slot check: full history + equality", old_slot_check, ()),
+        ("slot check: is_doctor_slot_booked", is_doctor_slot_booked, (doctor_id, appointment_date)),
+    ]:
+        milliseconds, _ = time_call(function, *call_args, repeat=args.repeat)
+        report(label, milliseconds)
+
+    try:
+        sizes = connection.execute('''
+            SELECT name, SUM(pgsize) FROM dbstat
+            WHERE name IN ('bench_appointments_doctor_date', 'idx_appointments_doctor_slot') GROUP BY name
+        ''').fetchall()
+    except sqlite3.OperationalError:
+        sizes = []  # SQLite built without the dbstat virtual table
+    for name, size in sizes:
+        print(f"{'index size ' + name:<60} {size / 1024 / 1024:>10.2f} MB")
+    connection.close()
+
+
+def bench_first_available(args):
+    from query_func import find_earliest_available_slots, get_appointments_by_doctor, get_doctors_by_specialization
+
+    specialization = SPECIALIZATIONS[0]
+    doctors = get_doctors_by_specialization(specialization)
+    print(f"{len(doctors)} doctors in {specialization}")
+
+    for days in (5, 14, 42):
+        milliseconds, options = time_call(find_earliest_available_slots, specialization, k=5, days=days,
+                                          patient_id=10000000000, repeat=args.repeat)
+        report(f"find_earliest_available_slots, k=5, {days} days", milliseconds, options[0][0] if options else "")
+
+    # Baseline: the booking page flow, full appointment history of every doctor
+    def per_doctor_histories():
+        for doctor in doctors:
+            get_appointments_by_doctor(doctor.doctor_id)
+
+    milliseconds, _ = time_call(per_doctor_histories, repeat=1)
+    report("baseline: get_appointments_by_doctor for every doctor", milliseconds)
+
+
+def bench_refresh(args):
+    from query_func import add_medical_record, get_medical_records_by_patient
+    from view_state import refresh_rows
+
+    connection = sqlite3.connect(database.DB_PATH)
+    for history in (100, 1000, 10000):
+        patient_id = 90000000000 + history
+        connection.executemany('''
+            INSERT INTO MedicalRecords (PatientID, DoctorID, Diagnosis, Treatment, Notes, CreatedDate, AppointmentID)
+            VALUES (?, 1, 'Diagnosis', 'Treatment', 'Notes', ?, 1)
+        ''', [(patient_id, f"2024-01-01 00:00:{i % 60:02d}") for i in range(history)])
+        connection.commit()
+
+        def fetch(ids):
+            return get_medical_records_by_patient(patient_id, ids)
+
+        view = {}
+        refresh_rows(view, patient_id, ["MedicalRecords"], fetch)
+
+        milliseconds, _ = time_call(fetch, None, repeat=args.repeat)
+        report(f"full reload, {history} records", milliseconds)
+        milliseconds, _ = time_call(refresh_rows, view, patient_id, ["MedicalRecords"], fetch, repeat=args.repeat)
+        report(f"refresh, no changes, {history} records", milliseconds)
+
+        def refresh_after_insert():
+            add_medical_record(patient_id, 1, "New", "Treatment", "Notes", "2024-02-01 00:00:00", 1)
+            return refresh_rows(view, patient_id, ["MedicalRecords"], fetch)
+
+        milliseconds, rows = time_call(refresh_after_insert, repeat=args.repeat)
+        report(f"insert + refresh, 1 change, {history} records", milliseconds, f"{len(rows)} rows")
+    connection.close()
+
+
+def _frontend(socket_path, db_path, patient_ids, doctor_ids, page_views):
+    """
+    One frontend process rendering page_views patient/doctor pages. Runs in a spawned process,
+    so query_func is imported here, after choosing between the data service and direct connections.
+    """
+    if socket_path:
+        os.environ["HEALTH_MONITORING_DATA_SERVICE"] = socket_path
+    else:
+        os.environ.pop("HEALTH_MONITORING_DATA_SERVICE", None)
+    os.environ["HEALTH_MONITORING_SHARDS"] = db_path
+    import query_func
+
+    rng = random.Random(os.getpid())
+    latencies = []
+    for _ in range(page_views):
+        patient_id = rng.choice(patient_ids)
+        doctor_id = rng.choice(doctor_ids)
+        started = time.perf_counter()
+        query_func.get_change_feed_position(patient_id)
+        query_func.get_appointments_by_patient(patient_id)
+        query_func.get_medical_records_by_patient(patient_id)
+        query_func.get_lab_result_values_by_patient(patient_id)
+        query_func.get_prescriptions_by_patient(patient_id)
+        query_func.get_all_specializations()
+        query_func.get_doctor_totals(doctor_id)
+        query_func.get_doctor_name_from_id(doctor_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def bench_data_service(args):
+    import multiprocessing
+    import subprocess
+    import sys
+
+    connection = sqlite3.connect(database.DB_PATH)
+    # A hot set of patients, as on a clinic day where the same patients reopen their pages
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients LIMIT 200')]
+    doctor_ids = [row[0] for row in connection.execute('SELECT DoctorID FROM Doctors')]
+    connection.close()
+    page_views = max(args.repeat, 1) * 40
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "data_service.sock")
+        environment = dict(os.environ, HEALTH_MONITORING_SHARDS=database.DB_PATH)
+        environment.pop("HEALTH_MONITORING_DATA_SERVICE", None)
+        service = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_service.py"),
+                                    "--socket", socket_path, "--readers", "4"], env=environment, stdout=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+            context = multiprocessing.get_context("spawn")
+            for processes in (1, 4, 16):
+                for label, path in (("direct connections", None), ("data service", socket_path)):
+                    with context.Pool(processes) as pool:
+                        started = time.perf_counter()
+                        results = pool.starmap(_frontend, [(path, database.DB_PATH, patient_ids, doctor_ids, page_views)]
+                                               * processes)
+                        elapsed = time.perf_counter() - started
+                    latencies = sorted(latency for result in results for latency in result)
+                    p95 = latencies[int(len(latencies) * 0.95)]
+                    report(f"{processes:>2} frontends, {label}, p50 page", statistics.median(latencies),
+                           f"p95 {p95:.2f} ms, {len(latencies) / elapsed:.0f} pages/s")
+        finally:
+            service.terminate()
+            service.wait()
+
+
+def bench_async_sections(args):
+    import query_func
+    from async_query import load_concurrently
+
+    connection = sqlite3.connect(database.DB_PATH)
+    # The patient with the longest history, so every section has rows to read
+    patient_id = connection.execute('''
+        SELECT PatientID FROM LabResults GROUP BY PatientID ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()[0]
+    connection.close()
+    today = datetime.now().date()
+    pages = {
+        "doctor statistics page (5 sections)": [
+            (query_func.get_doctor_totals, 1),
+            (query_func.get_doctor_daily_appointment_counts, 1, today - timedelta(days=30), today + timedelta(days=15)),
+            (query_func.get_doctor_daily_appointment_counts, 1, today - timedelta(weeks=12), today + timedelta(weeks=1)),
+            (query_func.get_doctor_test_type_counts, 1),
+            (query_func.get_doctor_no_show_counts, 1, today - timedelta(days=30), today),
+        ],
+        "patient overview (5 sections)": [
+            (query_func.get_appointments_by_patient, patient_id),
+            (query_func.get_medical_records_by_patient, patient_id),
+            (query_func.get_lab_result_values_by_patient, patient_id),
+            (query_func.get_prescriptions_by_patient, patient_id),
+            (query_func.find_earliest_available_slots, SPECIALIZATIONS[0], 5, 14, patient_id),
+        ],
+    }
+    # Also a check of the async read API: the pages must get the same sections back, in less wall time
+    failures = []
+    for label, calls in pages.items():
+        def sequential():
+            return [function(*call_args) for function, *call_args in calls]
+
+        sequential_milliseconds, sequential_results = time_call(sequential, repeat=args.repeat)
+        report(f"{label}, one after another", sequential_milliseconds)
+        concurrent_milliseconds, concurrent_results = time_call(load_concurrently, *calls, repeat=args.repeat)
+        report(f"{label}, load_concurrently", concurrent_milliseconds,
+               f"{sequential_milliseconds / concurrent_milliseconds:.1f}x")
+        if concurrent_results != sequential_results:
+            failures.append(f"{label}: load_concurrently returned other results")
+        elif concurrent_milliseconds >= sequential_milliseconds:
+            failures.append(f"{label}: load_concurrently is not faster")
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+def bench_backup(args):
+    import threading
+    import backup
+    import query_func
+
+    connection = sqlite3.connect(database.DB_PATH)
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients LIMIT 1000')]
+    connection.close()
+    print(f"database size {os.path.getsize(database.DB_PATH) / 1024 / 1024:.1f} MB")
+    rng = random.Random(372)
+
+    def foreground(done, writes):
+        # What the pages do meanwhile: patient reads, and a medical record written every 10th request
+        latencies = []
+        requests = 0
+        while not done.is_set() or requests < 50:
+            patient_id = rng.choice(patient_ids)
+            started = time.perf_counter()
+            if writes and requests % 10 == 0:
+                query_func.add_medical_record(patient_id, 1, "Backup", "Treatment", "Notes", "2024-02-01 00:00:00", 1)
+            else:
+                query_func.get_appointments_by_patient(patient_id)
+                query_func.get_medical_records_by_patient(patient_id)
+            latencies.append((time.perf_counter() - started) * 1000)
+            requests += 1
+        return sorted(latencies)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cases = [
+            ("no backup", None),
+            ("one-step backup", dict(pages_per_step=-1, pause=0)),
+            ("paced backup, 256 pages/step", dict(pages_per_step=256, pause=0.005)),
+        ]
+        for mode, writes in (("reads", False), ("reads + writes", True), ("reads + writes, WAL", True)):
+            if mode.endswith("WAL"):
+                # In WAL mode the backup's read transaction does not block writers
+                connection = sqlite3.connect(database.DB_PATH)
+                connection.execute('PRAGMA journal_mode = WAL')
+                connection.close()
+            for label, backup_kwargs in cases:
+                done = threading.Event()
+                stats = {}
+
+                def run_backup():
+                    if backup_kwargs is None:
+                        time.sleep(0.5)
+                    else:
+                        target = os.path.join(directory, f"copy_{time.perf_counter_ns()}.db")
+                        stats.update(backup.backup_file(database.DB_PATH, target, **backup_kwargs))
+                        os.remove(target)
+                    done.set()
+
+                thread = threading.Thread(target=run_backup)
+                thread.start()
+                latencies = foreground(done, writes)
+                thread.join()
+                extra = f"p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms, max {latencies[-1]:.2f} ms"
+                if stats:
+                    extra += f", backup {stats['seconds']:.2f} s, {stats['restarts']} restarts"
+                report(f"{mode}, {label}, p50", statistics.median(latencies), extra)
+
+
+def bench_profiles(args):
+    import query_func
+    import storage
+    from cohort_query import find_cohort
+
+    connection = sqlite3.connect(database.DB_PATH)
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients LIMIT 300')]
+    connection.close()
+    start_slot, end_slot = database.day_slot_range(datetime.now().date())
+
+    def patient_pages():
+        for patient_id in patient_ids:
+            query_func.get_appointments_by_patient(patient_id)
+            query_func.get_lab_result_values_by_patient(patient_id)
+            query_func.get_medical_records_by_patient(patient_id)
+
+    def slot_checks():
+        for doctor_id in range(1, 101):
+            query_func.get_doctor_booked_slots(doctor_id, start_slot, end_slot)
+
+    def cohort():
+        return find_cohort(value_conditions=[("Fe", "<", 30)], change_conditions=[("CRP", ">", 50)], test_type_id=4)
+
+    def writes():
+        for patient_id in patient_ids[:100]:
+            query_func.add_medical_record(patient_id, 1, "Profile", "Treatment", "Notes", "2024-02-01 00:00:00", 1)
+
+    workloads = [
+        (f"{len(patient_ids)} patient pages", patient_pages),
+        ("booked slots of 100 doctors", slot_checks),
+        ("cohort Fe < 30 and CRP change > 50", cohort),
+        ("100 medical record inserts (one commit each)", writes),
+    ]
+    # Per-call connections are what the pages use, persistent ones what data_service and async_query threads use
+    for persistent in (False, True):
+        if persistent:
+            query_func.use_persistent_connections()
+        for profile in ("default", "interactive", "read-mostly", "bulk-load"):
+            # journal_mode is stored in the file, go back to SQLite's default for the default profile
+            query_func.close_persistent_connections()
+            if persistent:
+                query_func.use_persistent_connections()
+            connection = sqlite3.connect(database.DB_PATH)
+            connection.execute(f"PRAGMA journal_mode = {storage.PROFILES[profile].get('journal_mode', 'DELETE')}")
+            connection.close()
+            storage.set_profile(profile)
+            for label, function in workloads:
+                milliseconds, _ = time_call(function, repeat=args.repeat)
+                report(f"{profile}, {'persistent' if persistent else 'per-call'}: {label}", milliseconds)
+
+    # Statistics: the same reads before and after the maintenance job's first ANALYZE
+    storage.set_profile("interactive")
+    print(f"maintenance: {storage.run_maintenance(database.DB_PATH)}")
+    for label, function in workloads[:3]:
+        milliseconds, _ = time_call(function, repeat=args.repeat)
+        report(f"interactive after ANALYZE: {label}", milliseconds)
+
+
+def bench_medicines(args):
+    from medicine_catalog import medicine_index
+
+    connection = sqlite3.connect(database.DB_PATH)
+    # The free-text layout before the catalog, rebuilt from the migrated rows for comparison
+    connection.execute('DROP TABLE IF EXISTS bench_details_text')
+    connection.execute('''
+        CREATE TABLE bench_details_text AS
+        SELECT pd.DetailID, pd.PrescriptionID, m.Name AS MedicineName, pd.Dosage, pd.Instructions
+        FROM PrescriptionDetails pd JOIN Medicines m ON m.MedicineID = pd.MedicineID
+    ''')
+    connection.commit()
+    medicine_count = connection.execute('SELECT COUNT(*) FROM Medicines').fetchone()[0]
+    lines = connection.execute('SELECT COUNT(*) FROM PrescriptionDetails').fetchone()[0]
+    print(f"{medicine_count} medicines in the catalog, {lines} prescription lines")
+    try:
+        for name, size in connection.execute('''
+            SELECT name, SUM(pgsize) FROM dbstat WHERE name IN ('PrescriptionDetails', 'bench_details_text', 'Medicines')
+            GROUP BY name
+        '''):
+            print(f"{'table size ' + name:<60} {size / 1024 / 1024:>10.2f} MB")
+    except sqlite3.OperationalError:
+        pass  # SQLite built without the dbstat virtual table
+
+    milliseconds, index = time_call(medicine_index, repeat=1)
+    report(f"load the autocomplete index ({len(index)} names)", milliseconds)
+    prefixes = ["a", "pa", "amo", "ator", "metfo", "levofl", "deksatan 1", "x"]
+
+    def index_search():
+        for prefix in prefixes:
+            index.search(prefix)
+
+    def catalog_range_query():
+        for prefix in prefixes:
+            # Prefix as a range on the UNIQUE NormalizedName index
+            connection.execute('SELECT MedicineID, Name FROM Medicines WHERE NormalizedName >= ? AND NormalizedName < ? '
+                               'ORDER BY NormalizedName LIMIT 10', (prefix, prefix + '\U0010ffff')).fetchall()
+
+    def free_text_like():
+        for prefix in prefixes:
+            connection.execute('SELECT DISTINCT MedicineName FROM bench_details_text WHERE MedicineName LIKE ? LIMIT 10',
+                               (prefix + '%',)).fetchall()
+
+    for label, function in [
+        ("autocomplete: in-memory index", index_search),
+        ("autocomplete: catalog range query", catalog_range_query),
+        ("autocomplete: LIKE over free-text lines", free_text_like),
+    ]:
+        milliseconds, _ = time_call(function, repeat=args.repeat)
+        report(f"{label}, {len(prefixes)} prefixes", milliseconds)
+
+    medicine_id, name = connection.execute('SELECT MedicineID, Name FROM Medicines ORDER BY MedicineID LIMIT 1 OFFSET 10').fetchone()
+    for label, sql, params in [
+        ("lines of one drug: MedicineID index", 'SELECT COUNT(*) FROM PrescriptionDetails WHERE MedicineID = ?', (medicine_id,)),
+        ("lines of one drug: free-text scan with variants",
+         'SELECT COUNT(*) FROM bench_details_text WHERE lower(trim(MedicineName)) = lower(?)', (name,)),
+    ]:
+        milliseconds, rows = time_call(lambda: connection.execute(sql, params).fetchone()[0], repeat=args.repeat)
+        report(label, milliseconds, f"{rows} lines")
+    connection.execute('DROP TABLE bench_details_text')
+    connection.commit()
+    connection.close()
+
+
+def bench_interactions(args):
+    from interactions import InteractionIndex, load_interactions
+    from medicine_catalog import medicine_index
+    from query_func import get_active_medicine_ids
+
+    rng = random.Random(7)
+    medicines = medicine_index()
+    connection = sqlite3.connect(database.DB_PATH)
+    catalog = connection.execute('SELECT MedicineID, Name FROM Medicines').fetchall()
+    names = [name for _, name in catalog]
+    # The shipped dataset plus random pairs between catalog medicines, about 5% of all pairs
+    interactions = load_interactions() + [
+        (*rng.sample(names, 2), rng.choice(["major", "moderate", "minor"]), "synthetic")
+        for _ in range(len(names) * (len(names) - 1) // 40)
+    ]
+    milliseconds, index = time_call(InteractionIndex, interactions, medicines, repeat=1)
+    report(f"build the pair index ({len(index)} pairs)", milliseconds)
+
+    medicine_ids = [medicine_id for medicine_id, _ in catalog]
+    history = rng.sample(medicine_ids, 30)
+    prescribed = [(medicine_id, "") for medicine_id in rng.sample(medicine_ids, 10)]
+    checks = 1000
+    milliseconds, conflicts = time_call(lambda: [index.check(prescribed, history) for _ in range(checks)][-1],
+                                        repeat=args.repeat)
+    report("check 10 new drugs against a 30-drug history", milliseconds / checks, f"{len(conflicts)} conflicts")
+
+    # The same check as a query over an interaction table with a (MedicineA, MedicineB) primary key
+    connection.execute('DROP TABLE IF EXISTS bench_interactions')
+    connection.execute('CREATE TABLE bench_interactions (MedicineA INTEGER, MedicineB INTEGER, Severity TEXT, '
+                       'PRIMARY KEY (MedicineA, MedicineB)) WITHOUT ROWID')
+    ids = dict((name, medicine_id) for medicine_id, name in catalog)
+    connection.executemany('INSERT OR IGNORE INTO bench_interactions VALUES (?, ?, ?)', [
+        (min(ids[a], ids[b]), max(ids[a], ids[b]), severity) for a, b, severity, _ in interactions if a in ids and b in ids
+    ])
+    new_ids = [medicine_id for medicine_id, _ in prescribed]
+    new_placeholders = ", ".join("?" for _ in new_ids)
+    all_placeholders = ", ".join("?" for _ in new_ids + history)
+
+    def sql_check():
+        return connection.execute(f'''
+            SELECT MedicineA, MedicineB, Severity FROM bench_interactions
+            WHERE MedicineA IN ({new_placeholders}) AND MedicineB IN ({all_placeholders})
+               OR MedicineB IN ({new_placeholders}) AND MedicineA IN ({all_placeholders})
+        ''', (new_ids + new_ids + history) * 2).fetchall()
+
+    milliseconds, rows = time_call(sql_check, repeat=args.repeat)
+    report("the same check as a query on an interaction table", milliseconds, f"{len(rows)} conflicts")
+    connection.execute('DROP TABLE bench_interactions')
+    connection.commit()
+
+    patient_id, since = connection.execute('''
+        SELECT PatientID, MIN(PrescribedDate) FROM Prescriptions GROUP BY PatientID ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()
+    connection.close()
+    milliseconds, active = time_call(get_active_medicine_ids, patient_id, since, repeat=args.repeat)
+    report("active medicines of the patient with most prescriptions", milliseconds, f"{len(active)} medicines")
+
+
+def bench_reminders(args):
+    import reminders
+
+    job = "bench-reminders"
+    # Today 10:00, so the window's leading edge moves through tomorrow's office hours during the every-minute runs
+    now = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0)
+    connection = sqlite3.connect(database.DB_PATH)
+    connection.execute('DELETE FROM ReminderWatermarks WHERE Job = ?', (job,))
+    connection.execute('DELETE FROM ReminderBatches WHERE Job = ?', (job,))
+    connection.commit()
+    appointments = connection.execute('SELECT MAX(AppointmentID) FROM Appointments').fetchone()[0]
+    print(f"{appointments} appointments")
+
+    sink = reminders.StubSink(keep=False)
+    milliseconds, stats = time_call(reminders.run_once, sink, job, now=now, repeat=1)
+    report("first run, a whole 24 h window", milliseconds, f"{stats['reminders']} reminders, {stats['batches']} batches")
+
+    # The job running every minute, with a few bookings arriving between runs, some into the covered window
+    patient_id, doctor_id = connection.execute('SELECT PatientID, DoctorID FROM Appointments LIMIT 1').fetchone()
+    rng = random.Random(40)
+    timings, sent = [], 0
+    for minute in range(1, 61):
+        slots = [database.appointment_slot(now) + rng.randrange(minute + 1, 2 * database.MINUTES_PER_DAY) for _ in range(3)]
+        connection.executemany('''
+            INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot) VALUES (?, ?, ?, ?, ?)
+        ''', [(patient_id, doctor_id, database.slot_to_text(slot), "bench", slot) for slot in slots])
+        connection.commit()
+        milliseconds, stats = time_call(reminders.run_once, sink, job, now=now + timedelta(minutes=minute), repeat=1)
+        timings.append(milliseconds)
+        sent += stats['reminders']
+    report("run every minute, median of 60 runs", statistics.median(timings), f"{sent} reminders in total")
+    report("run every minute, slowest of 60 runs", max(timings))
+
+    # The same 24 h window read with and without the slot index
+    start_slot = database.appointment_slot(now)
+    params = (start_slot, start_slot + database.MINUTES_PER_DAY, appointments)
+    full_scan = reminders._WINDOW_QUERY.replace('FROM Appointments a', 'FROM Appointments a NOT INDEXED')
+    for label, sql in [("24 h window as a full table scan", full_scan),
+                       ("24 h window on idx_appointments_slot_active", reminders._WINDOW_QUERY)]:
+        milliseconds, rows = time_call(lambda: connection.execute(sql, params).fetchall(), repeat=args.repeat)
+        report(label, milliseconds, f"{len(rows)} rows")
+
+    connection.execute("DELETE FROM Appointments WHERE Reason = 'bench'")
+    connection.execute('DELETE FROM ReminderWatermarks WHERE Job = ?', (job,))
+    connection.execute('DELETE FROM ReminderBatches WHERE Job = ?', (job,))
+    connection.commit()
+    connection.close()
+
+
+def bench_cancellations(args):
+    from query_func import get_doctor_booked_slots, is_doctor_slot_booked
+
+    connection = sqlite3.connect(database.DB_PATH)
+    doctor_id = 1
+    day = (datetime.now() + timedelta(days=7)).strftime("%Y-%m-%d")
+    start_slot, end_slot = database.day_slot_range(day)
+    day_slots = [start_slot + hour * 60 + minute for hour in range(9, 18) for minute in (0, 30)]
+    appointment_date = database.slot_to_text(day_slots[0])
+    patient_id = connection.execute('SELECT NationalID FROM Patients LIMIT 1').fetchone()[0]
+    # The two lookups as raw SQL on the partial index of the active rows and on the index of every row
+    lookups = {
+        "slot check": ("SELECT 1 FROM Appointments INDEXED BY {index} "
+                       "WHERE DoctorID = ? AND AppointmentSlot = ? AND Status = 'active' LIMIT 1",
+                       (doctor_id, day_slots[0])),
+        "booked hours": ("SELECT AppointmentSlot FROM Appointments INDEXED BY {index} "
+                         "WHERE DoctorID = ? AND AppointmentSlot >= ? AND AppointmentSlot < ? AND Status = 'active' "
+                         "ORDER BY AppointmentSlot", (doctor_id, start_slot, end_slot)),
+    }
+    plan = connection.execute("EXPLAIN QUERY PLAN SELECT 1 FROM Appointments WHERE DoctorID = ? AND AppointmentSlot = ? "
+                              "AND Status = 'active'", (doctor_id, day_slots[0])).fetchall()
+    print(f"slot check plan: {plan[0][-1]}")
+
+    # Booked-and-cancelled churn piling up on the doctor's busiest day, the worst case for the lookups
+    cancelled = 0
+    for target in (0, 1000, 10000, 100000):
+        rows = [(patient_id, doctor_id, database.slot_to_text(day_slots[i % len(day_slots)]), "bench-cancelled",
+                 day_slots[i % len(day_slots)]) for i in range(cancelled, target)]
+        for batch in _batches(rows):
+            connection.executemany('''
+                INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot, Status, CancelledAt)
+                VALUES (?, ?, ?, ?, ?, 'cancelled', CURRENT_TIMESTAMP)
+            ''', batch)
+        connection.commit()
+        cancelled = target
+        print(f"{cancelled} cancelled appointments on {day}")
+        milliseconds, _ = time_call(is_doctor_slot_booked, doctor_id, appointment_date, repeat=args.repeat)
+        report("  is_doctor_slot_booked", milliseconds)
+        milliseconds, slots = time_call(get_doctor_booked_slots, doctor_id, start_slot, end_slot, repeat=args.repeat)
+        report("  get_doctor_booked_slots, one day", milliseconds, f"{len(slots)} slots")
+        for label, (sql, params) in lookups.items():
+            for index in ("idx_appointments_doctor_active", "idx_appointments_doctor_slot"):
+                statement = sql.format(index=index)
+                milliseconds, _ = time_call(lambda: connection.execute(statement, params).fetchall(), repeat=args.repeat)
+                report(f"  {label} on {index}", milliseconds)
+
+    connection.execute("DELETE FROM Appointments WHERE Reason = 'bench-cancelled'")
+    connection.commit()
+    connection.close()
+
+
+def bench_roster(args):
+    from query_func import get_appointment_by_doctor_for_specific_patient, get_doctor_roster
+    from roster import PatientRoster
+
+    connection = sqlite3.connect(database.DB_PATH)
+    doctor_id = connection.execute('''
+        SELECT DoctorID FROM DoctorRoster GROUP BY DoctorID ORDER BY COUNT(*) DESC LIMIT 1
+    ''').fetchone()[0]
+    milliseconds, entries = time_call(get_doctor_roster, doctor_id, repeat=args.repeat)
+    report("load the roster: get_doctor_roster", milliseconds, f"{len(entries)} patients")
+    milliseconds, roster = time_call(PatientRoster, entries, repeat=args.repeat)
+    report("build the in-memory PatientRoster", milliseconds)
+
+    # What every rerun of an add page costs: before, a query per rerun; now, a search and a dict lookup
+    rng = random.Random(43)
+    patients = [rng.choice(entries) for _ in range(1000)]
+    milliseconds, _ = time_call(lambda: [get_appointment_by_doctor_for_specific_patient(doctor_id, entry.patient_id)
+                                         for entry in patients], repeat=args.repeat)
+    report("1000 reruns: get_appointment_by_doctor_for_specific_patient", milliseconds)
+    for label, text in [("1000 reruns: roster search by full National ID", lambda entry: str(entry.patient_id)),
+                        ("1000 reruns: roster search by 3-letter name prefix", lambda entry: entry.patient_name[:3])]:
+        milliseconds, _ = time_call(lambda: [roster.search(text(entry)) for entry in patients], repeat=args.repeat)
+        report(label, milliseconds)
+
+    # Booking cost of keeping the roster up to date
+    patient_id = entries[0].patient_id
+    slot = database.appointment_slot(datetime.now() + timedelta(days=400))
+
+    def book(count=500):
+        connection.executemany('''
+            INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot) VALUES (?, ?, ?, ?, ?)
+        ''', [(patient_id, doctor_id, database.slot_to_text(slot + 30 * i), "bench-roster", slot + 30 * i)
+              for i in range(count)])
+        connection.rollback()
+
+    book()  # Warm the page cache, so the two cases below read the same pages
+    milliseconds, _ = time_call(book, repeat=args.repeat)
+    report("500 bookings with the roster triggers", milliseconds)
+    triggers = connection.execute("SELECT name, sql FROM sqlite_master WHERE name LIKE 'trg_roster_%'").fetchall()
+    for name, _ in triggers:
+        connection.execute(f'DROP TRIGGER {name}')
+    milliseconds, _ = time_call(book, repeat=args.repeat)
+    report("500 bookings without them", milliseconds)
+    for _, sql in triggers:
+        connection.execute(sql)
+    connection.commit()
+
+    # Deleting rows that are not roster entries does not rescan the pair's appointments
+    connection.executemany('''
+        INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot, Status)
+        VALUES (?, ?, ?, ?, ?, 'cancelled')
+    ''', [(patient_id, doctor_id, database.slot_to_text(slot + i), "bench-roster", slot + i) for i in range(20000)])
+    connection.commit()
+    started = time.perf_counter()
+    connection.execute("DELETE FROM Appointments WHERE Reason = 'bench-roster'")
+    connection.commit()
+    report("delete 20000 cancelled appointments of one patient", (time.perf_counter() - started) * 1000)
+    connection.close()
+
+
+def bench_visits(args):
+    import query_func
+    import storage
+
+    connection = sqlite3.connect(database.DB_PATH)
+    visits = connection.execute('''
+        SELECT PatientID, DoctorID, AppointmentID FROM Appointments WHERE Status = 'active' LIMIT 100
+    ''').fetchall()
+    medicine_ids = [row[0] for row in connection.execute('SELECT MedicineID FROM Medicines LIMIT 3')]
+    connection.close()
+    test_date = "2024-02-01 10:00:00"
+    result_data = json.dumps({"doctor_comment": "Visit", "CRP": 5.0, "B12": 300.0, "Mg": 2.0, "Fe": 80.0})
+    lab_results = [{"test_type_id": 4, "result_data": result_data, "test_date": test_date}] * 3
+    record = {"diagnosis": "Visit", "treatment": "Treatment", "notes": "Notes", "created_date": test_date}
+    medicines = [{"medicine_id": medicine_id, "dosage": "1x1", "instructions": "After meals"}
+                 for medicine_id in medicine_ids]
+
+    # A visit with 3 lab results, a medical record and a 3-medicine prescription
+    def separate():
+        for patient_id, doctor_id, appointment_id in visits:
+            for lab_result in lab_results:
+                query_func.add_lab_result(patient_id, doctor_id, lab_result["test_type_id"], lab_result["result_data"],
+                                          test_date, appointment_id)
+            query_func.add_medical_record(patient_id, doctor_id, record["diagnosis"], record["treatment"],
+                                          record["notes"], test_date, appointment_id)
+            query_func.add_prescription(patient_id, doctor_id, appointment_id, medicines, "2024-02-01")
+
+    def together():
+        for patient_id, doctor_id, appointment_id in visits:
+            query_func.add_visit(patient_id, doctor_id, appointment_id, lab_results, record,
+                                 {"medicines": medicines, "prescribed_date": "2024-02-01"}, complete=False)
+
+    # The commits are what a profile's durability settings make expensive, as in bench_profiles
+    previous_profile = storage.active_profile()
+    for profile in ("default", "interactive"):
+        connection = sqlite3.connect(database.DB_PATH)
+        connection.execute(f"PRAGMA journal_mode = {storage.PROFILES[profile].get('journal_mode', 'DELETE')}")
+        connection.close()
+        storage.set_profile(profile)
+        for label, function in [("5 separate add_ calls, 5 commits", separate),
+                                ("add_visit, 1 commit", together)]:
+            milliseconds, _ = time_call(function, repeat=args.repeat)
+            report(f"{profile}: {len(visits)} visits, {label}", milliseconds,
+                   f"{milliseconds / len(visits):.2f} ms/visit")
+    storage.set_profile(previous_profile)
+
+
+def _clinical_note(rng, sentences):
+    return " ".join(sentence.format(*(rng.randint(1, 180) for _ in range(sentence.count("{}"))))
+                    for sentence in rng.sample(NOTE_SENTENCES, min(sentences, len(NOTE_SENTENCES))))
+
+
+def _read_syscalls():
+    # Linux only: read() calls of this process, with mmap off every page cache miss of SQLite is one
+    try:
+        with open("/proc/self/io") as file:
+            return int(next(line for line in file if line.startswith("syscr:")).split()[1])
+    except OSError:
+        return None
+
+
+def bench_clinical_text(args):
+    import clinical_text
+    import storage
+    from query_func import get_medical_record_summaries_by_patient, get_medical_records_by_patient
+
+    connection = sqlite3.connect(database.DB_PATH)
+    rng = random.Random(45)
+    # Long-lived patients' notes, 4 to 20 sentences (0.3 to 1.5 KB) instead of the generator's one-liners
+    connection.executemany("UPDATE MedicalRecords SET Treatment = ?, Notes = ? WHERE RecordID = ?", [
+        (_clinical_note(rng, rng.randint(1, 3)), _clinical_note(rng, rng.randint(4, 20)), record_id)
+        for record_id, in connection.execute("SELECT RecordID FROM MedicalRecords").fetchall()
+    ])
+    connection.commit()
+    # The patients with the longest history
+    patient_ids = [row[0] for row in connection.execute(
+        "SELECT PatientID FROM MedicalRecords GROUP BY PatientID ORDER BY COUNT(*) DESC LIMIT 300")]
+    # Patients opened over a day, for the page cache
+    day_patient_ids = [row[0] for row in connection.execute(
+        "SELECT PatientID FROM (SELECT DISTINCT PatientID FROM MedicalRecords) ORDER BY random() LIMIT 3000")]
+    connection.close()
+
+    def read_full():
+        for patient_id in patient_ids:
+            get_medical_records_by_patient(patient_id)
+
+    def read_list():
+        for patient_id in patient_ids:
+            get_medical_record_summaries_by_patient(patient_id)
+
+    def page_cache(cache_kib):
+        # Page reads from the file for the full records of a day's patients
+        connection = sqlite3.connect(database.DB_PATH)
+        connection.execute("PRAGMA mmap_size = 0")
+        connection.execute(f"PRAGMA cache_size = -{cache_kib}")
+        passes = []
+        for _ in range(2):  # The second pass is the steady state
+            started = _read_syscalls()
+            for patient_id in day_patient_ids:
+                rows = connection.execute("SELECT RecordID, Treatment, Notes FROM MedicalRecords WHERE PatientID = ?",
+                                          (patient_id,)).fetchall()
+                [clinical_text.decode(value, connection) for row in rows for value in row[1:]]
+            passes.append(_read_syscalls() - started)
+        connection.close()
+        return passes[-1]
+
+    def measure(state):
+        connection = sqlite3.connect(database.DB_PATH)
+        connection.execute("VACUUM")
+        try:
+            table_size = connection.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'MedicalRecords'").fetchone()[0]
+            print(f"{state + ': MedicalRecords table':<60} {table_size / 1024 / 1024:>10.2f} MB")
+        except sqlite3.OperationalError:
+            pass  # SQLite built without the dbstat virtual table
+        connection.close()
+        print(f"{state + ': database file':<60} {os.path.getsize(database.DB_PATH) / 1024 / 1024:>10.2f} MB")
+        for label, function in [("full records (get_medical_records_by_patient)", read_full),
+                                ("list view (get_medical_record_summaries_by_patient)", read_list)]:
+            milliseconds, _ = time_call(function, repeat=args.repeat)
+            report(f"{state}: {len(patient_ids)} patients, {label}", milliseconds)
+        if _read_syscalls() is not None:
+            # Hit rate of the interactive profile's cache, against the page requests counted as the reads with a
+            # cache too small to hit
+            cache_kib = -storage.PROFILES["interactive"]["cache_size"]
+            requests = page_cache(40)
+            misses = page_cache(cache_kib)
+            print(f"{state}: {len(day_patient_ids)} patients, {cache_kib // 1024} MB page cache: "
+                  f"{misses} of {requests} page requests missed, hit rate {1 - misses / requests:.1%}")
+
+    sizes = clinical_text.column_sizes(database.DB_PATH)
+    print(f"Treatment + Notes: {sum(count for count, _ in sizes.values())} values, "
+          f"{sum(size for _, size in sizes.values()) / 1024 / 1024:.2f} MB of text")
+    measure("plain")
+
+    started = time.perf_counter()
+    content = clinical_text.train_dictionary(clinical_text.sample_texts())
+    clinical_text.store_dictionary(content)
+    report(f"train a {len(content)} byte dictionary on 20000 records", (time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    rewritten = clinical_text.rewrite_shard(database.DB_PATH)
+    report(f"compress in place, {rewritten} records", (time.perf_counter() - started) * 1000)
+    sizes = clinical_text.column_sizes(database.DB_PATH)
+    print(f"Treatment + Notes: {sum(size for _, size in sizes.values()) / 1024 / 1024:.2f} MB stored, "
+          f"{sum(count for (_, kind), (count, _) in sizes.items() if kind == 'text')} values left plain (short)")
+    measure("compressed")
+
+
+def _traced(function):
+    """
+    Calls function and returns (result, bytes still allocated by it, peak bytes allocated during the call).
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, retained, peak
+
+
+def bench_rows(args):
+    from dataclasses import dataclass
+    from models import PatientAppointment, row_factory
+    from query_func import (create_connection, get_appointments_by_patient, get_lab_result_values_by_patient,
+                            get_prescriptions_by_patient)
+
+    @dataclass(slots=True)
+    class SlottedAppointment:
+        appointment_id: int
+        doctor_id: int
+        appointment_date: str
+        reason: str
+        appointment_slot: int
+        status: str
+
+    rng = random.Random(41)
+    connection = sqlite3.connect(database.DB_PATH)
+    for history in (1000, 10000, 50000):
+        patient_id = 91000000000 + history
+        slots = [database.appointment_slot(datetime(2020, 1, 1)) + 30 * i for i in range(history)]
+        connection.executemany('''
+            INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot) VALUES (?, ?, ?, ?, ?)
+        ''', [(patient_id, rng.randrange(1, args.doctors + 1), database.slot_to_text(slot), "checkup", slot) for slot in slots])
+        connection.executemany('''
+            INSERT INTO LabResults (PatientID, DoctorID, TestTypeID, ResultData, TestDate, AppointmentID)
+            VALUES (?, 1, 4, ?, ?, 1)
+        ''', [(patient_id, json.dumps({"doctor_comment": rng.choice(COMMENTS), "CRP": rng.uniform(0, 100),
+                                       "B12": rng.uniform(100, 900), "Mg": rng.uniform(1, 3), "Fe": rng.uniform(20, 200)}),
+               database.slot_to_text(slot)) for slot in slots])
+        connection.executemany('INSERT INTO Prescriptions (PatientID, DoctorID, AppointmentID, PrescribedDate) VALUES (?, 1, 1, ?)',
+                               [(patient_id, database.slot_to_text(slot)[:10]) for slot in slots])
+        connection.commit()
+
+        def select_all(sql):
+            def query():
+                query_connection = create_connection(patient_id)
+                rows = query_connection.execute(sql, (patient_id,)).fetchall()
+                query_connection.close()
+                return rows
+            return query
+
+        print(f"-- history of {history} rows per table")
+        for label, function in [
+            ("appointments: SELECT * tuples", select_all(
+                'SELECT * FROM Appointments WHERE PatientID = ? ORDER BY AppointmentSlot')),
+            ("appointments: list projection, models", lambda: get_appointments_by_patient(patient_id)),
+            ("lab results: SELECT * tuples", select_all('SELECT * FROM LabResults WHERE PatientID = ?')),
+            ("lab results: values projection, models", lambda: get_lab_result_values_by_patient(patient_id)[1]),
+            ("prescriptions: SELECT * tuples", select_all('SELECT * FROM Prescriptions WHERE PatientID = ?')),
+            ("prescriptions: list projection, models", lambda: get_prescriptions_by_patient(patient_id)),
+        ]:
+            gc.collect()
+            milliseconds, _ = time_call(function, repeat=args.repeat)
+            rows, retained, peak = _traced(function)
+            report(label, milliseconds, f"{retained / len(rows):.0f} B/row held, peak {peak / 1024 / 1024:.1f} MB")
+
+    # Row factories for the same projection, on the largest history
+    sql = ('SELECT AppointmentID, DoctorID, AppointmentDate, Reason, AppointmentSlot, Status FROM Appointments '
+           'WHERE PatientID = ? ORDER BY AppointmentSlot')
+
+    def fetch(factory=None, convert=None):
+        def query():
+            cursor = connection.cursor()
+            cursor.row_factory = factory
+            rows = cursor.execute(sql, (patient_id,)).fetchall()
+            return list(map(convert, rows)) if convert else rows
+        return query
+
+    print(f"-- row factories, {history} appointments")
+    for label, function in [
+        ("plain tuples", fetch()),
+        ("models.row_factory (tuple.__new__)", fetch(row_factory(PatientAppointment))),
+        ("NamedTuple._make per row", fetch(lambda cursor, row: PatientAppointment._make(row))),
+        ("sqlite3.Row", fetch(sqlite3.Row)),
+        ("slots dataclass", fetch(convert=lambda row: SlottedAppointment(*row))),
+    ]:
+        gc.collect()  # Garbage of the previous case is not charged to this one
+        milliseconds, _ = time_call(function, repeat=args.repeat)
+        rows, retained, _ = _traced(function)
+        report(label, milliseconds, f"{retained / len(rows):.0f} B/row held")
+    connection.close()
+
+
+BENCHMARKS = {
+    "cohort": bench_cohort,
+    "lab-fields": bench_lab_fields,
+    "slots": bench_slots,
+    "first-available": bench_first_available,
+    "refresh": bench_refresh,
+    "data-service": bench_data_service,
+    "async-sections": bench_async_sections,
+    "backup": bench_backup,
+    "profiles": bench_profiles,
+    "medicines": bench_medicines,
+    "interactions": bench_interactions,
+    "reminders": bench_reminders,
+    "cancellations": bench_cancellations,
+    "roster": bench_roster,
+    "visits": bench_visits,
+    "clinical-text": bench_clinical_text,
+    "rows": bench_rows,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--doctors", type=int, default=100)
+    parser.add_argument("--appointments", type=int, default=100000)
+    parser.add_argument("--lab-results", type=int, default=100000)
+    parser.add_argument("--medical-records", type=int, default=20000)
+    parser.add_argument("--prescriptions", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", help="Write the generated database to this path and keep it")
+    parser.add_argument("--reuse", help="Run against an already generated database")
+    args = parser.parse_args()
+
+    if args.reuse:
+        database.DB_PATH = args.reuse
+        database.migrate()
+        BENCHMARKS[args.benchmark](args)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.keep or os.path.join(directory, "benchmark.db")
+        started = time.perf_counter()
+        generate_database(path, args.patients, args.doctors, args.appointments, args.lab_results,
+                          args.medical_records, args.prescriptions)
+        print(f"Generated {path} in {time.perf_counter() - started:.1f} s")
+        BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
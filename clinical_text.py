@@ -0,0 +1,303 @@
+"""
+Compressed storage of the long clinical text of medical records, MedicalRecords.Treatment and MedicalRecords.Notes.
+
+A value is stored either as plain TEXT, as it always was, or as a BLOB:
+    1 byte   format, FORMAT_DEFLATE_DICTIONARY
+    4 bytes  DictionaryID, big-endian
+    rest     raw deflate stream of the UTF-8 text, compressed with the dictionary as preset (zlib zdict)
+so old and new rows mix in one column and typeof() tells them apart. The dictionary is trained on the stored texts
+(train_dictionary): notes are short and mostly repeat the phrasing of other notes, which deflate alone cannot exploit.
+Dictionaries are reference data in TextDictionaries (see database.create_text_dictionaries), written to every shard.
+Their ID is derived from the content, so a dictionary cached by ID is never stale.
+
+Compression is optional: new values are compressed while a dictionary is active, reads decode whatever they find.
+
+    python clinical_text.py train [--sample 20000] [--size 32768]   (trains a dictionary and activates it)
+    python clinical_text.py compress [--batch 2000] [--vacuum]       (rewrites the existing plain values in place)
+    python clinical_text.py decompress [--vacuum]                    (deactivates it and rewrites back to TEXT)
+    python clinical_text.py status
+
+LabResults.ResultData stays plain JSON text: the analyte columns are generated with json_extract over it and indexed
+for the cohort queries (database.add_analyte_columns), and the lab result list reads doctor_comment with json_extract.
+"""
+import argparse
+import hashlib
+import re
+import sqlite3
+import struct
+import zlib
+from collections import Counter
+
+import database
+import shard_router
+
+FORMAT_DEFLATE_DICTIONARY = 1
+_HEADER = struct.Struct('>BI')
+DICTIONARY_SIZE = 32 * 1024  # The deflate window, a longer dictionary is never referenced
+MIN_LENGTH = 48  # Shorter texts are stored plain, the header and deflate's end block eat the saving
+COLUMNS = ('Treatment', 'Notes')
+BATCH_SIZE = 2000
+
+# Compressors with the dictionary already loaded, per DictionaryID: copy() takes half the time of loading a 32 KB
+# dictionary for every value. A decompressor loads it as fast as it copies, decoding only keeps the content.
+_compressors = {}
+_dictionaries = {}
+
+_SENTENCE = re.compile(r'[^.!?;\n]+[.!?;]?')
+_WORD = re.compile(r'\w{4,}')
+
+
+def dictionary_id(content):
+    return int.from_bytes(hashlib.sha256(content).digest()[:4], 'big')
+
+
+def train_dictionary(texts, size=DICTIONARY_SIZE):
+    """
+    Builds a preset dictionary from sample texts: the sentences and words found in the most texts, weighted by their
+    length, the most useful last where deflate reaches them with the shortest distances.
+
+    Returns:
+        bytes: At most size bytes, empty when the texts share nothing.
+    """
+    counts = Counter()
+    for text in texts:
+        if text:
+            pieces = {sentence.strip() for sentence in _SENTENCE.findall(text)} | set(_WORD.findall(text))
+            counts.update(piece for piece in pieces if piece)
+    scored = sorted((count * len(piece.encode()), piece) for piece, count in counts.items() if count > 1)
+    chosen = []
+    total = 0
+    for _, piece in reversed(scored):
+        piece = piece.encode() + b' '
+        if total + len(piece) > size:
+            continue
+        chosen.append(piece)
+        total += len(piece)
+    return b''.join(reversed(chosen))
+
+
+def _dictionary(identifier, connection):
+    row = connection.execute('SELECT Content FROM TextDictionaries WHERE DictionaryID = ?', (identifier,)).fetchone()
+    if row is None:
+        raise ValueError(f'Text dictionary {identifier} is missing, the value cannot be decoded')
+    return row[0]
+
+
+def active_dictionary_id(connection):
+    """
+    The DictionaryID new values are compressed with, None when compression is off.
+    """
+    row = connection.execute('SELECT DictionaryID FROM TextDictionaries WHERE Active = 1').fetchone()
+    return row and row[0]
+
+
+def encoder(connection):
+    """
+    Returns the function turning a text into the value to store on this connection's database: a compressed BLOB
+    with the active dictionary, or the text itself when compression is off, the text is short or would not shrink.
+    """
+    identifier = active_dictionary_id(connection)
+    if identifier is None:
+        return lambda text: text
+    if identifier not in _compressors:
+        _compressors[identifier] = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY,
+                                                    _dictionary(identifier, connection))
+    prototype = _compressors[identifier]
+    header = _HEADER.pack(FORMAT_DEFLATE_DICTIONARY, identifier)
+
+    def encode(text):
+        if text is None or len(text) < MIN_LENGTH:
+            return text
+        data = text.encode()
+        compressor = prototype.copy()
+        compressed = header + compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else text
+
+    return encode
+
+
+def decode(value, connection):
+    """
+    The text of a stored value, plain or compressed. connection is used to load a dictionary not seen yet.
+    """
+    if not isinstance(value, bytes):
+        return value
+    format_, identifier = _HEADER.unpack_from(value)
+    if format_ != FORMAT_DEFLATE_DICTIONARY:
+        raise ValueError(f'Unknown clinical text format {format_}')
+    if identifier not in _dictionaries:
+        _dictionaries[identifier] = _dictionary(identifier, connection)
+    decompressor = zlib.decompressobj(-15, _dictionaries[identifier])
+    return (decompressor.decompress(value[_HEADER.size:]) + decompressor.flush()).decode()
+
+
+def decode_records(connection, records):
+    """
+    models.MedicalRecord rows with their treatment and notes decoded, rows without compressed values are kept as is.
+    """
+    return [
+        record._replace(treatment=decode(record.treatment, connection), notes=decode(record.notes, connection))
+        if isinstance(record.treatment, bytes) or isinstance(record.notes, bytes) else record
+        for record in records
+    ]
+
+
+# ** Migration tool **
+
+def store_dictionary(content):
+    """
+    Writes the dictionary to every shard and makes it the active one.
+
+    Returns:
+        int: Its DictionaryID.
+    """
+    identifier = dictionary_id(content)
+
+    def store(path):
+        connection = database.create_connection(path)
+        connection.execute('INSERT OR IGNORE INTO TextDictionaries (DictionaryID, Content) VALUES (?, ?)',
+                           (identifier, content))
+        connection.execute('UPDATE TextDictionaries SET Active = (DictionaryID = ?)', (identifier,))
+        connection.commit()
+        connection.close()
+
+    shard_router.fan_out(store)
+    return identifier
+
+
+def deactivate():
+    """
+    Turns compression off on every shard, the dictionaries stay for decoding.
+    """
+    def update(path):
+        connection = database.create_connection(path)
+        connection.execute('UPDATE TextDictionaries SET Active = 0')
+        connection.commit()
+        connection.close()
+
+    shard_router.fan_out(update)
+
+
+def sample_texts(sample=20000):
+    """
+    The Treatment and Notes texts of about sample records picked at random, spread over the shards.
+    """
+    def read(path):
+        connection = database.create_connection(path)
+        rows = connection.execute('SELECT Treatment, Notes FROM MedicalRecords ORDER BY random() LIMIT ?',
+                                  (sample // len(shard_router.shard_paths()) + 1,)).fetchall()
+        texts = [decode(value, connection) for row in rows for value in row]
+        connection.close()
+        return texts
+
+    return [text for texts in shard_router.fan_out(read) for text in texts if text]
+
+
+def rewrite_shard(path, compress=True, batch_size=BATCH_SIZE):
+    """
+    Rewrites the Treatment and Notes values of one shard in place, compressed with the active dictionary or back to
+    plain TEXT, in short transactions the application can write between. The content does not change, so the
+    rewrite is kept out of the ChangeLog: its update trigger is dropped and recreated inside each transaction.
+
+    Returns:
+        int: The number of records rewritten.
+    """
+    connection = database.create_connection(path)
+    if compress and active_dictionary_id(connection) is None:
+        connection.close()
+        raise ValueError(f'{path}: no active text dictionary, run train first')
+    encode = encoder(connection) if compress else (lambda text: text)
+    trigger = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                                 ('trg_changelog_medicalrecords_update',)).fetchone()
+    last_id = None
+    rewritten = 0
+    try:
+        while True:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute('''
+                SELECT RecordID, Treatment, Notes FROM MedicalRecords WHERE RecordID > ? ORDER BY RecordID LIMIT ?
+            ''', (-1 if last_id is None else last_id, batch_size)).fetchall()
+            if not rows:
+                connection.rollback()
+                return rewritten
+            last_id = rows[-1][0]
+            updates = []
+            for record_id, *values in rows:
+                new_values = [encode(decode(value, connection)) for value in values]
+                if new_values != values:
+                    updates.append((*new_values, record_id))
+            if updates:
+                if trigger:
+                    connection.execute('DROP TRIGGER trg_changelog_medicalrecords_update')
+                connection.executemany('UPDATE MedicalRecords SET Treatment = ?, Notes = ? WHERE RecordID = ?',
+                                       updates)
+                if trigger:
+                    connection.execute(trigger[0])
+            connection.commit()
+            rewritten += len(updates)
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def column_sizes(path):
+    """
+    Returns {(column, 'text' or 'blob'): (values, bytes)} of the Treatment and Notes values of one shard.
+    """
+    connection = database.create_connection(path)
+    sizes = {}
+    for column in COLUMNS:
+        for kind, count, size in connection.execute(f'''
+            SELECT typeof({column}), COUNT(*), SUM(length(CAST({column} AS BLOB))) FROM MedicalRecords
+            WHERE {column} IS NOT NULL GROUP BY typeof({column})
+        '''):
+            sizes[column, kind] = (count, size)
+    connection.close()
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    train_parser = commands.add_parser('train')
+    train_parser.add_argument('--sample', type=int, default=20000, help='Texts to train on')
+    train_parser.add_argument('--size', type=int, default=DICTIONARY_SIZE, help='Dictionary size in bytes')
+    for name in ('compress', 'decompress'):
+        rewrite_parser = commands.add_parser(name)
+        rewrite_parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='Records per transaction')
+        rewrite_parser.add_argument('--vacuum', action='store_true', help='VACUUM afterwards to shrink the files')
+    commands.add_parser('status')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        texts = sample_texts(args.sample)
+        content = train_dictionary(texts, args.size)
+        if not content:
+            parser.exit(1, 'The sampled texts share nothing to build a dictionary from\n')
+        print(f'Trained a {len(content)} byte dictionary on {len(texts)} texts, DictionaryID {store_dictionary(content)}')
+    elif args.command in ('compress', 'decompress'):
+        if args.command == 'decompress':
+            deactivate()
+        for path in shard_router.shard_paths():
+            try:
+                print(f'{path}: {rewrite_shard(path, args.command == "compress", args.batch)} records rewritten')
+            except ValueError as error:
+                parser.exit(1, f'{error}\n')
+            if args.vacuum:
+                connection = sqlite3.connect(path)
+                connection.execute('VACUUM')
+                connection.close()
+    elif args.command == 'status':
+        for path in shard_router.shard_paths():
+            connection = database.create_connection(path)
+            active = active_dictionary_id(connection)
+            connection.close()
+            print(f'{path}: compression {"off" if active is None else f"on, DictionaryID {active}"}')
+            for (column, kind), (count, size) in sorted(column_sizes(path).items()):
+                print(f'  {column} {"compressed" if kind == "blob" else "plain"}: {count} values, {size} bytes')
+
+
+if __name__ == '__main__':
+    main()
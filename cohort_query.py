@@ -0,0 +1,239 @@
+import heapq
+import re
+from datetime import datetime, timedelta
+from itertools import islice
+
+import shard_router
+from database import all_analytes, analyte_column
+from query_func import create_shard_connection
+
+# Comparison operators allowed in cohort filters, mapped to their SQL form
+OPERATORS = {
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">=",
+    "=": "=",
+    "!=": "!=",
+}
+
+_ANALYTE_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+_CONDITION_PATTERN = re.compile(
+    r"^\s*([A-Za-z][A-Za-z0-9_]*)\s+(?:(change)\s+)?(<=|>=|!=|<|>|=)\s*(-?\d+(?:\.\d+)?)\s*%?\s*$",
+    re.IGNORECASE,
+)
+
+
+def parse_filter(text):
+    """
+    Parses a cohort filter written one condition per line.
+
+    Supported conditions:
+        Fe < 10            the analyte value of a single lab result compared to a threshold
+        CRP change > 50    percent change of the analyte between the patient's last two tests
+
+    Parameters:
+        text (str): The filter text typed by the doctor.
+
+    Returns:
+        tuple: (value_conditions, change_conditions), both lists of (analyte, operator, threshold).
+    """
+    value_conditions = []
+    change_conditions = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        match = _CONDITION_PATTERN.match(line)
+        if not match:
+            raise ValueError(f"Line {line_number}: could not understand '{line.strip()}'")
+        analyte, change, operator, threshold = match.groups()
+        condition = (analyte, operator, float(threshold))
+        if change:
+            change_conditions.append(condition)
+        else:
+            value_conditions.append(condition)
+    return value_conditions, change_conditions
+
+
+def _analyte_expression(analyte):
+    # Known analytes have an indexed generated column (see database.add_analyte_columns).
+    # Other keys fall back to json_extract with the path inlined, which is why names are restricted to identifiers.
+    if analyte in all_analytes():
+        return f"lr.{analyte_column(analyte)}"
+    if not _ANALYTE_PATTERN.match(analyte):
+        raise ValueError(f"Invalid analyte name: {analyte}")
+    return f"json_extract(lr.ResultData, '$.{analyte}')"
+
+
+def _compile_scope(doctor_id, test_type_id, since, until):
+    clauses = []
+    params = []
+    if doctor_id is not None:
+        clauses.append("lr.DoctorID = ?")
+        params.append(doctor_id)
+    if test_type_id is not None:
+        clauses.append("lr.TestTypeID = ?")
+        params.append(test_type_id)
+    if since is not None:
+        clauses.append("lr.TestDate >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("lr.TestDate < ?")
+        params.append(until)
+    return clauses, params
+
+
+def _compile_conditions(conditions):
+    clauses = []
+    params = []
+    for analyte, operator, threshold in conditions:
+        if operator not in OPERATORS:
+            raise ValueError(f"Invalid operator: {operator}")
+        clauses.append(f"{_analyte_expression(analyte)} {OPERATORS[operator]} ?")
+        params.append(threshold)
+    return clauses, params
+
+
+def compile_cohort_query(value_conditions=(), doctor_id=None, test_type_id=None, since=None, until=None):
+    """
+    Compiles the SQL-expressible part of a cohort filter into a query returning matching patient IDs.
+    A patient matches when at least one lab result in scope satisfies every value condition.
+    The IDs are not de-duplicated: DISTINCT makes SQLite walk the PatientID index instead of the analyte index.
+
+    Returns:
+        tuple: (sql, params)
+    """
+    scope_clauses, scope_params = _compile_scope(doctor_id, test_type_id, since, until)
+    condition_clauses, condition_params = _compile_conditions(value_conditions)
+    clauses = scope_clauses + condition_clauses
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT lr.PatientID FROM LabResults lr {where}"
+    return sql, scope_params + condition_params
+
+
+def _compare(series, operator, threshold):
+    if operator == "<":
+        return series < threshold
+    if operator == "<=":
+        return series <= threshold
+    if operator == ">":
+        return series > threshold
+    if operator == ">=":
+        return series >= threshold
+    if operator == "=":
+        return series == threshold
+    if operator == "!=":
+        return series != threshold
+    raise ValueError(f"Invalid operator: {operator}")
+
+
+def _patients_matching_changes(cursor, change_conditions, doctor_id, test_type_id, since, until, candidate_query=None):
+    """
+    Evaluates window-style conditions (percent change between the last two tests of an analyte) with pandas.
+    Only the (patient, date, value) triples of the analyte are loaded, never the whole ResultData.
+    candidate_query is an optional (sql, params) restricting the patients, e.g. the compiled value conditions.
+    """
+    import pandas as pd
+
+    matching = None
+    for analyte, operator, threshold in change_conditions:
+        scope_clauses, scope_params = _compile_scope(doctor_id, test_type_id, since, until)
+        expression = _analyte_expression(analyte)
+        clauses = scope_clauses + [f"{expression} IS NOT NULL"]
+        if candidate_query is not None:
+            clauses.append(f"lr.PatientID IN ({candidate_query[0]})")
+            scope_params = scope_params + candidate_query[1]
+        cursor.execute(f'''
+            SELECT lr.PatientID, lr.TestDate, {expression}
+            FROM LabResults lr
+            WHERE {' AND '.join(clauses)}
+        ''', scope_params)
+        frame = pd.DataFrame(cursor.fetchall(), columns=["PatientID", "TestDate", "Value"])
+        if matching is not None:
+            frame = frame[frame["PatientID"].isin(matching)]
+        if frame.empty:
+            return set()
+
+        frame = frame.sort_values(["PatientID", "TestDate"])
+        last_two = frame.groupby("PatientID", sort=False).tail(2)
+        grouped = last_two.groupby("PatientID", sort=False)["Value"]
+        previous = grouped.first()
+        latest = grouped.last()
+        counts = grouped.size()
+        valid = (counts == 2) & (previous != 0)
+        change = (latest[valid] - previous[valid]) / previous[valid].abs() * 100
+        patients = set(change[_compare(change, operator, threshold)].index)
+        matching = patients if matching is None else matching & patients
+        if not matching:
+            return set()
+    return matching
+
+
+def find_cohort(value_conditions=(), change_conditions=(), doctor_id=None, test_type_id=None,
+                since=None, until=None, page=1, page_size=20):
+    """
+    Finds the patients whose lab results match a cohort filter. Use it in doctor's patient cohorts page.
+
+    Parameters:
+        value_conditions (list): (analyte, operator, threshold) tuples, see parse_filter.
+        change_conditions (list): (analyte, operator, percent) tuples, see parse_filter.
+        doctor_id (int): Only consider lab results ordered by this doctor. None for all doctors.
+        test_type_id (int): Only consider lab results of this test type. None for all test types.
+        since (str): Only consider lab results on or after this date. Format: 'YYYY-MM-DD'
+        until (str): Only consider lab results before this date. Format: 'YYYY-MM-DD'
+        page (int): 1-based page number.
+        page_size (int): Number of patients per page.
+
+    Returns:
+        tuple: (list of (NationalID, PatientName) tuples for the requested page, total number of matching patients)
+    """
+    offset = (max(page, 1) - 1) * page_size
+    sql, params = compile_cohort_query(value_conditions, doctor_id, test_type_id, since, until)
+
+    # Patients are disjoint across shards: each shard returns its count and its first offset + page_size patients,
+    # the sorted lists are merged and the page is cut from the merged list.
+    def query(path):
+        connection = create_shard_connection(path)
+        cursor = connection.cursor()
+        if not change_conditions:
+            cursor.execute(f'SELECT COUNT(DISTINCT PatientID) FROM ({sql})', params)
+            total = cursor.fetchone()[0]
+            cursor.execute(f'''
+                SELECT p.NationalID, p.FirstName || ' ' || p.LastName AS PatientName
+                FROM Patients p
+                WHERE p.NationalID IN ({sql})
+                ORDER BY p.NationalID
+                LIMIT ?
+            ''', params + [offset + page_size])
+            results = cursor.fetchall()
+            connection.close()
+            return results, total
+
+        candidate_query = (sql, params) if value_conditions else None
+        matching = sorted(_patients_matching_changes(
+            cursor, change_conditions, doctor_id, test_type_id, since, until, candidate_query
+        ))
+        page_ids = matching[:offset + page_size]
+        results = []
+        if page_ids:
+            placeholders = ", ".join("?" for _ in page_ids)
+            cursor.execute(f'''
+                SELECT p.NationalID, p.FirstName || ' ' || p.LastName AS PatientName
+                FROM Patients p
+                WHERE p.NationalID IN ({placeholders})
+                ORDER BY p.NationalID
+            ''', [int(patient_id) for patient_id in page_ids])
+            results = cursor.fetchall()
+        connection.close()
+        return results, len(matching)
+
+    shard_results = shard_router.fan_out(query)
+    merged = heapq.merge(*(results for results, _ in shard_results))
+    total = sum(shard_total for _, shard_total in shard_results)
+    return list(islice(merged, offset, offset + page_size)), total
+
+def days_ago(days):
+    """
+    Returns the date N days before today in the 'YYYY-MM-DD' format used by the since/until arguments.
+    """
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
@@ -0,0 +1,453 @@
+"""
+Local data service: one process owning the SQLite connections, shared by every Streamlit worker on the machine.
+
+Streamlit runs each page in its own process (or several when behind a load balancer), and every query function opens
+and closes a connection per call. The service keeps one writer connection, a pool of reader connections and a
+result cache shared by all of them, and the frontends call it over a Unix socket.
+
+Start it next to the application:
+    python data_service.py --socket /tmp/health_monitoring.sock --readers 4
+
+and start Streamlit with HEALTH_MONITORING_DATA_SERVICE=/tmp/health_monitoring.sock. query_func then replaces its
+public functions with stubs calling the service (see install_client), so the pages do not change. The service brings
+every shard up to the current schema when it starts (database.create_tables and migrate), main.py skips it then.
+
+What still opens the database files in the calling process, so it needs the shard configuration
+(HEALTH_MONITORING_SHARDS) and runs on the machine holding the files:
+    - the query_func functions in LOCAL_FUNCTIONS (connection handling and lab_result_value_fields)
+    - cohort_query.parse_filter and days_ago, which only parse input (find_cohort is served through query_func)
+    - the operations tools: database.py, shard_router.py (reshard), backup.py, reminders.py, clinical_text.py,
+      benchmark.py and load_simulator.py
+
+Protocol: every message is a frame of a 4-byte big-endian payload length, a 1-byte format marker and the payload.
+The payload is msgpack when the msgpack package is installed (marker b'M'), JSON otherwise (marker b'J').
+    request:  [function name, args, kwargs]
+    response: [true, result, result is a list] or [false, exception type name, message]
+Row models (see models) travel as their model name and values and are rebuilt as the same model on the other side.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from functools import wraps
+
+from models import MODELS
+
+try:
+    import msgpack
+except ImportError:  # Optional, JSON is used without it
+    msgpack = None
+
+SOCKET_ENV = 'HEALTH_MONITORING_DATA_SERVICE'
+
+# Functions that change data: run on the single writer connection and clear the cache
+WRITE_PREFIXES = ('add_', 'cancel_')
+# query_func functions that always run in the calling process
+LOCAL_FUNCTIONS = {
+    'create_connection', 'create_shard_connection', 'use_persistent_connections', 'close_persistent_connections',
+    'lab_result_value_fields',
+}
+# Read functions whose result is not only a function of the database, never cached
+UNCACHED_FUNCTIONS = {'find_earliest_available_slots'}
+
+_HEADER = struct.Struct('>IB')
+_MSGPACK = ord('M')
+_JSON = ord('J')
+_DATETIME_EXT = 1
+_DATE_EXT = 2
+_ROW_EXT = 3
+
+
+class DataServiceError(Exception):
+    """
+    The service could not be reached, or raised an exception the client has no local type for.
+    """
+
+
+# ** Encoding **
+
+def _msgpack_default(value):
+    # Packed with strict_types, so tuples (rows) and their subclasses (row models) come here
+    if isinstance(value, tuple):
+        if type(value).__name__ in MODELS:
+            return msgpack.ExtType(_ROW_EXT, _pack([type(value).__name__, *value]))
+        return list(value)
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_DATETIME_EXT, value.isoformat().encode())
+    if isinstance(value, date):
+        return msgpack.ExtType(_DATE_EXT, value.isoformat().encode())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    raise TypeError(f'Cannot encode {type(value).__name__}')
+
+
+def _pack(value):
+    return msgpack.packb(value, default=_msgpack_default, use_bin_type=True, strict_types=True)
+
+
+def _row(name, values):
+    model = MODELS.get(name)
+    return model._make(values) if model is not None else tuple(values)  # A model this side does not know
+
+
+def _msgpack_ext_hook(code, data):
+    if code == _ROW_EXT:
+        name, *values = _unpack(data)
+        return _row(name, values)
+    if code == _DATETIME_EXT:
+        return datetime.fromisoformat(data.decode())
+    if code == _DATE_EXT:
+        return date.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+def _unpack(payload):
+    return msgpack.unpackb(payload, ext_hook=_msgpack_ext_hook, use_list=False, raw=False, strict_map_key=False)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Cannot encode {type(value).__name__}')
+
+
+def _json_rows(value):
+    # json encodes tuple subclasses as plain arrays without calling default, so row models are tagged beforehand
+    if isinstance(value, tuple) and type(value).__name__ in MODELS:
+        return {'__row__': type(value).__name__, 'values': [_json_rows(item) for item in value]}
+    if isinstance(value, (list, tuple)):
+        return [_json_rows(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _json_rows(item) for key, item in value.items()}
+    return value
+
+
+def _json_object_hook(value):
+    if '__row__' in value:
+        return _row(value['__row__'], _tuples(value['values']))
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    if '__date__' in value:
+        return date.fromisoformat(value['__date__'])
+    return value
+
+
+def _tuples(value):
+    # JSON counterpart of msgpack's use_list=False: rows come back as tuples, like from sqlite3
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _tuples(item) for key, item in value.items()}
+    return value
+
+
+def encode(value):
+    if msgpack is not None:
+        return _MSGPACK, _pack(value)
+    return _JSON, json.dumps(_json_rows(value), default=_json_default, separators=(',', ':')).encode()
+
+
+def decode(marker, payload):
+    """
+    Decodes a payload. Arrays are returned as tuples.
+    """
+    if marker == _MSGPACK:
+        if msgpack is None:
+            raise DataServiceError('The peer sent msgpack but the msgpack package is not installed')
+        return _unpack(payload)
+    if marker == _JSON:
+        return _tuples(json.loads(payload, object_hook=_json_object_hook))
+    raise DataServiceError(f'Unknown payload format {marker!r}')
+
+
+def _receive_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        buffer += chunk
+    return bytes(buffer)
+
+
+def send_frame(sock, marker, payload):
+    sock.sendall(_HEADER.pack(len(payload), marker) + payload)
+
+
+def receive_frame(sock):
+    """
+    Returns (marker, payload) of the next frame.
+    """
+    length, marker = _HEADER.unpack(_receive_exactly(sock, _HEADER.size))
+    return marker, _receive_exactly(sock, length)
+
+
+# ** Server **
+
+class ResultCache:
+    """
+    LRU cache of read results shared by every client. Cleared on every write through the service, and entries expire
+    after ttl seconds to bound how stale a result can be when something else writes to the database files.
+    """
+    def __init__(self, max_entries=2048, ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return  # A write finished while the value was being read
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+class DataService:
+    """
+    Runs query_func functions on a pool of reader threads and a single writer thread, each thread keeping its own
+    connections open (query_func.use_persistent_connections).
+    """
+    def __init__(self, readers=4, cache_entries=2048, cache_ttl=5.0):
+        import query_func
+
+        self.query_func = query_func
+        self.functions = exposed_functions(vars(query_func))
+        self.cache = ResultCache(cache_entries, cache_ttl)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='reader',
+                                           initializer=query_func.use_persistent_connections)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer',
+                                          initializer=query_func.use_persistent_connections)
+
+    def _run(self, function, args, kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            # Do not leave a half-done transaction on a connection the next request reuses
+            self.query_func.close_persistent_connections()
+            self.query_func.use_persistent_connections()
+            raise
+
+    def call(self, name, args, kwargs, cache_key=None):
+        function = self.functions.get(name)
+        if function is None:
+            raise AttributeError(f'Unknown function {name}')
+        if name.startswith(WRITE_PREFIXES):
+            try:
+                return self._writer.submit(self._run, function, args, kwargs).result()
+            finally:
+                self.cache.clear()
+
+        cacheable = cache_key is not None and name not in UNCACHED_FUNCTIONS
+        if cacheable:
+            entry = self.cache.get(cache_key)
+            if entry is not None:
+                return entry[1]
+        generation = self.cache.generation
+        result = self._readers.submit(self._run, function, args, kwargs).result()
+        if cacheable:
+            self.cache.put(cache_key, result, generation)
+        return result
+
+    def shutdown(self):
+        self._readers.shutdown()
+        self._writer.shutdown()
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        service = self.server.service
+        while True:
+            try:
+                marker, payload = receive_frame(self.request)
+            except ConnectionError:
+                return
+            try:
+                name, args, kwargs = decode(marker, payload)
+                result = service.call(name, args, dict(kwargs), cache_key=payload)
+                response = [True, result, isinstance(result, list)]
+            except Exception as error:
+                response = [False, type(error).__name__, str(error)]
+            try:
+                send_frame(self.request, *encode(response))
+            except TypeError as error:  # The result cannot be encoded
+                send_frame(self.request, *encode([False, 'TypeError', str(error)]))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, readers=4, cache_entries=2048, cache_ttl=5.0, ready=None):
+    """
+    Serves the query functions on a Unix socket until interrupted.
+    ready is an optional threading.Event set once the socket accepts connections.
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    service = DataService(readers, cache_entries, cache_ttl)
+    with _Server(socket_path, _RequestHandler) as server:
+        server.service = service
+        if ready is not None:
+            ready.set()
+        try:
+            server.serve_forever()
+        finally:
+            service.shutdown()
+            os.unlink(socket_path)
+
+
+# ** Client **
+
+def exposed_functions(namespace):
+    """
+    The query_func functions served by the service: the public functions defined in query_func itself.
+    """
+    return {
+        name: value for name, value in namespace.items()
+        if callable(value) and not name.startswith('_') and name not in LOCAL_FUNCTIONS
+        and getattr(value, '__module__', None) == 'query_func' and not isinstance(value, type)
+    }
+
+
+_EXCEPTIONS = {
+    'ValueError': ValueError,
+    'TypeError': TypeError,
+    'KeyError': KeyError,
+    'AttributeError': AttributeError,
+    'OperationalError': sqlite3.OperationalError,
+    'IntegrityError': sqlite3.IntegrityError,
+    'DatabaseError': sqlite3.DatabaseError,
+}
+
+
+class DataServiceClient:
+    """
+    Calls the service, with one socket per thread (Streamlit runs every session in its own thread).
+    """
+    def __init__(self, socket_path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self._local, 'socket', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as error:
+                sock.close()
+                raise DataServiceError(f'Cannot connect to the data service at {self.socket_path}: {error}') from error
+            self._local.socket = sock
+        return sock
+
+    def _drop_socket(self):
+        sock = getattr(self._local, 'socket', None)
+        if sock is not None:
+            sock.close()
+            self._local.socket = None
+
+    def call(self, name, args, kwargs):
+        marker, payload = encode([name, args, kwargs])
+        # A request that could not be sent is retried once on a new connection (e.g. the service was restarted).
+        # Once sent it is never retried, the service may have run it.
+        for attempt in range(2):
+            sock = self._socket()
+            try:
+                send_frame(sock, marker, payload)
+                break
+            except OSError as error:
+                self._drop_socket()
+                if attempt:
+                    raise DataServiceError(f'Cannot reach the data service: {error}') from error
+        try:
+            response = decode(*receive_frame(sock))
+        except (OSError, ConnectionError) as error:
+            self._drop_socket()
+            raise DataServiceError(f'No response from the data service: {error}') from error
+
+        if response[0]:
+            return list(response[1]) if response[2] else response[1]
+        error_type, message = response[1], response[2]
+        if error_type in _EXCEPTIONS:
+            raise _EXCEPTIONS[error_type](message)
+        raise DataServiceError(f'{error_type}: {message}')
+
+    def close(self):
+        self._drop_socket()
+
+
+def install_client(namespace, socket_path):
+    """
+    Replaces the exposed functions in namespace (the globals of query_func) with stubs calling the service.
+    """
+    client = DataServiceClient(socket_path)
+
+    def remote(name, function):
+        @wraps(function)
+        def stub(*args, **kwargs):
+            return client.call(name, args, kwargs)
+        return stub
+
+    for name, function in exposed_functions(namespace).items():
+        namespace[name] = remote(name, function)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=os.environ.get(SOCKET_ENV) or '/tmp/health_monitoring.sock')
+    parser.add_argument('--readers', type=int, default=4, help='Reader threads, each with its own connections')
+    parser.add_argument('--cache-entries', type=int, default=2048)
+    parser.add_argument('--cache-ttl', type=float, default=5.0, help='Seconds a cached read result stays valid')
+    args = parser.parse_args()
+    # The service runs the real functions, never the client stubs
+    os.environ.pop(SOCKET_ENV, None)
+    from database import create_tables, migrate
+    from shard_router import shard_paths
+    for path in shard_paths():
+        create_tables(path)
+        migrate(path)
+    print(f'Serving on {args.socket} ({"msgpack" if msgpack else "JSON"}, {args.readers} readers)')
+    try:
+        serve(args.socket, args.readers, args.cache_entries, args.cache_ttl)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
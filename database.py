@@ -1,11 +1,79 @@
+import os
 import sqlite3
+import sys
+from datetime import datetime, timedelta
 
-def create_connection():
-    connection = sqlite3.connect('health_monitoring.db')
+DB_PATH = 'health_monitoring.db'
+
+# Numeric analytes stored in LabResults.ResultData for each TestTypeID.
+# doctor_comment is present for every test type and is not listed here.
+TEST_TYPE_ANALYTES = {
+    1: ["T1", "T2"],                  # MR
+    2: [],                            # Röntgen
+    3: [],                            # Tomografi
+    4: ["CRP", "B12", "Mg", "Fe"],    # Kan Tahlili
+}
+
+def analyte_column(analyte):
+    """
+    Name of the generated LabResults column exposing an analyte of ResultData, e.g. 'CRP' -> 'CRPValue'.
+    """
+    return f"{analyte}Value"
+
+def all_analytes():
+    """
+    Every analyte of every test type, in TEST_TYPE_ANALYTES order and without duplicates.
+    """
+    analytes = []
+    for test_type_analytes in TEST_TYPE_ANALYTES.values():
+        for analyte in test_type_analytes:
+            if analyte not in analytes:
+                analytes.append(analyte)
+    return analytes
+
+# Appointments.AppointmentSlot holds the appointment time as minutes since this (naive, local) epoch
+SLOT_EPOCH = datetime(1970, 1, 1)
+MINUTES_PER_DAY = 24 * 60
+
+def appointment_slot(appointment_date):
+    """
+    Converts an AppointmentDate text to its integer slot key.
+    Accepts 'YYYY-MM-DD HH:MM:SS' as well as the unpadded '2024-11-28 9:00:00' older rows were stored with.
+    """
+    if isinstance(appointment_date, datetime):
+        moment = appointment_date
+    else:
+        text = appointment_date.strip()
+        try:
+            moment = datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            moment = datetime.strptime(text, '%Y-%m-%d %H:%M')
+    return int((moment - SLOT_EPOCH).total_seconds() // 60)
+
+def slot_to_datetime(slot):
+    return SLOT_EPOCH + timedelta(minutes=slot)
+
+def slot_to_text(slot):
+    """
+    Canonical AppointmentDate text of a slot key, always zero padded: 'YYYY-MM-DD HH:MM:SS'.
+    """
+    return slot_to_datetime(slot).strftime('%Y-%m-%d %H:%M:%S')
+
+def day_slot_range(day):
+    """
+    Half-open [start, end) slot range covering a whole day given as 'YYYY-MM-DD' or a date.
+    """
+    if isinstance(day, str):
+        day = datetime.strptime(day, '%Y-%m-%d')
+    start = appointment_slot(datetime(day.year, day.month, day.day))
+    return start, start + MINUTES_PER_DAY
+
+def create_connection(db_path=None):
+    connection = sqlite3.connect(db_path or DB_PATH)
     return connection
 
-def create_tables():
-    connection = create_connection()
+def create_tables(db_path=None):
+    connection = create_connection(db_path)
     cursor = connection.cursor()
 
     # Patients table with NationalID as primary key
@@ -62,11 +130,13 @@ def create_tables():
         PatientID INTEGER NOT NULL,
         DoctorID INTEGER NOT NULL,
         TestTypeID INTEGER NOT NULL,
+        AppointmentID INTEGER,
         ResultData TEXT,
         TestDate TEXT,
         FOREIGN KEY (PatientID) REFERENCES Patients(NationalID),
         FOREIGN KEY (DoctorID) REFERENCES Doctors(DoctorID),
-        FOREIGN KEY (TestTypeID) REFERENCES TestTypes(TestTypeID)
+        FOREIGN KEY (TestTypeID) REFERENCES TestTypes(TestTypeID),
+        FOREIGN KEY (AppointmentID) REFERENCES Appointments(AppointmentID)
     )
     ''')
 
@@ -80,8 +150,10 @@ def create_tables():
         Treatment TEXT,
         Notes TEXT,
         CreatedDate TEXT,
+        AppointmentID INTEGER,
         FOREIGN KEY (PatientID) REFERENCES Patients(NationalID),
-        FOREIGN KEY (DoctorID) REFERENCES Doctors(DoctorID)
+        FOREIGN KEY (DoctorID) REFERENCES Doctors(DoctorID),
+        FOREIGN KEY (AppointmentID) REFERENCES Appointments(AppointmentID)
     )
     ''')
 
@@ -93,6 +165,9 @@ def create_tables():
         DoctorID INTEGER NOT NULL,
         AppointmentDate TEXT,
         Reason TEXT,
+        AppointmentSlot INTEGER,
+        Status TEXT NOT NULL DEFAULT 'active' CHECK (Status IN ('active', 'cancelled', 'completed')),
+        CancelledAt TEXT,
         FOREIGN KEY (PatientID) REFERENCES Patients(NationalID),
         FOREIGN KEY (DoctorID) REFERENCES Doctors(DoctorID)
     )
@@ -100,7 +175,7 @@ def create_tables():
 
     # Prescriptions table
     cursor.execute('''
-        CREATE TABLE Prescriptions (
+        CREATE TABLE IF NOT EXISTS Prescriptions (
             PrescriptionID INTEGER PRIMARY KEY AUTOINCREMENT,
             PatientID INTEGER NOT NULL,
             DoctorID INTEGER NOT NULL,
@@ -114,7 +189,7 @@ def create_tables():
 
     # PrescriptionDetails table
     cursor.execute('''
-    CREATE TABLE PrescriptionDetails (
+    CREATE TABLE IF NOT EXISTS PrescriptionDetails (
         DetailID INTEGER PRIMARY KEY AUTOINCREMENT,
         PrescriptionID INTEGER NOT NULL,
         MedicineName TEXT NOT NULL,
@@ -127,5 +202,684 @@ def create_tables():
     connection.commit()
     connection.close()
 
+def create_indexes(db_path=None):
+    """
+    Creates the secondary indexes used by the query functions.
+    Safe to run on an existing database, every index is created only if it is missing.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    # Older databases use a surrogate PatientID key, every other table references NationalID
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_national_id ON Patients (NationalID)')
+
+    # Lab result lookups by patient, by ordering doctor and by test type (cohort queries)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_labresults_patient_date ON LabResults (PatientID, TestDate)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_labresults_doctor_date ON LabResults (DoctorID, TestDate)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_labresults_type_date ON LabResults (TestTypeID, TestDate)')
+
+    # Per-patient history pages
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_medicalrecords_patient_date ON MedicalRecords (PatientID, CreatedDate)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_prescriptions_patient_date ON Prescriptions (PatientID, PrescribedDate)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_prescriptiondetails_prescription ON PrescriptionDetails (PrescriptionID)')
+
+    connection.commit()
+    connection.close()
+
+def add_analyte_columns(db_path=None):
+    """
+    Exposes every analyte of ResultData as a virtual generated column (json_extract, no extra storage)
+    with an index on it, so lab values can be filtered and projected without parsing JSON in Python.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    # table_xinfo also lists generated columns, table_info does not
+    cursor.execute('PRAGMA table_xinfo(LabResults)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+
+    for analyte in all_analytes():
+        column = analyte_column(analyte)
+        if column not in existing_columns:
+            cursor.execute(f'''
+            ALTER TABLE LabResults
+            ADD COLUMN {column} REAL GENERATED ALWAYS AS (json_extract(ResultData, '$.{analyte}')) VIRTUAL
+            ''')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_labresults_{analyte.lower()} ON LabResults ({column})')
+
+    connection.commit()
+    connection.close()
+
+def add_appointment_slots(db_path=None):
+    """
+    Adds the integer AppointmentSlot key next to the free-form AppointmentDate text, backfills it for existing rows,
+    rewrites their AppointmentDate in the canonical zero-padded format and indexes it per doctor and per patient.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    cursor.execute('PRAGMA table_info(Appointments)')
+    if 'AppointmentSlot' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE Appointments ADD COLUMN AppointmentSlot INTEGER')
+
+    cursor.execute('SELECT AppointmentID, AppointmentDate FROM Appointments WHERE AppointmentSlot IS NULL AND AppointmentDate IS NOT NULL')
+    updates = []
+    for appointment_id, appointment_date in cursor.fetchall():
+        slot = appointment_slot(appointment_date)
+        updates.append((slot, slot_to_text(slot), appointment_id))
+    cursor.executemany('UPDATE Appointments SET AppointmentSlot = ?, AppointmentDate = ? WHERE AppointmentID = ?', updates)
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_doctor_slot ON Appointments (DoctorID, AppointmentSlot)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_patient_slot ON Appointments (PatientID, AppointmentSlot)')
+
+    connection.commit()
+    connection.close()
+
+# Appointment life cycle: booked as 'active', then 'cancelled' by the patient or 'completed' by the doctor.
+# Rows are never deleted, so the history and the statistics keep every appointment.
+APPOINTMENT_STATUSES = ('active', 'cancelled', 'completed')
+
+def add_appointment_status(db_path=None):
+    """
+    Adds the Status and CancelledAt columns to Appointments (existing rows become 'active') and the partial indexes
+    on the active rows. Slot checks, a doctor's schedule and the reminder window filter on Status = 'active' and
+    read only these indexes, so their cost does not grow with the number of cancelled and completed appointments.
+    A patient's own appointments are few and are listed with every status on idx_appointments_patient_slot.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    cursor.execute('PRAGMA table_info(Appointments)')
+    columns = {row[1] for row in cursor.fetchall()}
+    if 'Status' not in columns:
+        cursor.execute('''
+        ALTER TABLE Appointments ADD COLUMN
+        Status TEXT NOT NULL DEFAULT 'active' CHECK (Status IN ('active', 'cancelled', 'completed'))
+        ''')
+        # The rollup triggers of older databases count every row, create_rollups recreates them status-aware
+        for trigger in ('insert', 'delete', 'move'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_rollup_appointment_{trigger}')
+    if 'CancelledAt' not in columns:
+        cursor.execute('ALTER TABLE Appointments ADD COLUMN CancelledAt TEXT')
+
+    cursor.execute('PRAGMA table_info(DoctorTotals)')
+    totals_columns = {row[1] for row in cursor.fetchall()}
+    if totals_columns and 'CancelledAppointmentCount' not in totals_columns:
+        cursor.execute('ALTER TABLE DoctorTotals ADD COLUMN CancelledAppointmentCount INTEGER NOT NULL DEFAULT 0')
+
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_doctor_active ON Appointments (DoctorID, AppointmentSlot)
+    WHERE Status = 'active'
+    ''')
+    # Time window scans across all doctors, see reminders.py
+    cursor.execute('DROP INDEX IF EXISTS idx_appointments_slot')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_slot_active ON Appointments (AppointmentSlot)
+    WHERE Status = 'active'
+    ''')
+
+    connection.commit()
+    connection.close()
+
+# Rollup tables kept up to date by the triggers below, read by the doctor statistics panel and, for DoctorRoster,
+# by the patient search of the doctor pages
+ROLLUP_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS DoctorDailyAppointments (
+        DoctorID INTEGER NOT NULL,
+        Day INTEGER NOT NULL,  -- AppointmentSlot / MINUTES_PER_DAY
+        AppointmentCount INTEGER NOT NULL DEFAULT 0,
+        CompletedCount INTEGER NOT NULL DEFAULT 0,  -- Closed out as a visit, the rest of a past day are no-shows
+        PRIMARY KEY (DoctorID, Day)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS DoctorTestTypeCounts (
+        DoctorID INTEGER NOT NULL,
+        TestTypeID INTEGER NOT NULL,
+        ResultCount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (DoctorID, TestTypeID)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS DoctorTotals (
+        DoctorID INTEGER PRIMARY KEY,
+        AppointmentCount INTEGER NOT NULL DEFAULT 0,
+        LabResultCount INTEGER NOT NULL DEFAULT 0,
+        MedicalRecordCount INTEGER NOT NULL DEFAULT 0,
+        PrescriptionCount INTEGER NOT NULL DEFAULT 0,
+        CancelledAppointmentCount INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    # Every patient of a doctor with their latest appointment that is not cancelled, see roster.py
+    '''
+    CREATE TABLE IF NOT EXISTS DoctorRoster (
+        DoctorID INTEGER NOT NULL,
+        PatientID INTEGER NOT NULL,
+        AppointmentID INTEGER NOT NULL,
+        AppointmentSlot INTEGER,
+        PRIMARY KEY (DoctorID, PatientID)
+    ) WITHOUT ROWID
+    ''',
+]
+
+# Recomputes the DoctorRoster entry of one doctor and patient from their appointments ({row} is OLD or NEW),
+# a range scan on idx_appointments_patient_doctor_active
+_ROSTER_ENTRY = '''
+        DELETE FROM DoctorRoster WHERE DoctorID = {row}.DoctorID AND PatientID = {row}.PatientID;
+        INSERT INTO DoctorRoster (DoctorID, PatientID, AppointmentID, AppointmentSlot)
+        SELECT DoctorID, PatientID, AppointmentID, AppointmentSlot FROM Appointments
+        WHERE PatientID = {row}.PatientID AND DoctorID = {row}.DoctorID AND Status <> 'cancelled'
+        ORDER BY AppointmentSlot DESC, AppointmentID DESC LIMIT 1;'''
+# Only the appointment a roster entry points to can change it when deleted, cancelled or moved away: rebuilding for
+# any other row would rescan the pair's appointments for nothing, row after row in a bulk delete
+_IS_ROSTER_ENTRY = '''
+    EXISTS (SELECT 1 FROM DoctorRoster
+            WHERE DoctorID = OLD.DoctorID AND PatientID = OLD.PatientID AND AppointmentID = OLD.AppointmentID)'''
+_ROSTER_UPDATE_CHANGES = '''
+    (OLD.DoctorID IS NOT NEW.DoctorID OR OLD.PatientID IS NOT NEW.PatientID
+     OR OLD.AppointmentSlot IS NOT NEW.AppointmentSlot OR (OLD.Status = 'cancelled') <> (NEW.Status = 'cancelled'))'''
+
+ROLLUP_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_appointment_insert AFTER INSERT ON Appointments
+    BEGIN
+        INSERT INTO DoctorDailyAppointments (DoctorID, Day, AppointmentCount, CompletedCount)
+        SELECT NEW.DoctorID, NEW.AppointmentSlot / {MINUTES_PER_DAY}, 1, NEW.Status = 'completed'
+        WHERE NEW.AppointmentSlot IS NOT NULL AND NEW.Status <> 'cancelled'
+        ON CONFLICT (DoctorID, Day) DO UPDATE SET AppointmentCount = AppointmentCount + 1,
+            CompletedCount = CompletedCount + excluded.CompletedCount;
+        INSERT INTO DoctorTotals (DoctorID, AppointmentCount, CancelledAppointmentCount)
+        VALUES (NEW.DoctorID, NEW.Status <> 'cancelled', NEW.Status = 'cancelled')
+        ON CONFLICT (DoctorID) DO UPDATE SET AppointmentCount = AppointmentCount + excluded.AppointmentCount,
+            CancelledAppointmentCount = CancelledAppointmentCount + excluded.CancelledAppointmentCount;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_appointment_delete AFTER DELETE ON Appointments
+    BEGIN
+        UPDATE DoctorDailyAppointments SET AppointmentCount = AppointmentCount - 1,
+            CompletedCount = CompletedCount - (OLD.Status = 'completed')
+        WHERE DoctorID = OLD.DoctorID AND Day = OLD.AppointmentSlot / {MINUTES_PER_DAY} AND OLD.Status <> 'cancelled';
+        UPDATE DoctorTotals SET AppointmentCount = AppointmentCount - (OLD.Status <> 'cancelled'),
+            CancelledAppointmentCount = CancelledAppointmentCount - (OLD.Status = 'cancelled')
+        WHERE DoctorID = OLD.DoctorID;
+    END
+    ''',
+    # A move to another doctor or slot, a cancellation and a close-out all take the old row out of the counts and add
+    # the new one
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_appointment_update AFTER UPDATE OF DoctorID, AppointmentSlot, Status ON Appointments
+    WHEN OLD.DoctorID IS NOT NEW.DoctorID OR OLD.AppointmentSlot IS NOT NEW.AppointmentSlot
+        OR (OLD.Status = 'cancelled') <> (NEW.Status = 'cancelled')
+        OR (OLD.Status = 'completed') <> (NEW.Status = 'completed')
+    BEGIN
+        UPDATE DoctorDailyAppointments SET AppointmentCount = AppointmentCount - 1,
+            CompletedCount = CompletedCount - (OLD.Status = 'completed')
+        WHERE DoctorID = OLD.DoctorID AND Day = OLD.AppointmentSlot / {MINUTES_PER_DAY} AND OLD.Status <> 'cancelled';
+        INSERT INTO DoctorDailyAppointments (DoctorID, Day, AppointmentCount, CompletedCount)
+        SELECT NEW.DoctorID, NEW.AppointmentSlot / {MINUTES_PER_DAY}, 1, NEW.Status = 'completed'
+        WHERE NEW.AppointmentSlot IS NOT NULL AND NEW.Status <> 'cancelled'
+        ON CONFLICT (DoctorID, Day) DO UPDATE SET AppointmentCount = AppointmentCount + 1,
+            CompletedCount = CompletedCount + excluded.CompletedCount;
+        UPDATE DoctorTotals SET AppointmentCount = AppointmentCount - (OLD.Status <> 'cancelled'),
+            CancelledAppointmentCount = CancelledAppointmentCount - (OLD.Status = 'cancelled')
+        WHERE DoctorID = OLD.DoctorID;
+        INSERT INTO DoctorTotals (DoctorID, AppointmentCount, CancelledAppointmentCount)
+        VALUES (NEW.DoctorID, NEW.Status <> 'cancelled', NEW.Status = 'cancelled')
+        ON CONFLICT (DoctorID) DO UPDATE SET AppointmentCount = AppointmentCount + excluded.AppointmentCount,
+            CancelledAppointmentCount = CancelledAppointmentCount + excluded.CancelledAppointmentCount;
+    END
+    ''',
+    # A booking becomes the roster entry unless the patient already has a later appointment with the doctor
+    # (IDs only grow, so a booking at the same slot is the later one)
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_roster_appointment_insert AFTER INSERT ON Appointments
+    WHEN NEW.Status <> 'cancelled'
+    BEGIN
+        INSERT INTO DoctorRoster (DoctorID, PatientID, AppointmentID, AppointmentSlot)
+        VALUES (NEW.DoctorID, NEW.PatientID, NEW.AppointmentID, NEW.AppointmentSlot)
+        ON CONFLICT (DoctorID, PatientID) DO UPDATE
+        SET AppointmentID = excluded.AppointmentID, AppointmentSlot = excluded.AppointmentSlot
+        WHERE excluded.AppointmentSlot >= AppointmentSlot OR AppointmentSlot IS NULL;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_roster_appointment_delete AFTER DELETE ON Appointments
+    WHEN {_IS_ROSTER_ENTRY}
+    BEGIN{_ROSTER_ENTRY.format(row='OLD')}
+    END
+    ''',
+    # An update is two steps: the entry is recomputed when it was this appointment (cancelled, moved to an earlier
+    # slot or to another pair), and the updated appointment replaces the entry of its pair when it is now the later
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_roster_appointment_update
+    AFTER UPDATE OF DoctorID, PatientID, AppointmentSlot, Status ON Appointments
+    WHEN {_ROSTER_UPDATE_CHANGES} AND {_IS_ROSTER_ENTRY}
+    BEGIN{_ROSTER_ENTRY.format(row='OLD')}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_roster_appointment_update_new
+    AFTER UPDATE OF DoctorID, PatientID, AppointmentSlot, Status ON Appointments
+    WHEN {_ROSTER_UPDATE_CHANGES} AND NEW.Status <> 'cancelled'
+    BEGIN
+        INSERT INTO DoctorRoster (DoctorID, PatientID, AppointmentID, AppointmentSlot)
+        VALUES (NEW.DoctorID, NEW.PatientID, NEW.AppointmentID, NEW.AppointmentSlot)
+        ON CONFLICT (DoctorID, PatientID) DO UPDATE
+        SET AppointmentID = excluded.AppointmentID, AppointmentSlot = excluded.AppointmentSlot
+        WHERE (excluded.AppointmentSlot, excluded.AppointmentID) > (AppointmentSlot, AppointmentID)
+            OR AppointmentSlot IS NULL;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_lab_result_insert AFTER INSERT ON LabResults
+    BEGIN
+        INSERT INTO DoctorTestTypeCounts (DoctorID, TestTypeID, ResultCount) VALUES (NEW.DoctorID, NEW.TestTypeID, 1)
+        ON CONFLICT (DoctorID, TestTypeID) DO UPDATE SET ResultCount = ResultCount + 1;
+        INSERT INTO DoctorTotals (DoctorID, LabResultCount) VALUES (NEW.DoctorID, 1)
+        ON CONFLICT (DoctorID) DO UPDATE SET LabResultCount = LabResultCount + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_lab_result_delete AFTER DELETE ON LabResults
+    BEGIN
+        UPDATE DoctorTestTypeCounts SET ResultCount = ResultCount - 1
+        WHERE DoctorID = OLD.DoctorID AND TestTypeID = OLD.TestTypeID;
+        UPDATE DoctorTotals SET LabResultCount = LabResultCount - 1 WHERE DoctorID = OLD.DoctorID;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_medical_record_insert AFTER INSERT ON MedicalRecords
+    BEGIN
+        INSERT INTO DoctorTotals (DoctorID, MedicalRecordCount) VALUES (NEW.DoctorID, 1)
+        ON CONFLICT (DoctorID) DO UPDATE SET MedicalRecordCount = MedicalRecordCount + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_medical_record_delete AFTER DELETE ON MedicalRecords
+    BEGIN
+        UPDATE DoctorTotals SET MedicalRecordCount = MedicalRecordCount - 1 WHERE DoctorID = OLD.DoctorID;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_prescription_insert AFTER INSERT ON Prescriptions
+    BEGIN
+        INSERT INTO DoctorTotals (DoctorID, PrescriptionCount) VALUES (NEW.DoctorID, 1)
+        ON CONFLICT (DoctorID) DO UPDATE SET PrescriptionCount = PrescriptionCount + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_prescription_delete AFTER DELETE ON Prescriptions
+    BEGIN
+        UPDATE DoctorTotals SET PrescriptionCount = PrescriptionCount - 1 WHERE DoctorID = OLD.DoctorID;
+    END
+    ''',
+]
+
+def _rebuild_rollups(cursor):
+    cursor.execute('DELETE FROM DoctorDailyAppointments')
+    cursor.execute('DELETE FROM DoctorTestTypeCounts')
+    cursor.execute('DELETE FROM DoctorTotals')
+    cursor.execute('DELETE FROM DoctorRoster')
+    cursor.execute(f'''
+    INSERT INTO DoctorDailyAppointments (DoctorID, Day, AppointmentCount, CompletedCount)
+    SELECT DoctorID, AppointmentSlot / {MINUTES_PER_DAY}, COUNT(*), SUM(Status = 'completed') FROM Appointments
+    WHERE AppointmentSlot IS NOT NULL AND Status <> 'cancelled'
+    GROUP BY DoctorID, AppointmentSlot / {MINUTES_PER_DAY}
+    ''')
+    cursor.execute('''
+    INSERT INTO DoctorTestTypeCounts (DoctorID, TestTypeID, ResultCount)
+    SELECT DoctorID, TestTypeID, COUNT(*) FROM LabResults GROUP BY DoctorID, TestTypeID
+    ''')
+    cursor.execute('''
+    INSERT INTO DoctorTotals (DoctorID, AppointmentCount, LabResultCount, MedicalRecordCount, PrescriptionCount,
+                              CancelledAppointmentCount)
+    SELECT DoctorID, SUM(Appointments), SUM(LabResults), SUM(MedicalRecords), SUM(Prescriptions), SUM(Cancelled)
+    FROM (
+        SELECT DoctorID, SUM(Status <> 'cancelled') AS Appointments, 0 AS LabResults, 0 AS MedicalRecords,
+               0 AS Prescriptions, SUM(Status = 'cancelled') AS Cancelled
+        FROM Appointments GROUP BY DoctorID
+        UNION ALL
+        SELECT DoctorID, 0, COUNT(*), 0, 0, 0 FROM LabResults GROUP BY DoctorID
+        UNION ALL
+        SELECT DoctorID, 0, 0, COUNT(*), 0, 0 FROM MedicalRecords GROUP BY DoctorID
+        UNION ALL
+        SELECT DoctorID, 0, 0, 0, COUNT(*), 0 FROM Prescriptions GROUP BY DoctorID
+    )
+    GROUP BY DoctorID
+    ''')
+    # Each doctor and patient's latest appointment, the one _ROSTER_ENTRY picks
+    cursor.execute('''
+    INSERT INTO DoctorRoster (DoctorID, PatientID, AppointmentID, AppointmentSlot)
+    SELECT DoctorID, PatientID, AppointmentID, AppointmentSlot FROM (
+        SELECT DoctorID, PatientID, AppointmentID, AppointmentSlot, ROW_NUMBER() OVER (
+            PARTITION BY DoctorID, PatientID ORDER BY AppointmentSlot DESC, AppointmentID DESC
+        ) AS Position
+        FROM Appointments WHERE Status <> 'cancelled'
+    )
+    WHERE Position = 1
+    ''')
+
+def rebuild_rollups(db_path=None):
+    """
+    Recomputes every rollup table from the base tables in one transaction.
+    Run it after bulk changes made with the triggers disabled or if the rollups are suspected to have drifted:
+        python database.py rebuild-rollups
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+    _rebuild_rollups(cursor)
+    connection.commit()
+    connection.close()
+
+def create_rollups(db_path=None):
+    """
+    Creates the per-doctor rollup tables and the triggers maintaining them.
+    They are all filled from the existing rows when one of them is created.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    cursor.execute('''
+    SELECT COUNT(*) FROM sqlite_master
+    WHERE type = 'table' AND name IN ('DoctorDailyAppointments', 'DoctorTestTypeCounts', 'DoctorTotals', 'DoctorRoster')
+    ''')
+    is_new = cursor.fetchone()[0] < len(ROLLUP_TABLES)
+
+    # Older daily rollups have no CompletedCount: add it, recreate the appointment triggers and refill the rollups
+    cursor.execute('PRAGMA table_info(DoctorDailyAppointments)')
+    daily_columns = {row[1] for row in cursor.fetchall()}
+    if daily_columns and 'CompletedCount' not in daily_columns:
+        cursor.execute('ALTER TABLE DoctorDailyAppointments ADD COLUMN CompletedCount INTEGER NOT NULL DEFAULT 0')
+        for trigger in ('insert', 'delete', 'update'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS trg_rollup_appointment_{trigger}')
+        is_new = True
+
+    # The first roster triggers rebuilt the entry on every delete and update, recreated with their guards
+    for trigger in ('delete', 'update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS trg_roster_appointment_{trigger}')
+    for statement in ROLLUP_TABLES + ROLLUP_TRIGGERS:
+        cursor.execute(statement)
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_appointments_patient_doctor_active
+    ON Appointments (PatientID, DoctorID, AppointmentSlot) WHERE Status <> 'cancelled'
+    ''')
+    if is_new:
+        _rebuild_rollups(cursor)
+
+    connection.commit()
+    connection.close()
+
+# Tables whose changes are recorded in ChangeLog: (primary key, patient of the row, row reported in the log).
+# PrescriptionDetails lines are always read per prescription, so their changes are reported on the PrescriptionID.
+CHANGE_LOG_TABLES = {
+    'Appointments': ('AppointmentID', '{row}.PatientID', '{row}.AppointmentID'),
+    'LabResults': ('ResultID', '{row}.PatientID', '{row}.ResultID'),
+    'MedicalRecords': ('RecordID', '{row}.PatientID', '{row}.RecordID'),
+    'Prescriptions': ('PrescriptionID', '{row}.PatientID', '{row}.PrescriptionID'),
+    'PrescriptionDetails': (
+        'DetailID',
+        '(SELECT PatientID FROM Prescriptions WHERE PrescriptionID = {row}.PrescriptionID)',
+        '{row}.PrescriptionID',
+    ),
+}
+
+def _change_log_triggers():
+    statements = []
+    for table, (_, patient, row_id) in CHANGE_LOG_TABLES.items():
+        for event, operation, row in (('INSERT', 'I', 'NEW'), ('UPDATE', 'U', 'NEW'), ('DELETE', 'D', 'OLD')):
+            statements.append(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_changelog_{table.lower()}_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO ChangeLog (PatientID, TableName, RowID, Operation)
+                VALUES ({patient.format(row=row)}, '{table}', {row_id.format(row=row)}, '{operation}');
+            END
+            ''')
+    return statements
+
+def create_change_log(db_path=None):
+    """
+    Creates the append-only ChangeLog and the triggers recording every insert, update and delete
+    of the patient-owned tables with a monotonically increasing sequence number.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+
+    # AUTOINCREMENT so that sequence numbers are never reused, even after compaction deletes the newest rows
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ChangeLog (
+        Seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        PatientID INTEGER,
+        TableName TEXT NOT NULL,
+        RowID INTEGER NOT NULL,
+        Operation TEXT NOT NULL,  -- 'I', 'U' or 'D'
+        ChangedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_changelog_patient_seq ON ChangeLog (PatientID, Seq)')
+
+    # Highest sequence number removed by compaction, clients that are behind it must reload everything
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ChangeLogCompaction (
+        ID INTEGER PRIMARY KEY CHECK (ID = 1),
+        CompactedThroughSeq INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO ChangeLogCompaction (ID, CompactedThroughSeq) VALUES (1, 0)')
+
+    for statement in _change_log_triggers():
+        cursor.execute(statement)
+
+    connection.commit()
+    connection.close()
+
+def compact_change_log(keep_days=30, db_path=None):
+    """
+    Deletes ChangeLog entries older than keep_days days:
+        python database.py compact-change-log [keep_days]
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+    cursor.execute("SELECT MAX(Seq) FROM ChangeLog WHERE ChangedAt < datetime('now', ?)", (f'-{keep_days} days',))
+    through_seq = cursor.fetchone()[0]
+    if through_seq is not None:
+        cursor.execute('DELETE FROM ChangeLog WHERE Seq <= ?', (through_seq,))
+        cursor.execute('''
+        UPDATE ChangeLogCompaction SET CompactedThroughSeq = MAX(CompactedThroughSeq, ?) WHERE ID = 1
+        ''', (through_seq,))
+    connection.commit()
+    connection.close()
+
+# ** Medicine catalog **
+
+def display_medicine_name(name):
+    """
+    Medicine name as shown: surrounding and repeated whitespace removed, case kept.
+    """
+    return ' '.join(name.split())
+
+def normalize_medicine_name(name):
+    """
+    Catalog key of a medicine name: spelling variants differing only in case or whitespace share it.
+    """
+    return display_medicine_name(name).casefold()
+
+def _reference_db_path(db_path):
+    from shard_router import reference_path
+    reference = reference_path()
+    return None if os.path.abspath(reference) == os.path.abspath(db_path or DB_PATH) else reference
+
+def create_medicine_catalog(db_path=None):
+    """
+    Creates the Medicines catalog and moves PrescriptionDetails from a free-text MedicineName to a MedicineID.
+    Existing names are deduplicated on normalize_medicine_name, the most used spelling becomes the catalog name.
+
+    Medicines is reference data replicated to every shard with the same IDs: the names of a shard are added to the
+    reference shard's catalog first, which is then copied to the shard.
+    """
+    connection = create_connection(db_path)
+    connection.create_function('normalize_medicine_name', 1, normalize_medicine_name, deterministic=True)
+    connection.create_function('display_medicine_name', 1, display_medicine_name, deterministic=True)
+    cursor = connection.cursor()
+
+    reference = _reference_db_path(db_path)
+    catalog = 'main'
+    if reference is not None:
+        cursor.execute('ATTACH DATABASE ? AS ref', (reference,))
+        catalog = 'ref'
+    for schema in {'main', catalog}:
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.Medicines (
+            MedicineID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Name TEXT NOT NULL,
+            NormalizedName TEXT NOT NULL UNIQUE
+        )
+        ''')
+
+    cursor.execute('PRAGMA main.table_info(PrescriptionDetails)')
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'MedicineName' in columns:
+        # Bare column with MAX(): the spelling used by the most lines of each normalized name
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO {catalog}.Medicines (Name, NormalizedName)
+        SELECT Name, NormalizedName FROM (
+            SELECT display_medicine_name(MedicineName) AS Name, normalize_medicine_name(MedicineName) AS NormalizedName,
+                   MAX(Uses)
+            FROM (SELECT MedicineName, COUNT(*) AS Uses FROM main.PrescriptionDetails GROUP BY MedicineName)
+            GROUP BY NormalizedName
+        )
+        ''')
+    if reference is not None:
+        cursor.execute('''
+        INSERT OR IGNORE INTO main.Medicines (MedicineID, Name, NormalizedName)
+        SELECT MedicineID, Name, NormalizedName FROM ref.Medicines
+        ''')
+
+    if 'MedicineName' in columns:
+        # The lines are copied into a new table rather than updated in place, which would leave the old table's pages
+        # half empty. Its triggers go with the old table (create_change_log, which runs after this step, recreates
+        # them), so the copy adds no ChangeLog rows. The AUTOINCREMENT position is kept: it holds the shard's ID range.
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'PrescriptionDetails'")
+        sequence = cursor.fetchone()
+        cursor.execute('''
+        CREATE TABLE PrescriptionDetailsCatalog (
+            DetailID INTEGER PRIMARY KEY AUTOINCREMENT,
+            PrescriptionID INTEGER NOT NULL,
+            MedicineID INTEGER NOT NULL,
+            Dosage TEXT NOT NULL,
+            Instructions TEXT,
+            FOREIGN KEY (PrescriptionID) REFERENCES Prescriptions(PrescriptionID),
+            FOREIGN KEY (MedicineID) REFERENCES Medicines(MedicineID)
+        )
+        ''')
+        cursor.execute('''
+        INSERT INTO PrescriptionDetailsCatalog (DetailID, PrescriptionID, MedicineID, Dosage, Instructions)
+        SELECT pd.DetailID, pd.PrescriptionID, m.MedicineID, pd.Dosage, pd.Instructions
+        FROM main.PrescriptionDetails pd
+        JOIN main.Medicines m ON m.NormalizedName = normalize_medicine_name(pd.MedicineName)
+        ''')
+        cursor.execute('DROP TABLE main.PrescriptionDetails')
+        cursor.execute('ALTER TABLE PrescriptionDetailsCatalog RENAME TO PrescriptionDetails')
+        if sequence:
+            cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'PrescriptionDetails'", sequence)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_prescriptiondetails_prescription ON PrescriptionDetails (PrescriptionID)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_prescriptiondetails_medicine ON PrescriptionDetails (MedicineID)')
+
+    connection.commit()
+    if reference is not None:
+        cursor.execute('DETACH DATABASE ref')
+    connection.close()
+
+# ** Appointment reminders **
+
+def create_reminder_watermarks(db_path=None):
+    """
+    Creates the table where reminders.py records, per job, how far it has sent reminders: every appointment with
+    AppointmentSlot <= Slot and AppointmentID <= AppointmentID has been sent. The Pending columns hold the bounds of
+    a run that has not finished sending yet, and ReminderBatches the appointments that run planned, in batches, so
+    that a rerun sends exactly the same batches.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ReminderWatermarks (
+        Job TEXT PRIMARY KEY,
+        Slot INTEGER NOT NULL,
+        AppointmentID INTEGER NOT NULL,
+        PendingFromSlot INTEGER,
+        PendingSlot INTEGER,
+        PendingAppointmentID INTEGER,
+        UpdatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ReminderBatches (
+        Job TEXT NOT NULL,
+        Position INTEGER NOT NULL,
+        BatchNumber INTEGER NOT NULL,
+        AppointmentID INTEGER NOT NULL,
+        PRIMARY KEY (Job, Position)
+    )
+    ''')
+    connection.commit()
+    connection.close()
+
+# ** Clinical text compression **
+
+def create_text_dictionaries(db_path=None):
+    """
+    Creates the table of the preset dictionaries MedicalRecords.Treatment and Notes are compressed with, see
+    clinical_text. Reference data, the same rows on every shard. At most one is Active: new values are compressed
+    with it, none active means compression is off.
+    """
+    connection = create_connection(db_path)
+    cursor = connection.cursor()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS TextDictionaries (
+        DictionaryID INTEGER PRIMARY KEY,  -- Derived from Content, see clinical_text.dictionary_id
+        Content BLOB NOT NULL,
+        Active INTEGER NOT NULL DEFAULT 0,
+        CreatedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    connection.commit()
+    connection.close()
+
+# ** Sharding **
+
+def seed_shard_id_range(db_path=None):
+    """
+    Starts the IDs of a shard's patient-owned tables in the shard's own range, see shard_router.seed_id_range.
+    Needed for shards created empty with create_tables, reshard seeds the shards it creates itself.
+    """
+    from shard_router import seed_id_range
+    seed_id_range(db_path or DB_PATH)
+
+def migrate(db_path=None):
+    """
+    Brings an existing database up to the current schema. Every step is idempotent.
+    """
+    create_indexes(db_path)
+    add_analyte_columns(db_path)
+    add_appointment_slots(db_path)
+    add_appointment_status(db_path)
+    create_rollups(db_path)
+    create_medicine_catalog(db_path)
+    create_reminder_watermarks(db_path)
+    create_text_dictionaries(db_path)
+    create_change_log(db_path)
+    seed_shard_id_range(db_path)
+
 if __name__ == '__main__':
-    create_tables()
+    from shard_router import shard_paths
+
+    # Every command runs on each shard, a single file unless sharding is configured
+    for path in shard_paths():
+        if sys.argv[1:] == ['rebuild-rollups']:
+            rebuild_rollups(path)
+        elif sys.argv[1:2] == ['compact-change-log']:
+            compact_change_log(*(int(arg) for arg in sys.argv[2:3]), db_path=path)
+        else:
+            create_tables(path)
+            migrate(path)
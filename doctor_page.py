@@ -1,17 +1,32 @@
 import streamlit as st
-from datetime import datetime
+import pandas as pd
+from datetime import datetime, timedelta
 from p_appointment_page import appointments_page
 from p_lab_results_page import lab_results_page
 from p_medical_records_page import medical_records_page
 from p_prescriptions_page import prescriptions_page
+from database import TEST_TYPE_ANALYTES, day_slot_range, display_medicine_name, normalize_medicine_name, slot_to_text
 from query_func import (
     get_doctor_name_from_id,
     get_appointments_by_doctor,
-    get_appointment_by_doctor_for_specific_patient,
+    get_appointments_by_doctor_between,
     add_lab_result,
     add_medical_record,
-    add_prescription
+    add_prescription,
+    add_visit,
+    add_medicines,
+    get_all_test_types,
+    get_doctor_totals,
+    get_doctor_daily_appointment_counts,
+    get_doctor_test_type_counts,
+    get_doctor_no_show_counts,
+    find_cohort
 )
+from cohort_query import parse_filter, days_ago
+from async_query import load_concurrently
+from medicine_catalog import search_medicines, remember_medicines
+from interactions import check_prescription
+from roster import current_entry, doctor_roster, find_patients
 
 #Main page for the doctors
 def main_doctor_page():
@@ -28,7 +43,8 @@ def main_doctor_page():
     # Sidebar menu for navigation
     doctor_menu = st.sidebar.selectbox(
         "What would you like to do?",
-        ["All Appointments", "Add Lab Result For Patient", "Add Medical Result For Patient", "Add Prescription"]
+        ["All Appointments", "Add Lab Result For Patient", "Add Medical Result For Patient", "Add Prescription", "Close Out Visit",
+         "Patient Cohorts", "Statistics"]
     )
 
     #All Appointments
@@ -47,6 +63,18 @@ def main_doctor_page():
     if doctor_menu == "Add Prescription":
         add_prescription_page(doctor_id)
 
+    #Close Out Visit
+    if doctor_menu == "Close Out Visit":
+        close_visit_page(doctor_id)
+
+    #Patient Cohorts
+    if doctor_menu == "Patient Cohorts":
+        patient_cohorts_page(doctor_id)
+
+    #Statistics
+    if doctor_menu == "Statistics":
+        statistics_page(doctor_id)
+
 # All Appointments Page
 def all_appointments_page(doctor_id):
     """
@@ -70,10 +98,10 @@ def all_appointments_page(doctor_id):
     st.write("Here are your upcoming appointments:")
     appointments_data = [
         {
-            "Appointment ID": appointment[0],
-            "Patient Name": appointment[1],
-            "Appointment Date": appointment[2],
-            "Reason": appointment[3],
+            "Appointment ID": appointment.appointment_id,
+            "Patient Name": appointment.patient_name,
+            "Appointment Date": appointment.appointment_date,
+            "Reason": appointment.reason,
         }
         for appointment in appointments
     ]
@@ -85,21 +113,18 @@ def all_appointments_page(doctor_id):
     st.subheader("Filter Appointments by Date")
     filter_date = st.date_input("Select a date to filter appointments:")
 
-    # Filter appointments based on the selected date
+    # Filter appointments based on the selected date, a range scan over the day's slots
     if filter_date:
-        filtered_appointments = [
-            appointment for appointment in appointments
-            if appointment[2].startswith(filter_date.strftime('%Y-%m-%d'))
-        ]
+        filtered_appointments = get_appointments_by_doctor_between(doctor_id, *day_slot_range(filter_date))
 
         if filtered_appointments:
             st.write("Appointments on selected date:")
             filtered_appointments_data = [
                 {
-                    "Appointment ID": appointment[0],
-                    "Patient Name": appointment[1],
-                    "Appointment Date": appointment[2],
-                    "Reason": appointment[3],
+                    "Appointment ID": appointment.appointment_id,
+                    "Patient Name": appointment.patient_name,
+                    "Appointment Date": appointment.appointment_date,
+                    "Reason": appointment.reason,
                 }
                 for appointment in filtered_appointments
             ]
@@ -107,6 +132,49 @@ def all_appointments_page(doctor_id):
         else:
             st.info("No appointments found for the selected date.")
 
+# Patient selection shared by the add pages
+def select_patient(doctor_id):
+    """
+    Searches the doctor's patients by name or National ID prefix and lets the doctor pick one.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Retrieved from session state.
+
+    Returns:
+        models.RosterEntry: The selected patient with the appointment to link the new rows to, None until one is found.
+    """
+    search_column, refresh_column = st.columns([4, 1])
+    search = search_column.text_input("Search Patient by Name or National ID:")
+    if refresh_column.button("Refresh Patients", help="Reload your patient list, e.g. after new bookings"):
+        doctor_roster(doctor_id, reload=True)
+
+    if not search:
+        return None
+    patients = find_patients(doctor_id, search)
+    if not patients:
+        st.error("No active appointment found for this patient.")
+        return None
+
+    def describe(patient):
+        last_appointment = slot_to_text(patient.appointment_slot) if patient.appointment_slot is not None else "-"
+        return f"{patient.patient_name} ({patient.patient_id}), last appointment {last_appointment}"
+
+    return st.selectbox("Patient:", patients, format_func=describe)
+
+def current_appointment_id(doctor_id, patient):
+    """
+    The appointment to link new rows to, re-read before writing: the roster's cached one may have been cancelled or
+    followed by a later booking since it was loaded. Shows an error and returns None when the patient has no
+    appointment that is not cancelled any more.
+    """
+    entry = current_entry(doctor_id, patient.patient_id)
+    if entry is None:
+        st.error("This patient no longer has an appointment with you.")
+        return None
+    if entry.appointment_id != patient.appointment_id and entry.appointment_slot is not None:
+        st.info(f"Linked to the patient's latest appointment, {slot_to_text(entry.appointment_slot)}.")
+    return entry.appointment_id
+
 # Add Prescription For Patient Page
 def add_prescription_page(doctor_id):
     """
@@ -117,34 +185,17 @@ def add_prescription_page(doctor_id):
     """
     st.title("Add Prescription for Patient")
 
-    # Input for Patient ID
-    patient_id = st.text_input("Enter Patient National ID:")
+    # Patient from the session's roster, no query per rerun; the appointment is re-read on submit
+    patient = select_patient(doctor_id)
 
-    if patient_id:
-        # Get Appointment ID
-        appointment_id = get_appointment_by_doctor_for_specific_patient(doctor_id, patient_id)
-
-        if not appointment_id:
-            st.error("No active appointment found for this patient.")
-            return
+    if patient:
+        patient_id = patient.patient_id
 
         # Input for medicines
         st.subheader("Add Medicines to Prescription")
-        medicines = []
         medicine_count = st.number_input("Number of medicines to prescribe:", min_value=1, step=1)
-
-        for i in range(medicine_count):
-            with st.expander(f"Medicine {i+1} Details"):
-                medicine_name = st.text_input(f"Medicine {i+1} Name:", key=f"medicine_name_{i}")
-                dosage = st.text_input(f"Medicine {i+1} Dosage:", key=f"dosage_{i}")
-                instructions = st.text_area(f"Medicine {i+1} Instructions (optional):", key=f"instructions_{i}")
-
-                if medicine_name and dosage:
-                    medicines.append({
-                        "name": medicine_name,
-                        "dosage": dosage,
-                        "instructions": instructions
-                    })
+        medicines = medicine_inputs(medicine_count)
+        show_interactions(patient_id, medicines)
 
         # Prescription date
         prescription_date = st.date_input("Prescription Date", datetime.now()).strftime('%Y-%m-%d')
@@ -155,9 +206,73 @@ def add_prescription_page(doctor_id):
                 st.error("Please add at least one medicine to the prescription.")
                 return
             
+            appointment_id = current_appointment_id(doctor_id, patient)
+            if appointment_id is None:
+                return
+            add_new_medicines(medicines)
             add_prescription(patient_id, doctor_id, appointment_id, medicines, prescription_date)
             st.success("Prescription added successfully.")
 
+# Medicine inputs of a prescription, shared by add_prescription_page and close_visit_page
+def medicine_inputs(medicine_count):
+    """
+    Shows the name (with catalog autocomplete), dosage and instructions inputs of medicine_count medicines.
+
+    Returns:
+        list of dict: The medicines given a name and a dosage, with 'medicine_id' (None for a name typed as new),
+            'name', 'dosage' and 'instructions'.
+    """
+    medicines = []
+    for i in range(medicine_count):
+        with st.expander(f"Medicine {i+1} Details"):
+            medicine_name = st.text_input(f"Medicine {i+1} Name:", key=f"medicine_name_{i}")
+            medicine_id = None
+            if medicine_name:
+                # Catalog names starting with what was typed, searched in memory
+                names = dict(search_medicines(medicine_name))
+                options = list(names)
+                if normalize_medicine_name(medicine_name) not in map(normalize_medicine_name, names.values()):
+                    options.append(None)  # As typed, added to the catalog on submit
+                choice = st.selectbox(
+                    f"Medicine {i+1} from catalog:", options, key=f"medicine_choice_{i}",
+                    format_func=lambda option, names=names, typed=medicine_name: names[option] if option is not None
+                    else f"{display_medicine_name(typed)} (new)"
+                )
+                if choice is not None:
+                    medicine_id, medicine_name = choice, names[choice]
+            dosage = st.text_input(f"Medicine {i+1} Dosage:", key=f"dosage_{i}")
+            instructions = st.text_area(f"Medicine {i+1} Instructions (optional):", key=f"instructions_{i}")
+
+            if medicine_name and dosage:
+                medicines.append({
+                    "medicine_id": medicine_id,
+                    "name": medicine_name,
+                    "dosage": dosage,
+                    "instructions": instructions
+                })
+    return medicines
+
+# Interactions with each other and with what the patient is taking, shown before submitting
+def show_interactions(patient_id, medicines):
+    prescribed = [(medicine["medicine_id"], medicine["name"]) for medicine in medicines]
+    for conflict in check_prescription(patient_id, prescribed) if prescribed else []:
+        other = f"{conflict.other} (currently taking)" if conflict.other_is_active else conflict.other
+        message = f"Interaction, {conflict.severity}: {conflict.medicine} + {other}. {conflict.description}"
+        if conflict.severity in ("contraindicated", "major"):
+            st.error(message)
+        else:
+            st.warning(message)
+
+# New names join the catalog (and this process' autocomplete) before the prescription references them
+def add_new_medicines(medicines):
+    new_names = [medicine["name"] for medicine in medicines if medicine["medicine_id"] is None]
+    if new_names:
+        medicine_ids = add_medicines(new_names)
+        remember_medicines(medicine_ids, new_names)
+        for medicine in medicines:
+            if medicine["medicine_id"] is None:
+                medicine["medicine_id"] = medicine_ids[normalize_medicine_name(medicine["name"])]
+
 # Add Medical Result For Patient Page
 def add_medical_result_page(doctor_id):
     """
@@ -168,16 +283,11 @@ def add_medical_result_page(doctor_id):
     """
     st.title("Add Medical Result for Patient")
 
-    # Input for Patient ID
-    patient_id = st.text_input("Enter Patient National ID:")
+    # Patient from the session's roster, no query per rerun; the appointment is re-read on submit
+    patient = select_patient(doctor_id)
 
-    if patient_id:
-        # Get Appointment ID
-        appointment_id = get_appointment_by_doctor_for_specific_patient(doctor_id, patient_id)
-
-        if not appointment_id:
-            st.error("No active appointment found for this patient.")
-            return
+    if patient:
+        patient_id = patient.patient_id
 
         # Input fields for medical record
         st.subheader("Enter Medical Record Details")
@@ -193,7 +303,10 @@ def add_medical_result_page(doctor_id):
             if not diagnosis or not treatment:
                 st.error("Diagnosis and Treatment Plan are required fields.")
                 return
-            
+
+            appointment_id = current_appointment_id(doctor_id, patient)
+            if appointment_id is None:
+                return
             add_medical_record(patient_id, doctor_id, diagnosis, treatment, notes, created_datetime, appointment_id)
             st.success("Medical record added successfully.")
 
@@ -207,16 +320,11 @@ def add_lab_results_page(doctor_id):
     """
     st.title("Add Lab Result for Patient")
 
-    # Input for Patient ID
-    patient_id = st.text_input("Enter Patient National ID:")
+    # Patient from the session's roster, no query per rerun; the appointment is re-read on submit
+    patient = select_patient(doctor_id)
 
-    if patient_id:
-        # Get Appointment ID
-        appointment_id = get_appointment_by_doctor_for_specific_patient(doctor_id, patient_id)
-
-        if not appointment_id:
-            st.error("No active appointment found for this patient.")
-            return
+    if patient:
+        patient_id = patient.patient_id
 
         # Menu to select test type
         st.subheader("Select Test Type")
@@ -235,25 +343,7 @@ def add_lab_results_page(doctor_id):
 
         # Display appropriate input fields based on the selected test type
         st.subheader("Enter Test Results")
-        result_data = {"doctor_comment": st.text_input("Doctor Comment:")}
-
-        if selected_test_type_id == 1:  # MR
-            result_data["T1"] = st.number_input("T1 Value:", min_value=0.0)
-            result_data["T2"] = st.number_input("T2 Value:", min_value=0.0)
-
-        elif selected_test_type_id == 2:  # Röntgen
-            # No additional fields for Röntgen, only the doctor_comment is required
-            pass
-
-        elif selected_test_type_id == 3:  # Tomografi
-            # No additional fields for Tomografi, only the doctor_comment is required
-            pass
-
-        elif selected_test_type_id == 4:  # Kan Tahlili
-            result_data["CRP"] = st.number_input("CRP Value:", min_value=0.0)
-            result_data["B12"] = st.number_input("B12 Value:", min_value=0.0)
-            result_data["Mg"] = st.number_input("Mg Value:", min_value=0.0)
-            result_data["Fe"] = st.number_input("Fe Value:", min_value=0.0)
+        result_data = lab_result_inputs(selected_test_type_id)
 
         # Date and time input for the test
         test_date = st.date_input("Test Date", datetime.now()).strftime('%Y-%m-%d')
@@ -271,5 +361,219 @@ def add_lab_results_page(doctor_id):
                 return
 
             # Save lab result to the database
+            appointment_id = current_appointment_id(doctor_id, patient)
+            if appointment_id is None:
+                return
             add_lab_result(patient_id, doctor_id, selected_test_type_id, result_data_json, test_datetime, appointment_id)
             st.success("Lab result added successfully.")
+
+# Result fields of a test type, shared by add_lab_results_page and close_visit_page
+def lab_result_inputs(test_type_id, key="lab_result"):
+    """
+    Shows the doctor comment and the analyte inputs of the test type (database.TEST_TYPE_ANALYTES): T1 and T2 for
+    MR, CRP, B12, Mg and Fe for Kan Tahlili, only the doctor_comment for Röntgen and Tomografi.
+
+    Parameters:
+        test_type_id (int): The selected test type.
+        key (str): Prefix of the widget keys, tells apart several tests on one page.
+
+    Returns:
+        dict: The result data, stored as JSON in LabResults.ResultData.
+    """
+    result_data = {"doctor_comment": st.text_input("Doctor Comment:", key=f"{key}_doctor_comment")}
+    for analyte in TEST_TYPE_ANALYTES[test_type_id]:
+        result_data[analyte] = st.number_input(f"{analyte} Value:", min_value=0.0, key=f"{key}_{analyte}")
+    return result_data
+
+# Close Out Visit Page
+def close_visit_page(doctor_id):
+    """
+    Records a whole visit at once: lab results, a medical record and a prescription, and marks the appointment
+    completed. Everything stays in the form until the visit is closed, then it is written in one transaction.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Retrieved from session state.
+    """
+    st.title("Close Out Visit")
+
+    # Patient and appointment from the session's roster, no query per rerun
+    patient = select_patient(doctor_id)
+    if not patient:
+        return
+    patient_id, appointment_id = patient.patient_id, patient.appointment_id
+
+    st.subheader("Lab Results")
+    test_types = {test_type.test_type_id: test_type.test_type for test_type in get_all_test_types()}
+    test_count = st.number_input("Number of lab tests:", min_value=0, step=1)
+    tests = []
+    for i in range(test_count):
+        with st.expander(f"Lab Test {i+1}"):
+            test_type_id = st.selectbox("Choose the test type", options=list(test_types),
+                                        format_func=lambda x: test_types[x], key=f"visit_test_type_{i}")
+            tests.append((test_type_id, lab_result_inputs(test_type_id, key=f"visit_test_{i}")))
+
+    st.subheader("Medical Record")
+    diagnosis = st.text_input("Diagnosis:")
+    treatment = st.text_area("Treatment Plan:")
+    notes = st.text_area("Additional Notes:")
+
+    st.subheader("Prescription")
+    medicine_count = st.number_input("Number of medicines to prescribe:", min_value=0, step=1)
+    medicines = medicine_inputs(medicine_count)
+    show_interactions(patient_id, medicines)
+
+    # One date and time for everything recorded in the visit
+    visit_date = st.date_input("Visit Date", datetime.now()).strftime('%Y-%m-%d')
+    visit_time = st.time_input("Visit Time", datetime.now().time()).strftime('%H:%M:%S')
+    visit_datetime = f"{visit_date} {visit_time}"
+    complete = st.checkbox("Mark the appointment as completed", value=True)
+
+    if st.button("Close Out Visit"):
+        if any(not result_data.get("doctor_comment") for _, result_data in tests):
+            st.error("Doctor Comment is required for every lab test.")
+            return
+        if (diagnosis or treatment or notes) and not (diagnosis and treatment):
+            st.error("Diagnosis and Treatment Plan are required fields of the medical record.")
+            return
+        if not (tests or diagnosis or medicines or complete):
+            st.error("Nothing to record for this visit.")
+            return
+
+        import json
+        add_new_medicines(medicines)
+        try:
+            add_visit(
+                patient_id, doctor_id, appointment_id,
+                lab_results=[
+                    {"test_type_id": test_type_id, "result_data": json.dumps(result_data), "test_date": visit_datetime}
+                    for test_type_id, result_data in tests
+                ],
+                medical_record={"diagnosis": diagnosis, "treatment": treatment, "notes": notes,
+                                "created_date": visit_datetime} if diagnosis else None,
+                prescription={"medicines": medicines, "prescribed_date": visit_date} if medicines else None,
+                complete=complete
+            )
+        except ValueError as error:
+            st.error(str(error))
+            return
+        st.success(f"Visit closed out: {len(tests)} lab result(s), {'a' if diagnosis else 'no'} medical record, "
+                   f"{len(medicines)} medicine(s) prescribed.")
+
+
+# Patient Cohorts Page
+def patient_cohorts_page(doctor_id):
+    """
+    Lets the doctor find patients whose lab values match a filter, e.g. "Fe < 10" or "CRP change > 50".
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Retrieved from session state.
+    """
+    st.title("Patient Cohorts")
+
+    filter_text = st.text_area(
+        "Conditions (one per line):",
+        placeholder="Fe < 10\nCRP change > 50",
+        help="'<analyte> <op> <value>' compares a single test, '<analyte> change <op> <percent>' compares the last two tests."
+    )
+
+    only_mine = st.checkbox("Only lab results I ordered", value=True)
+
+    test_types = {test_type.test_type_id: test_type.test_type for test_type in get_all_test_types()}
+    test_type_options = [None] + list(test_types.keys())
+    selected_test_type_id = st.selectbox(
+        "Test type",
+        options=test_type_options,
+        format_func=lambda x: "All test types" if x is None else test_types[x]
+    )
+
+    last_days = st.number_input("Only tests from the last N days (0 for all):", min_value=0, step=1)
+    page_size = st.selectbox("Patients per page", [20, 50, 100])
+    page = st.number_input("Page", min_value=1, step=1)
+
+    if not filter_text.strip():
+        st.info("Enter at least one condition.")
+        return
+
+    try:
+        value_conditions, change_conditions = parse_filter(filter_text)
+        patients, total = find_cohort(
+            value_conditions,
+            change_conditions,
+            doctor_id=doctor_id if only_mine else None,
+            test_type_id=selected_test_type_id,
+            since=days_ago(last_days) if last_days else None,
+            page=page,
+            page_size=page_size
+        )
+    except ValueError as error:
+        st.error(str(error))
+        return
+
+    st.write(f"{total} matching patients")
+    if patients:
+        st.dataframe([
+            {"National ID": patient[0], "Patient Name": patient[1]}
+            for patient in patients
+        ])
+    elif total:
+        st.info("No patients on this page.")
+
+# Statistics Page
+def statistics_page(doctor_id):
+    """
+    Shows the doctor's workload. Everything is read from the rollup tables, so the cost does not grow with history.
+    The no-show rate covers the last 30 days: past appointments that were neither cancelled nor closed out as a visit.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Retrieved from session state.
+    """
+    st.title("Statistics")
+
+    today = datetime.now().date()
+    week_start = today - timedelta(days=today.weekday())
+    # The five sections are independent, their queries run at the same time
+    totals, daily_counts, weekly_counts, test_type_counts, no_show_counts = load_concurrently(
+        (get_doctor_totals, doctor_id),
+        (get_doctor_daily_appointment_counts, doctor_id, today - timedelta(days=30), today + timedelta(days=15)),
+        (get_doctor_daily_appointment_counts, doctor_id, week_start - timedelta(weeks=11), week_start + timedelta(weeks=1)),
+        (get_doctor_test_type_counts, doctor_id),
+        (get_doctor_no_show_counts, doctor_id, today - timedelta(days=30), today),
+    )
+
+    appointment_count, lab_result_count, medical_record_count, prescription_count, cancelled_count = totals
+    columns = st.columns(5)
+    columns[0].metric("Appointments", appointment_count)
+    columns[1].metric("Cancelled", cancelled_count)
+    columns[2].metric("Lab Results", lab_result_count)
+    columns[3].metric("Medical Records", medical_record_count)
+    columns[4].metric("Prescriptions", prescription_count)
+    if appointment_count + cancelled_count:
+        st.caption(f"Cancellation rate: {cancelled_count / (appointment_count + cancelled_count):.1%}")
+    # Geçmiş randevulardan iptal edilmeyen ve ziyareti kapatılmayanlar gelmeyen hastalar sayılıyor
+    past_appointment_count, no_show_count = no_show_counts
+    if past_appointment_count:
+        st.caption(f"No-show rate, last 30 days: {no_show_count / past_appointment_count:.1%} "
+                   f"({no_show_count} of {past_appointment_count} appointments not closed out as a visit)")
+
+    # Appointments per day, last 30 and next 14 days
+    st.subheader("Appointments per Day")
+    if daily_counts:
+        daily = pd.DataFrame(daily_counts, columns=["Day", "Appointments"]).set_index("Day")
+        st.bar_chart(daily)
+    else:
+        st.info("No appointments in this period.")
+
+    # Patient load per week, last 12 weeks (built from the same daily rollup)
+    st.subheader("Appointments per Week")
+    if weekly_counts:
+        weekly = pd.DataFrame(weekly_counts, columns=["Day", "Appointments"])
+        weekly["Week"] = pd.to_datetime(weekly["Day"]).dt.to_period("W").dt.start_time.dt.strftime("%Y-%m-%d")
+        st.bar_chart(weekly.groupby("Week")["Appointments"].sum())
+    else:
+        st.info("No appointments in this period.")
+
+    st.subheader("Lab Tests Ordered per Type")
+    if test_type_counts:
+        st.dataframe([{"Test Type": test_type, "Count": count} for test_type, count in test_type_counts])
+    else:
+        st.info("No lab tests ordered yet.")
@@ -0,0 +1,131 @@
+"""
+Drug-interaction check of a new prescription against the medicines the patient is taking.
+
+The interactions come from drug_interactions.csv (medicine_a, medicine_b, severity, description, one row per pair,
+names in any spelling). They are loaded once per process into a dict keyed by the pair of catalog MedicineIDs, so a
+check is one hash lookup per pair of medicines. A dataset name that is not in the Medicines catalog yet is keyed by
+its normalized name instead, which is also how a medicine typed as new on the prescription page is looked up. The
+index is rebuilt when the catalog grows (see medicine_catalog.medicine_index).
+"""
+import csv
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from database import normalize_medicine_name
+from medicine_catalog import medicine_index
+from query_func import get_active_medicine_ids
+
+INTERACTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drug_interactions.csv')
+# A prescription counts as being taken for this many days after it was prescribed
+ACTIVE_PRESCRIPTION_DAYS = 90
+SEVERITIES = ('contraindicated', 'major', 'moderate', 'minor')
+
+Interaction = namedtuple('Interaction', ['severity', 'description'])
+Conflict = namedtuple('Conflict', ['medicine', 'other', 'other_is_active', 'severity', 'description'])
+
+
+def load_interactions(path=INTERACTIONS_PATH):
+    """
+    Reads the interaction dataset.
+
+    Returns:
+        list of tuples: (medicine_a, medicine_b, severity, description)
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        rows = [(row['medicine_a'], row['medicine_b'], row['severity'].strip().lower(), row['description'])
+                for row in csv.DictReader(file)]
+    for medicine_a, medicine_b, severity, _ in rows:
+        if severity not in SEVERITIES:
+            raise ValueError(f'Unknown severity {severity!r} for {medicine_a} + {medicine_b} in {path}')
+    return rows
+
+
+class InteractionIndex:
+    """
+    Interaction pairs keyed by frozenset of the two medicine keys: the MedicineID, or the normalized name of a
+    medicine missing from the catalog.
+    """
+    def __init__(self, interactions, medicines):
+        self._pairs = {}
+        self._names = {}
+        for medicine_a, medicine_b, severity, description in interactions:
+            key_a, key_b = self._key(medicines, medicine_a), self._key(medicines, medicine_b)
+            pair = frozenset((key_a, key_b))
+            known = self._pairs.get(pair)
+            # A pair listed twice keeps its most severe entry
+            if known is None or SEVERITIES.index(severity) < SEVERITIES.index(known.severity):
+                self._pairs[pair] = Interaction(severity, description)
+
+    def _key(self, medicines, name):
+        key, name = medicines.lookup(name) or (normalize_medicine_name(name), name)
+        self._names.setdefault(key, name)  # Catalog spelling, shown for the patient's active medicines
+        return key
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def check(self, prescribed, active_ids=()):
+        """
+        Finds the interactions of the prescribed medicines with each other and with the active ones.
+
+        Parameters:
+            prescribed (list of tuples): (MedicineID or None for a medicine not in the catalog, name)
+            active_ids (iterable of int): MedicineIDs the patient is taking, see get_active_medicine_ids.
+
+        Returns:
+            list of Conflict: The most severe first.
+        """
+        keys = [(medicine_id if medicine_id is not None else normalize_medicine_name(name), name)
+                for medicine_id, name in prescribed]
+        prescribed_keys = {key for key, _ in keys}
+        active = [medicine_id for medicine_id in set(active_ids) if medicine_id not in prescribed_keys]
+        pairs = self._pairs
+        conflicts = []
+        for position, (key, name) in enumerate(keys):
+            for other_key, other_name in keys[position + 1:]:
+                interaction = pairs.get(frozenset((key, other_key)))
+                if interaction is not None:
+                    conflicts.append(Conflict(name, other_name, False, *interaction))
+            for other_key in active:
+                interaction = pairs.get(frozenset((key, other_key)))
+                if interaction is not None:
+                    conflicts.append(Conflict(name, self._names[other_key], True, *interaction))
+        conflicts.sort(key=lambda conflict: SEVERITIES.index(conflict.severity))
+        return conflicts
+
+
+_index = None
+_built_for = None
+_lock = threading.Lock()
+
+
+def interaction_index():
+    """
+    The process-wide index, built on first use and rebuilt when the medicine catalog has grown since.
+    """
+    global _index, _built_for
+    medicines = medicine_index()
+    with _lock:
+        if _index is None or _built_for != (id(medicines), medicines.max_id):
+            _index = InteractionIndex(load_interactions(), medicines)
+            _built_for = (id(medicines), medicines.max_id)
+        return _index
+
+
+def check_prescription(patient_id, prescribed, today=None):
+    """
+    Checks a prescription being written for the patient against the medicines prescribed to them in the last
+    ACTIVE_PRESCRIPTION_DAYS days.
+
+    Parameters:
+        patient_id (int): The National ID of the patient.
+        prescribed (list of tuples): (MedicineID or None, name) of each medicine of the new prescription.
+
+    Returns:
+        list of Conflict: The most severe first, empty when nothing interacts.
+    """
+    today = today or datetime.now()
+    since = (today - timedelta(days=ACTIVE_PRESCRIPTION_DAYS)).strftime('%Y-%m-%d')
+    return interaction_index().check(prescribed, get_active_medicine_ids(patient_id, since))
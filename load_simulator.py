@@ -0,0 +1,358 @@
+"""
+Concurrent-session load simulator for capacity planning of the SQLite backend.
+
+Simulated patients and doctors go through the data paths of the pages (appointments_page, patient_page and
+doctor_page), with a think time between page views, from a pool of threads or processes. The report gives the
+throughput, latency percentiles and error rates per action, the 'database is locked' errors, and an estimate of the
+time writes spent waiting for the write lock.
+
+    python load_simulator.py --sessions 500 --duration 60 --mode process --processes 8
+    python load_simulator.py --sessions 50 --think-time 0.5 --patient-share 0.9 --db bench.db
+
+Run it against a copy of the database: the booking sessions insert and cancel real appointments.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+# Page views of a patient session and their weights
+PATIENT_ACTIONS = {
+    'open appointments': 4,
+    'book appointment': 3,
+    'book first available': 1,
+    'cancel appointment': 1,
+    'lab results': 2,
+    'medical records': 2,
+    'prescriptions': 1,
+    'browse doctors': 1,
+}
+# Page views of a doctor session and their weights
+DOCTOR_ACTIONS = {
+    'all appointments': 2,
+    'appointments of a day': 4,
+    'statistics': 2,
+    'patient records': 2,
+}
+WRITE_ACTIONS = {'book appointment', 'book first available', 'cancel appointment'}
+
+
+def _is_locked(error):
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+class Session:
+    """
+    One simulated user. Every method is one page view, calling the same functions as the page does.
+    A page view returns a short reason (str) when it could not do its job, e.g. the slot was taken meanwhile.
+    """
+    def __init__(self, rng, patient_id, doctor_id, specializations, patient_ids):
+        self.rng = rng
+        self.patient_id = patient_id
+        self.doctor_id = doctor_id
+        self.specializations = specializations
+        self.patient_ids = patient_ids
+        self.view = {}  # Cached rows of view_state.refresh_rows, like st.session_state
+        self.roster = None  # The doctor's roster.PatientRoster, loaded once per session like on the doctor pages
+
+    def _days(self):
+        today = datetime.now()
+        return [(today + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(1, 8) if (today + timedelta(days=i)).weekday() < 5]
+
+    def open_appointments(self):
+        from query_func import get_appointments_by_patient
+        from view_state import refresh_rows
+        return refresh_rows(self.view, self.patient_id, ['Appointments'],
+                            lambda ids: get_appointments_by_patient(self.patient_id, ids),
+                            key=lambda appointment: appointment.appointment_id,
+                            sort_key=lambda appointment: appointment.appointment_slot)
+
+    def book_appointment(self):
+        from p_appointment_page import (get_doctor_unavailable_hours, is_patient_time_slot_available,
+                                        is_time_slot_available)
+        from query_func import APPOINTMENT_TIMES, add_appointment, get_all_specializations, get_doctors_by_specialization
+
+        self.open_appointments()
+        get_all_specializations()
+        doctors = get_doctors_by_specialization(self.rng.choice(self.specializations))
+        if not doctors:
+            return 'no doctor'
+        doctor_id = self.rng.choice(doctors)[0]
+        day = self.rng.choice(self._days())
+        unavailable = get_doctor_unavailable_hours(doctor_id, day)
+        available = [hour for hour in APPOINTMENT_TIMES if hour not in unavailable]
+        if not available:
+            return 'day full'
+        appointment_date = f'{day} {self.rng.choice(available)}:00'
+        if not is_time_slot_available(doctor_id, appointment_date):
+            return 'slot taken'  # Booked by another session in the meantime
+        if not is_patient_time_slot_available(self.patient_id, appointment_date):
+            return 'patient busy'
+        add_appointment(self.patient_id, doctor_id, appointment_date, 'load test')
+        return None
+
+    def book_first_available(self):
+        from p_appointment_page import is_time_slot_available
+        from query_func import add_appointment, find_earliest_available_slots
+
+        options = find_earliest_available_slots(self.rng.choice(self.specializations), k=5, days=14,
+                                                patient_id=self.patient_id)
+        if not options:
+            return 'no free slot'
+        appointment_date, doctor_id, _ = self.rng.choice(options)
+        if not is_time_slot_available(doctor_id, appointment_date):
+            return 'slot taken'
+        add_appointment(self.patient_id, doctor_id, appointment_date, 'load test')
+        return None
+
+    def cancel_appointment(self):
+        from query_func import cancel_appointment
+
+        appointments = [appointment for appointment in self.open_appointments()
+                        if appointment.reason == 'load test' and appointment.status == 'active']
+        if not appointments:
+            return 'nothing to cancel'
+        cancel_appointment(self.patient_id, self.rng.choice(appointments).appointment_id)
+        return None
+
+    def lab_results(self):
+        from query_func import get_lab_result_values_by_patient
+        get_lab_result_values_by_patient(self.patient_id)
+
+    def medical_records(self):
+        from query_func import get_medical_record_summaries_by_patient
+        get_medical_record_summaries_by_patient(self.patient_id)
+
+    def prescriptions(self):
+        from query_func import get_prescriptions_by_patient
+        get_prescriptions_by_patient(self.patient_id)
+
+    def browse_doctors(self):
+        from query_func import get_all_specializations, get_doctors_by_specialization
+        get_all_specializations()
+        get_doctors_by_specialization(self.rng.choice(self.specializations))
+
+    def all_appointments(self):
+        from query_func import get_appointments_by_doctor, get_doctor_name_from_id
+        get_doctor_name_from_id(self.doctor_id)
+        get_appointments_by_doctor(self.doctor_id)
+
+    def appointments_of_a_day(self):
+        from database import day_slot_range
+        from query_func import get_appointments_by_doctor_between
+        get_appointments_by_doctor_between(self.doctor_id, *day_slot_range(self.rng.choice(self._days())))
+
+    def statistics(self):
+        from query_func import get_doctor_daily_appointment_counts, get_doctor_test_type_counts, get_doctor_totals
+        today = datetime.now().date()
+        get_doctor_totals(self.doctor_id)
+        get_doctor_daily_appointment_counts(self.doctor_id, today - timedelta(days=30), today + timedelta(days=15))
+        get_doctor_test_type_counts(self.doctor_id)
+
+    def patient_records(self):
+        from query_func import (get_doctor_roster, get_lab_result_values_by_patient,
+                                get_medical_record_summaries_by_patient)
+        from roster import PatientRoster
+        if self.roster is None:
+            self.roster = PatientRoster(get_doctor_roster(self.doctor_id))
+        patient_id = self.rng.choice(self.patient_ids)
+        self.roster.search(str(patient_id))
+        get_lab_result_values_by_patient(patient_id)
+        get_medical_record_summaries_by_patient(patient_id)
+
+
+def _run_session(session, actions, think_time, deadline, samples):
+    names = list(actions)
+    weights = list(actions.values())
+    while time.monotonic() < deadline:
+        action = session.rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        outcome = None
+        try:
+            result = getattr(session, action.replace(' ', '_'))()
+            outcome = result if isinstance(result, str) else None  # Page views return a reason when nothing was done
+        except sqlite3.OperationalError as error:
+            outcome = 'database is locked' if _is_locked(error) else f'error: {error}'
+        except Exception as error:  # Reported, a failing page view must not stop the session
+            outcome = f'error: {type(error).__name__}: {error}'
+        samples.append((action, time.perf_counter() - started, outcome))
+        if think_time:
+            time.sleep(session.rng.expovariate(1 / think_time))
+
+
+def _load_population(db_path):
+    connection = sqlite3.connect(db_path)
+    patient_ids = [row[0] for row in connection.execute('SELECT NationalID FROM Patients')]
+    doctor_ids = [row[0] for row in connection.execute('SELECT DoctorID FROM Doctors')]
+    specializations = [row[0] for row in connection.execute('SELECT Specialization FROM DoctorsSpecializations')]
+    connection.close()
+    return patient_ids, doctor_ids, specializations
+
+
+def run_sessions(sessions, duration, think_time, patient_share, seed, shard_paths=None):
+    """
+    Runs sessions simulated users on threads of this process for duration seconds.
+
+    Returns:
+        list: (action, seconds, outcome) samples, outcome None for a successful page view.
+    """
+    import shard_router
+    if shard_paths:
+        shard_router.configure(shard_paths)
+    # The population comes from the reference shard for doctors and from every shard for patients
+    patient_ids, doctor_ids, specializations = [], [], []
+    for path in shard_router.shard_paths():
+        patients, doctors, names = _load_population(path)
+        patient_ids += patients
+        doctor_ids, specializations = doctors, names
+
+    rng = random.Random(seed)
+    samples = []
+    deadline = time.monotonic() + duration
+    threads = []
+    for index in range(sessions):
+        session_rng = random.Random(rng.random())
+        session = Session(session_rng, session_rng.choice(patient_ids), session_rng.choice(doctor_ids),
+                          specializations, patient_ids)
+        actions = PATIENT_ACTIONS if session_rng.random() < patient_share else DOCTOR_ACTIONS
+        thread = threading.Thread(target=_run_session, args=(session, actions, think_time, deadline, samples),
+                                  daemon=True)
+        threads.append(thread)
+    for thread in threads:
+        thread.start()
+        time.sleep(min(think_time, 1) / max(sessions, 1))  # Staggered logins instead of one thundering herd
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def _run_process(arguments):
+    return run_sessions(*arguments)
+
+
+def simulate(sessions=50, duration=30, think_time=1.0, patient_share=0.8, mode='thread', processes=4, seed=372,
+             shard_paths=None):
+    """
+    Runs the simulation on threads of this process (mode='thread') or split over a pool of processes
+    (mode='process', sessions are divided between them, each process running its share on threads).
+
+    Returns:
+        tuple: (samples, elapsed seconds)
+    """
+    started = time.perf_counter()
+    if mode == 'thread':
+        samples = run_sessions(sessions, duration, think_time, patient_share, seed, shard_paths)
+    else:
+        import multiprocessing
+        shares = [sessions // processes + (1 if index < sessions % processes else 0) for index in range(processes)]
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.map(_run_process, [
+                (share, duration, think_time, patient_share, seed + index, shard_paths)
+                for index, share in enumerate(shares) if share
+            ])
+        samples = [sample for result in results for sample in result]
+    return samples, time.perf_counter() - started
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def summarize(samples, elapsed, baseline_write_seconds=None):
+    """
+    Aggregates the samples per action.
+    Lock wait is estimated as the time successful writes took beyond baseline_write_seconds, the median write time
+    of an uncontended run (SQLite's busy handler is not observable from Python).
+
+    Returns:
+        dict
+    """
+    by_action = defaultdict(list)
+    for sample in samples:
+        by_action[sample[0]].append(sample)
+
+    actions = {}
+    for action, action_samples in sorted(by_action.items()):
+        latencies = sorted(seconds * 1000 for _, seconds, _ in action_samples)
+        outcomes = defaultdict(int)
+        for _, _, outcome in action_samples:
+            if outcome is not None:
+                outcomes[outcome.split(':')[0] if outcome.startswith('error') else outcome] += 1
+        actions[action] = {
+            'count': len(action_samples),
+            'per_second': len(action_samples) / elapsed,
+            'p50': statistics.median(latencies),
+            'p95': _percentile(latencies, 0.95),
+            'p99': _percentile(latencies, 0.99),
+            'max': latencies[-1],
+            'outcomes': dict(outcomes),
+        }
+
+    writes = [seconds for action, seconds, outcome in samples if action in WRITE_ACTIONS and outcome is None]
+    locked = sum(1 for _, _, outcome in samples if outcome == 'database is locked')
+    errors = sum(1 for _, _, outcome in samples if outcome and outcome.startswith('error'))
+    summary = {
+        'elapsed': elapsed,
+        'page_views': len(samples),
+        'per_second': len(samples) / elapsed,
+        'locked': locked,
+        'locked_percent': 100 * locked / len(samples) if samples else 0,
+        'errors': errors,
+        'actions': actions,
+    }
+    if baseline_write_seconds is not None and writes:
+        waits = sorted(max(seconds - baseline_write_seconds, 0) * 1000 for seconds in writes)
+        summary['lock_wait_p50'] = statistics.median(waits)
+        summary['lock_wait_p99'] = _percentile(waits, 0.99)
+        summary['lock_wait_total'] = sum(waits) / 1000
+    return summary
+
+
+def print_summary(summary):
+    print(f"{summary['page_views']} page views in {summary['elapsed']:.1f} s, {summary['per_second']:.1f}/s, "
+          f"'database is locked' {summary['locked']} ({summary['locked_percent']:.2f}%), other errors {summary['errors']}")
+    if 'lock_wait_p50' in summary:
+        print(f"estimated write lock wait: p50 {summary['lock_wait_p50']:.1f} ms, p99 {summary['lock_wait_p99']:.1f} ms, "
+              f"{summary['lock_wait_total']:.1f} s in total")
+    print(f"{'action':<24} {'count':>7} {'/s':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}  outcomes")
+    for action, stats in summary['actions'].items():
+        outcomes = ', '.join(f'{name} {count}' for name, count in stats['outcomes'].items())
+        print(f"{action:<24} {stats['count']:>7} {stats['per_second']:>7.1f} {stats['p50']:>9.2f} {stats['p95']:>9.2f} "
+              f"{stats['p99']:>9.2f} {stats['max']:>9.2f}  {outcomes}")
+
+
+def calibrate_write(shard_paths=None, seed=372):
+    """
+    Median seconds of a booking page view with a single session, the uncontended baseline of the lock wait estimate.
+    """
+    samples = run_sessions(1, 3, 0, 1.0, seed, shard_paths)
+    writes = [seconds for action, seconds, outcome in samples if action in WRITE_ACTIONS and outcome is None]
+    return statistics.median(writes) if writes else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='Database file(s), comma separated shards. Defaults to the configured shards')
+    parser.add_argument('--sessions', type=int, default=50, help='Simultaneous users')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds')
+    parser.add_argument('--think-time', type=float, default=1.0, help='Mean seconds between page views of a user')
+    parser.add_argument('--patient-share', type=float, default=0.8, help='Fraction of the users who are patients')
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--seed', type=int, default=372)
+    args = parser.parse_args()
+
+    shard_paths = [path.strip() for path in args.db.split(',')] if args.db else None
+    baseline = calibrate_write(shard_paths, args.seed)
+    samples, elapsed = simulate(args.sessions, args.duration, args.think_time, args.patient_share,
+                                args.mode, args.processes, args.seed, shard_paths)
+    print_summary(summarize(samples, elapsed, baseline))
+
+
+if __name__ == '__main__':
+    main()
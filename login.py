@@ -1,33 +1,9 @@
 import streamlit as st
-import sqlite3
+from query_func import authenticate_user
 from patient_interface import patient_interface
 from doctor_interface import doctor_interface
 
 
-def get_db_connection():
-    conn = sqlite3.connect('health_monitoring.db')
-    return conn
-
-def authenticate_user(username, password):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-
-    cursor.execute("SELECT NationalID FROM Patients WHERE Username = ? AND Password = ?", (username, password))
-    patient = cursor.fetchone()
-    
-    if patient:
-        conn.close()
-        return patient[0], 'patient'
-    
-    cursor.execute("SELECT DoctorID FROM Doctors WHERE Username = ? AND Password = ?", (username, password))
-    doctor = cursor.fetchone()
-    conn.close()
-    if doctor:
-        return doctor[0], 'doctor'
-
-    return None
-
 def main():
     st.title("Login Page")
     
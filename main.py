@@ -1,9 +1,24 @@
+import os
 import streamlit as st
+from data_service import SOCKET_ENV
 from login import main as login_page
 from doctor_interface import doctor_interface
 from patient_interface import patient_interface
+from database import create_tables, migrate
+from shard_router import shard_paths
+
+@st.cache_resource
+def init_database():
+    # Runs once per server process, brings every database file (shard) up to the current schema
+    if os.environ.get(SOCKET_ENV):
+        return  # The data service migrated the shards when it started
+    for path in shard_paths():
+        create_tables(path)
+        migrate(path)
 
 def main():
+    init_database()
+
     # Check if the user is logged in
     if 'role' not in st.session_state:
         login_page()  # Show the login page if not authenticated
@@ -0,0 +1,108 @@
+"""
+Prefix search over the Medicines catalog for the medicine name autocomplete of add_prescription_page.
+
+The catalog is read once per process into a sorted list of normalized names and searched with bisect, so a keystroke
+costs no query. Medicines added by this process are inserted into the index directly, the ones added by other
+processes are picked up by a reload when the catalog's highest MedicineID has moved (checked at most every
+RELOAD_CHECK_SECONDS).
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from database import display_medicine_name, normalize_medicine_name
+from query_func import get_latest_medicine_id, get_medicine_catalog
+
+RELOAD_CHECK_SECONDS = 60
+
+
+class MedicineIndex:
+    """
+    Sorted (normalized name, MedicineID, name) entries of the catalog.
+    """
+    def __init__(self, medicines=()):
+        self._entries = sorted((normalized, medicine_id, name) for medicine_id, name, normalized in medicines)
+        self._keys = [entry[0] for entry in self._entries]
+        self.max_id = max((entry[1] for entry in self._entries), default=0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, medicine_id, name):
+        normalized = normalize_medicine_name(name)
+        position = bisect_left(self._keys, normalized)
+        if position < len(self._keys) and self._keys[position] == normalized:
+            return
+        insort(self._entries, (normalized, medicine_id, name))
+        self._keys.insert(position, normalized)
+        self.max_id = max(self.max_id, medicine_id)
+
+    def lookup(self, name):
+        """
+        Returns the (MedicineID, catalog name) of a name in any spelling, None when it is not in the catalog.
+        """
+        normalized = normalize_medicine_name(name)
+        position = bisect_left(self._keys, normalized)
+        if position < len(self._keys) and self._keys[position] == normalized:
+            return self._entries[position][1:]
+        return None
+
+    def search(self, prefix, limit=10):
+        """
+        Returns up to limit (MedicineID, name) tuples whose name starts with prefix, ignoring case and extra spaces.
+        """
+        normalized = normalize_medicine_name(prefix)
+        if not normalized:
+            return []
+        results = []
+        for position in range(bisect_left(self._keys, normalized), len(self._keys)):
+            if not self._keys[position].startswith(normalized) or len(results) == limit:
+                break
+            _, medicine_id, name = self._entries[position]
+            results.append((medicine_id, name))
+        return results
+
+
+_index = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _load():
+    return MedicineIndex(get_medicine_catalog())
+
+
+def medicine_index():
+    """
+    The process-wide index, loaded on first use.
+    """
+    global _index, _checked_at
+    with _lock:
+        if _index is None:
+            _index = _load()
+            _checked_at = time.monotonic()
+        elif time.monotonic() - _checked_at > RELOAD_CHECK_SECONDS:
+            _checked_at = time.monotonic()
+            if get_latest_medicine_id() != _index.max_id:
+                _index = _load()
+        return _index
+
+
+def search_medicines(prefix, limit=10):
+    return medicine_index().search(prefix, limit)
+
+
+def remember_medicines(medicine_ids, names):
+    """
+    Adds medicines just created by this process (query_func.add_medicines) to the index.
+
+    Parameters:
+        medicine_ids (dict): normalized name -> MedicineID, as returned by add_medicines.
+        names (list of str): The names as typed.
+    """
+    index = medicine_index()
+    with _lock:
+        for name in names:
+            medicine_id = medicine_ids.get(normalize_medicine_name(name))
+            if medicine_id is not None:
+                index.add(medicine_id, display_medicine_name(name))
@@ -0,0 +1,171 @@
+"""
+Row models returned by the query functions.
+
+Every model is a NamedTuple: it is a tuple (no per-row __dict__, same memory as the plain tuple sqlite3 returns, and
+it still unpacks and indexes like one) whose columns are also attributes, so pages read appointment.reason instead of
+appointment[4]. Each model matches the column list of the query that produces it, one model per use case: a list
+view selects only what the list shows, a detail view every column.
+
+Queries build their rows with row_factory(Model), see query_func.
+"""
+from typing import NamedTuple, Optional
+
+import database
+
+
+def row_factory(model):
+    """
+    sqlite3 row factory building model rows: cursor.row_factory = row_factory(Model).
+    Calls tuple.__new__ directly, skipping the argument checking of the generated __new__ and _make.
+    """
+    def factory(cursor, row, new=tuple.__new__, model=model):
+        return new(model, row)
+    return factory
+
+
+# ** Appointments **
+
+class PatientAppointment(NamedTuple):
+    """
+    A patient's appointment list, get_appointments_by_patient.
+    """
+    appointment_id: int
+    doctor_id: int
+    appointment_date: str
+    reason: Optional[str]
+    appointment_slot: int
+    status: str  # 'active', 'cancelled' or 'completed', see database.APPOINTMENT_STATUSES
+
+
+class Appointment(NamedTuple):
+    """
+    Every column of an appointment, get_appointment.
+    """
+    appointment_id: int
+    patient_id: int
+    doctor_id: int
+    appointment_date: str
+    reason: Optional[str]
+    appointment_slot: int
+    status: str
+    cancelled_at: Optional[str]
+
+
+class DoctorAppointment(NamedTuple):
+    """
+    A doctor's list of active appointments, get_appointments_by_doctor and get_appointments_by_doctor_between.
+    """
+    appointment_id: int
+    patient_name: str
+    appointment_date: str
+    reason: Optional[str]
+
+
+class RosterEntry(NamedTuple):
+    """
+    A patient of a doctor with their latest appointment that is not cancelled, get_doctor_roster.
+    """
+    patient_id: int
+    patient_name: str
+    appointment_id: int
+    appointment_slot: Optional[int]
+
+
+# ** Lab results **
+
+class LabResult(NamedTuple):
+    """
+    Every stored column of a lab result, including the ResultData JSON text, get_lab_results_by_patient.
+    """
+    result_id: int
+    patient_id: int
+    doctor_id: int
+    test_type_id: int
+    result_data: str
+    test_date: str
+    appointment_id: Optional[int]
+
+
+# A lab result list row with the doctor comment and every analyte extracted, get_lab_result_values_by_patient.
+# The analyte fields follow database.TEST_TYPE_ANALYTES, None when the test type has no such analyte.
+LabResultValues = NamedTuple('LabResultValues', [
+    ('result_id', int), ('test_type_id', int), ('test_date', str), ('doctor_comment', Optional[str]),
+] + [(analyte, Optional[float]) for analyte in database.all_analytes()])
+
+
+class TestType(NamedTuple):
+    test_type_id: int
+    test_type: str
+    description: Optional[str]
+
+
+# ** Medical records **
+
+class MedicalRecord(NamedTuple):
+    """
+    A medical record with its doctor's name, get_medical_records_by_patient.
+    """
+    record_id: int
+    diagnosis: str
+    treatment: Optional[str]
+    notes: Optional[str]
+    created_date: str
+    doctor_name: str
+
+
+class MedicalRecordSummary(NamedTuple):
+    """
+    A patient's list of medical records without the treatment and notes, get_medical_record_summaries_by_patient.
+    """
+    record_id: int
+    diagnosis: str
+    created_date: str
+    doctor_name: str
+
+
+# ** Prescriptions **
+
+class Prescription(NamedTuple):
+    """
+    A patient's prescription list, get_prescriptions_by_patient. The medicines are PrescriptionLine rows.
+    """
+    prescription_id: int
+    doctor_id: int
+    appointment_id: Optional[int]
+    prescribed_date: str
+
+
+class PrescriptionLine(NamedTuple):
+    """
+    One medicine of a prescription with its catalog name.
+    """
+    medicine_name: str
+    dosage: str
+    instructions: Optional[str]
+
+
+# ** Doctors **
+
+class Specialization(NamedTuple):
+    specialization_id: int
+    specialization: str
+
+
+class Doctor(NamedTuple):
+    """
+    A doctor as listed to patients, get_doctors_by_specialization.
+    """
+    doctor_id: int
+    first_name: str
+    last_name: str
+    specialization: str
+    contact_info: Optional[str]
+    hire_date: Optional[str]
+
+
+# Models by name, for rebuilding rows that crossed a process boundary (see data_service)
+MODELS = {
+    model.__name__: model
+    for model in [PatientAppointment, Appointment, DoctorAppointment, RosterEntry, LabResult, LabResultValues,
+                  TestType, MedicalRecord, MedicalRecordSummary, Prescription, PrescriptionLine, Specialization, Doctor]
+}
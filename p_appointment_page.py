@@ -1,9 +1,15 @@
 import streamlit as st
 from datetime import datetime, timedelta
+from database import day_slot_range, slot_to_datetime
+from view_state import load_patient_rows
 from query_func import (
+    APPOINTMENT_TIMES,
     add_appointment,
     get_appointments_by_patient,
-    get_appointments_by_doctor,
+    get_doctor_booked_slots,
+    is_doctor_slot_booked,
+    is_patient_slot_booked,
+    find_earliest_available_slots,
     get_doctors_by_specialization,
     get_all_specializations,
     cancel_appointment
@@ -13,48 +19,72 @@ def is_time_slot_available(doctor_id, appointment_date):
     """
     Checks if the selected time slot is available for the doctor.
     """
-    appointments = get_appointments_by_doctor(doctor_id)  # Fetch all appointments for the doctor
-    for appointment in appointments:
-        if appointment[2] == appointment_date:  # Check if the date and time matches
-            return False
-    return True
+    return not is_doctor_slot_booked(doctor_id, appointment_date)  # Single lookup on the active-rows index (DoctorID, AppointmentSlot)
 
 def is_patient_time_slot_available(patient_id, appointment_date):
     """
     Checks if the selected time slot is already booked by the patient.
     """
-    appointments = get_appointments_by_patient(patient_id)  # Fetch all appointments for the patient
-    for appointment in appointments:
-        if appointment[3] == appointment_date:  # Check if the date and time matches
-            return False
-    return True
+    return not is_patient_slot_booked(patient_id, appointment_date)  # Single index lookup on (PatientID, AppointmentSlot)
 
 def get_doctor_unavailable_hours(doctor_id, date):
     """
-    Retrieves the unavailable hours for a doctor on a specific date.
+    Retrieves the unavailable hours ('HH:MM') for a doctor on a specific date.
     """
-    appointments = get_appointments_by_doctor(doctor_id)  # Fetch all appointments for the doctor
-    unavailable_hours = []
-    for appointment in appointments:
-        appointment_date, appointment_time = appointment[2].split(" ")  # Split date and time
-        if appointment_date == date:  # Check if the appointment is on the selected date
-            unavailable_hours.append(appointment_time)  # Add the time to the unavailable list
-    return unavailable_hours
+    start_slot, end_slot = day_slot_range(date)  # Only this day's range of the doctor's slots is read
+    return [slot_to_datetime(slot).strftime("%H:%M") for slot in get_doctor_booked_slots(doctor_id, start_slot, end_slot)]
+
+def first_available_section(patient_id, specialization):
+    """
+    Books the earliest free time with any doctor of the selected specialization.
+    """
+    horizon_days = st.slider("Search the next N days", min_value=1, max_value=42, value=14)
+    options = find_earliest_available_slots(specialization, k=5, days=horizon_days, patient_id=patient_id)
+
+    if not options:
+        st.info("No available times in this period. Please search further ahead.")
+        return
+
+    selected_option = st.selectbox(
+        "Select Appointment",
+        options,
+        format_func=lambda option: f"{option[0][:16]} - Dr. {option[2]}"
+    )
+    reason = st.text_input("Reason for Appointment", key="first-available-reason")
+
+    if st.button("Confirm Appointment", key="first-available-confirm"):
+        appointment_date, doctor_id, _ = selected_option
+
+        # Seçenekler listelendikten sonra dolmuş olabilir
+        if not is_time_slot_available(doctor_id, appointment_date):
+            st.error("The selected time slot is no longer available. Please choose another one.")
+        else:
+            add_appointment(patient_id, doctor_id, appointment_date, reason)
+            st.success("Appointment added successfully!")
+            st.rerun()
 
 def appointments_page(patient_id):
     st.header("Appointments")
 
     # Kullanıcının mevcut randevularını görüntüleme
     st.subheader("My Appointments")
-    appointments = get_appointments_by_patient(patient_id)  # Fetch updated appointments every time
+    # Only appointments changed since the last rerun are re-read
+    appointments = load_patient_rows(
+        "appointments", patient_id, ["Appointments"],
+        lambda ids: get_appointments_by_patient(patient_id, ids),
+        key=lambda appointment: appointment.appointment_id,
+        sort_key=lambda appointment: appointment.appointment_slot
+    )
 
     if appointments:
         for appointment in appointments:
-            st.write(f"**Date:** {appointment[3]}, **Reason:** {appointment[4]}")
+            st.write(f"**Date:** {appointment.appointment_date}, **Reason:** {appointment.reason}, "
+                     f"**Status:** {appointment.status.capitalize()}")
 
-            # Cancel Appointment Butonu
-            if st.button(f"Cancel Appointment {appointment[0]}", key=f"cancel-{appointment[0]}"):
-                cancel_appointment(appointment[0])  # Randevuyu iptal et
+            # Cancel Appointment Butonu, sadece aktif randevular iptal edilebilir
+            if appointment.status == "active" and st.button(f"Cancel Appointment {appointment.appointment_id}",
+                                                            key=f"cancel-{appointment.appointment_id}"):
+                cancel_appointment(patient_id, appointment.appointment_id)  # Randevuyu iptal et
                 st.rerun()
                 st.success("Appointment canceled successfully!")
     else:
@@ -65,13 +95,18 @@ def appointments_page(patient_id):
 
     # Uzmanlık seçimi
     specializations = get_all_specializations()
-    specialization_names = [spec[1] for spec in specializations]
+    specialization_names = [spec.specialization for spec in specializations]
     selected_specialization = st.selectbox("Select Specialization", specialization_names)
 
     if selected_specialization:
+        booking_mode = st.radio("Booking", ["Choose a doctor", "First available"], horizontal=True)
+        if booking_mode == "First available":
+            first_available_section(patient_id, selected_specialization)
+            return
+
         # Uzmanlığa göre doktor seçimi
         doctors = get_doctors_by_specialization(selected_specialization)
-        doctor_options = {f"{doctor[1]} {doctor[2]}": doctor[0] for doctor in doctors}
+        doctor_options = {f"{doctor.first_name} {doctor.last_name}": doctor.doctor_id for doctor in doctors}
         selected_doctor = st.selectbox("Select Doctor", list(doctor_options.keys()))
 
         if selected_doctor:
@@ -85,10 +120,9 @@ def appointments_page(patient_id):
             if selected_date:
                 # Doktorun dolu saatlerini al
                 unavailable_hours = get_doctor_unavailable_hours(doctor_id, selected_date)
-                all_hours = [f"{hour}:00" for hour in range(9, 18)] + [f"{hour}:30" for hour in range(9, 17)]
-                
+
                 # Müsait saatleri filtrele
-                available_hours = [hour for hour in all_hours if hour not in unavailable_hours]
+                available_hours = [hour for hour in APPOINTMENT_TIMES if hour not in unavailable_hours]
 
                 # Eğer tüm saatler doluysa bilgi göster
                 if not available_hours:
@@ -112,6 +146,5 @@ def appointments_page(patient_id):
                                 add_appointment(patient_id, doctor_id, appointment_date, reason)
                                 st.success("Appointment added successfully!")
 
-                                # My Appointments kısmını otomatik olarak güncellemek için çağrılıyor
-                                appointments = get_appointments_by_patient(patient_id)  # Fetch updated appointments
+                                # My Appointments kısmı bir sonraki çalıştırmada değişiklik kaydından güncelleniyor
                                 st.rerun()
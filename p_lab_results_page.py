@@ -1,27 +1,26 @@
 import streamlit as st
-import json
-from query_func import get_lab_results_by_patient
+from query_func import get_lab_result_values_by_patient
+from view_state import load_patient_rows
 
 def lab_results_page(patient_id):
     st.header("My Lab Results")
 
-    # Lab sonuçlarını al
-    lab_results = get_lab_results_by_patient(patient_id)
+    # Lab sonuçlarını al, JSON alanları SQL tarafında ayrıştırılıyor, sadece değişen sonuçlar yeniden okunuyor
+    lab_results = load_patient_rows(
+        "lab_results", patient_id, ["LabResults"],
+        lambda ids: get_lab_result_values_by_patient(patient_id, ids)[1],
+        key=lambda result: result.result_id
+    )
 
     if lab_results:
         for result in lab_results:
-            # [(1, 12345678901, 2, 1, 8, '{"doctor_comment": "iyi iyi", "T1": 14.0, "T2": 123.0}', '2024-11-29 01:01:31')]
             # Randevu sonucu
-            st.subheader(f"Test Date: {result[6]}")  # Test tarihi
-            
-            # Lab result data (JSON formatında)
-            result_data = json.loads(result[5])  # ResultData JSON formatında
-            st.write("Doctor's Comment: ", result_data.get("doctor_comment", "No comment available"))
-            
-            # Eğer test türüne özgü veriler varsa onları yazdır
-            for key, value in result_data.items():
-                if key != "doctor_comment":
+            st.subheader(f"Test Date: {result.test_date}")  # Test tarihi
+            st.write("Doctor's Comment: ", result.doctor_comment or "No comment available")
+
+            # Eğer test türüne özgü veriler varsa onları yazdır (LabResultValues'un analit alanları)
+            for key, value in result._asdict().items():
+                if key not in ("result_id", "test_type_id", "test_date", "doctor_comment") and value is not None:
                     st.write(f"{key}: {value}")
     else:
         st.info("No lab results found for this patient.")
-
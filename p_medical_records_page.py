@@ -1,20 +1,30 @@
 import streamlit as st
-from query_func import get_medical_records_by_patient
+from query_func import get_medical_record_summaries_by_patient, get_medical_records_by_patient
+from view_state import load_patient_rows
 
 def medical_records_page(patient_id):
     st.header("My Medical Records")
 
-    # Hastanın tıbbi kayıtlarını al
-    medical_records = get_medical_records_by_patient(patient_id)
+    # Hastanın tıbbi kayıtlarını al, liste tedavi ve notları okumuyor
+    medical_records = load_patient_rows(
+        "medical_records", patient_id, ["MedicalRecords"],
+        lambda ids: get_medical_record_summaries_by_patient(patient_id, ids),
+        key=lambda record: record.record_id,
+        sort_key=lambda record: record.created_date, reverse=True
+    )
 
     if medical_records:
         for record in medical_records:
-            st.subheader(f"Record ID: {record[0]}")  # Tıbbi kayıt ID'si
-            st.write(f"**Date:** {record[4]}")  # Kayıt tarihi
-            st.write(f"**Doctor Name:** {record[5]}")  # Doktor adı
-            st.write(f"**Diagnosis:** {record[1]}")  # Tanı
-            st.write(f"**Treatment:** {record[2]}")  # Tedavi
-            st.write(f"**Notes:** {record[3]}")  # Notlar
+            st.subheader(f"Record ID: {record.record_id}")  # Tıbbi kayıt ID'si
+            st.write(f"**Date:** {record.created_date}")  # Kayıt tarihi
+            st.write(f"**Doctor Name:** {record.doctor_name}")  # Doktor adı
+            st.write(f"**Diagnosis:** {record.diagnosis}")  # Tanı
+            # Tedavi ve notlar sadece açılan kayıt için okunuyor
+            if st.toggle("Show treatment and notes", key=f"medical_record_{record.record_id}"):
+                details = get_medical_records_by_patient(patient_id, [record.record_id])
+                if details:
+                    st.write(f"**Treatment:** {details[0].treatment}")  # Tedavi
+                    st.write(f"**Notes:** {details[0].notes}")  # Notlar
             st.markdown("---")  # Kayıtlar arasında ayırıcı çizgi
     else:
         st.info("No medical records found for this patient.")
@@ -1,47 +1,32 @@
-import sqlite3
 import streamlit as st
-from query_func import get_prescriptions_by_patient
+from query_func import get_prescription_details_by_id, get_prescriptions_by_patient
+from view_state import load_patient_rows
 
 
-def get_prescription_details_by_id(prescription_id):
-    """
-    Retrieves the details of a specific prescription.
-    
-    Parameters:
-        prescription_id (int): The ID of the prescription to retrieve details for.
-    
-    Returns:
-        list of tuples: Details of the prescription including medicine name, dosage, and instructions.
-    """
-    connection = sqlite3.connect('health_monitoring.db')  # Veritabanı bağlantısı
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT MedicineName, Dosage, Instructions 
-        FROM PrescriptionDetails 
-        WHERE PrescriptionID = ?
-    ''', (prescription_id,))
-    details = cursor.fetchall()
-    connection.close()
-    return details
-
 def prescriptions_page(patient_id):
     st.header("My Prescriptions")
 
-    # Hastanın reçetelerini al
-    prescriptions = get_prescriptions_by_patient(patient_id)
+    # Hastanın reçetelerini detaylarıyla birlikte al, sadece değişen reçeteler yeniden okunuyor
+    prescriptions = load_patient_rows(
+        "prescriptions", patient_id, ["Prescriptions", "PrescriptionDetails"],
+        lambda ids: [
+            (prescription, get_prescription_details_by_id(prescription.prescription_id, patient_id))
+            for prescription in get_prescriptions_by_patient(patient_id, ids)
+        ],
+        key=lambda item: item[0].prescription_id
+    )
 
     if prescriptions:
-        for prescription in prescriptions:
-            st.subheader(f"Prescription Date: {prescription[4]}")  # Reçete tarihi
-            st.write(f"**Prescription ID:** {prescription[0]}")
-            st.write(f"**Doctor ID:** {prescription[2]}")  # Doktor bilgisi
+        for prescription, details in prescriptions:
+            st.subheader(f"Prescription Date: {prescription.prescribed_date}")  # Reçete tarihi
+            st.write(f"**Prescription ID:** {prescription.prescription_id}")
+            st.write(f"**Doctor ID:** {prescription.doctor_id}")  # Doktor bilgisi
 
-            # Reçete detaylarını al ve göster
-            details = get_prescription_details_by_id(prescription[0])
+            # Reçete detaylarını göster
             if details:
                 st.write("**Prescription Details:**")
                 for detail in details:
-                    st.write(f"- **Medicine:** {detail[0]}, **Dosage:** {detail[1]}, **Instructions:** {detail[2]}")
+                    st.write(f"- **Medicine:** {detail.medicine_name}, **Dosage:** {detail.dosage}, **Instructions:** {detail.instructions}")
             else:
                 st.write("No details available for this prescription.")
     else:
@@ -48,14 +48,14 @@ def patient_page(patient_id):
         
         # Tüm uzmanlıkları getir
         specializations = get_all_specializations()
-        specialization_names = [spec[1] for spec in specializations]
+        specialization_names = [spec.specialization for spec in specializations]
         selected_specialization = st.selectbox("Select Specialization", specialization_names)
         
         if selected_specialization:
             doctors = get_doctors_by_specialization(selected_specialization)
             if doctors:
                 for doctor in doctors:
-                    st.write(f"**Name:** {doctor[1]} {doctor[2]}, **Contact Info:** {doctor[4]}, **Hire Date:** {doctor[5]}")
+                    st.write(f"**Name:** {doctor.first_name} {doctor.last_name}, **Contact Info:** {doctor.contact_info}, **Hire Date:** {doctor.hire_date}")
             else:
                 st.info("No doctors found for this specialization.")
 
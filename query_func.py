@@ -1,9 +1,99 @@
+import heapq
+import os
 import sqlite3
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from itertools import islice
 
+import clinical_text
+import database
+import shard_router
+import storage
+from models import (Appointment, Doctor, DoctorAppointment, LabResult, LabResultValues, MedicalRecord,
+                    MedicalRecordSummary, PatientAppointment, Prescription, PrescriptionLine, RosterEntry,
+                    Specialization, TestType, row_factory)
 
-def create_connection():
-    return sqlite3.connect('health_monitoring.db')
+# Bookable appointment times, every 30 minutes from 09:00 to 17:00
+APPOINTMENT_TIMES = [f"{hour:02d}:{minute:02d}" for hour in range(9, 18) for minute in (0, 30) if (hour, minute) != (17, 30)]
+
+_persistent = threading.local()
+
+
+class PersistentConnection(sqlite3.Connection):
+    """
+    Connection kept open for the lifetime of a worker thread: close() from the query functions is ignored.
+    """
+    def close(self):
+        pass
+
+    def close_for_real(self):
+        super().close()
+
+
+def use_persistent_connections():
+    """
+    Makes the query functions reuse one connection per shard in the calling thread instead of opening one per call.
+    Used as the initializer of connection pool threads (see data_service and async_query).
+    """
+    _persistent.connections = {}
+
+
+def close_persistent_connections():
+    connections = getattr(_persistent, 'connections', None) or {}
+    for connection in connections.values():
+        connection.close_for_real()
+    _persistent.connections = None
+
+
+def create_shard_connection(path):
+    """
+    Connection to one shard file, see shard_router.shard_paths. Use create_connection unless querying every shard.
+    """
+    connections = getattr(_persistent, 'connections', None)
+    if connections is None:
+        return storage.configure_connection(sqlite3.connect(path), path)
+    if path not in connections:
+        connections[path] = storage.configure_connection(sqlite3.connect(path, factory=PersistentConnection), path,
+                                                          persistent=True)
+    return connections[path]
+
+
+def create_connection(patient_id=None):
+    """
+    Connection to the shard holding the patient's rows, or to the reference shard (doctors, specializations, test types)
+    when no patient is given. There is a single shard unless sharding is configured, see shard_router.
+    """
+    if patient_id is None:
+        return create_shard_connection(shard_router.reference_path())
+    return create_shard_connection(shard_router.path_for_patient(patient_id))
+
+
+def _query_all_shards(sql, params=(), model=None):
+    """
+    Runs a read query on every shard in parallel and returns the rows of each shard, in shard order.
+    Rows are model rows (see models) when a model is given, plain tuples otherwise.
+    """
+    def query(path):
+        connection = create_shard_connection(path)
+        cursor = connection.cursor()
+        if model is not None:
+            cursor.row_factory = row_factory(model)
+        cursor.execute(sql, params)
+        results = cursor.fetchall()
+        connection.close()
+        return results
+    return shard_router.fan_out(query)
+
+
+def _in_filter(column, values):
+    """
+    Extra WHERE condition restricting column to the given values (e.g. row IDs of an incremental refresh),
+    or nothing if values is None.
+    """
+    if values is None:
+        return '', ()
+    values = list(values)
+    return f" AND {column} IN ({', '.join('?' for _ in values)})", tuple(values)
 
 
 # ** Appointments Page **
@@ -21,56 +111,158 @@ def add_appointment(patient_id, doctor_id, appointment_date, reason):
         appointment_date (str): The date and time of the appointment. Format: 'YYYY-MM-DD HH:MM:SS'
         reason (str): Reason for the appointment.
     """
-    connection = create_connection()
+    # The integer slot key is what every appointment query filters and sorts on, the text is stored canonicalized
+    appointment_slot = database.appointment_slot(appointment_date)
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
     cursor.execute('''
-    INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason)
-    VALUES (?, ?, ?, ?)
-    ''', (patient_id, doctor_id, appointment_date, reason))
+    INSERT INTO Appointments (PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (patient_id, doctor_id, database.slot_to_text(appointment_slot), reason, appointment_slot))
     connection.commit()
     connection.close()
 
 # Patient UI
-def get_appointments_by_patient(national_id):
+def get_appointments_by_patient(national_id, appointment_ids=None):
     """
     Retrieves all appointments for a specific patient.
     
     Parameters:
         national_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        appointment_ids (list of int): Only return these appointments (incremental refresh). None for all.
     
     Returns:
-        list of tuples: All appointments belonging to the patient.
+        list of models.PatientAppointment: All appointments belonging to the patient, cancelled and completed ones
+        included (see the status field).
     """
-    connection = create_connection()
+    id_filter, id_params = _in_filter('AppointmentID', appointment_ids)
+    connection = create_connection(national_id)
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM Appointments WHERE PatientID = ?', (national_id,))
+    cursor.row_factory = row_factory(PatientAppointment)
+    cursor.execute(f'''
+    SELECT AppointmentID, DoctorID, AppointmentDate, Reason, AppointmentSlot, Status FROM Appointments
+    WHERE PatientID = ?{id_filter} ORDER BY AppointmentSlot ASC
+    ''', (national_id,) + id_params)
     results = cursor.fetchall()
     connection.close()
     return results
 
+def get_appointment(appointment_id, patient_id):
+    """
+    Retrieves every column of one appointment.
+
+    Parameters:
+        appointment_id (int): The ID of the appointment.
+        patient_id (int): The National ID of the patient the appointment belongs to, selects the shard.
+
+    Returns:
+        models.Appointment: The appointment, None if there is no such appointment.
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.row_factory = row_factory(Appointment)
+    cursor.execute('''
+    SELECT AppointmentID, PatientID, DoctorID, AppointmentDate, Reason, AppointmentSlot, Status, CancelledAt
+    FROM Appointments
+    WHERE AppointmentID = ?
+    ''', (appointment_id,))
+    result = cursor.fetchone()
+    connection.close()
+    return result
+
 # Doctor UI
 def get_appointments_by_doctor(doctor_id):
     """
-    Retrieves all appointments for a specific doctor. Use it in doctor's appointment page.
+    Retrieves the active (booked, not yet cancelled or completed) appointments of a doctor. Use it in doctor's
+    appointment page.
     
     Parameters:
         doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
     
     Returns:
-        list of tuples: Appointments with patient names and details.
+        list of models.DoctorAppointment: Appointments with patient names and details.
     """
-    connection = create_connection()
-    cursor = connection.cursor()
-    cursor.execute('''
+    # Appointments live on their patient's shard: query every shard and merge the sorted results.
+    # AppointmentDate is stored zero-padded, so it sorts like AppointmentSlot.
+    shard_results = _query_all_shards('''
     SELECT a.AppointmentID, p.FirstName || ' ' || p.LastName AS PatientName, a.AppointmentDate, a.Reason
     FROM Appointments a
     JOIN Patients p ON a.PatientID = p.NationalID
-    WHERE a.DoctorID = ?
-    ORDER BY a.AppointmentDate ASC
-    ''', (doctor_id,))
-    results = cursor.fetchall()
+    WHERE a.DoctorID = ? AND a.Status = 'active'
+    ORDER BY a.AppointmentSlot ASC
+    ''', (doctor_id,), model=DoctorAppointment)
+    return list(heapq.merge(*shard_results, key=lambda appointment: appointment.appointment_date))
+
+# Doctor UI
+def get_appointments_by_doctor_between(doctor_id, start_slot, end_slot):
+    """
+    Retrieves a doctor's active appointments whose slot is in [start_slot, end_slot), e.g. a single day.
+    Same columns as get_appointments_by_doctor, but only the requested range of the index is read.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+        start_slot (int): First slot key of the range, see database.appointment_slot / database.day_slot_range.
+        end_slot (int): Slot key right after the range.
+
+    Returns:
+        list of models.DoctorAppointment: Appointments with patient names and details.
+    """
+    shard_results = _query_all_shards('''
+    SELECT a.AppointmentID, p.FirstName || ' ' || p.LastName AS PatientName, a.AppointmentDate, a.Reason
+    FROM Appointments a
+    JOIN Patients p ON a.PatientID = p.NationalID
+    WHERE a.DoctorID = ? AND a.AppointmentSlot >= ? AND a.AppointmentSlot < ? AND a.Status = 'active'
+    ORDER BY a.AppointmentSlot ASC
+    ''', (doctor_id, start_slot, end_slot), model=DoctorAppointment)
+    return list(heapq.merge(*shard_results, key=lambda appointment: appointment.appointment_date))
+
+# Patient UI
+def get_doctor_booked_slots(doctor_id, start_slot, end_slot):
+    """
+    Retrieves the booked slot keys of a doctor in [start_slot, end_slot). Used to show the available hours of a day.
+    A cancelled appointment frees its slot.
+
+    Returns:
+        list of int: Booked slot keys in ascending order.
+    """
+    shard_results = _query_all_shards('''
+    SELECT AppointmentSlot FROM Appointments
+    WHERE DoctorID = ? AND AppointmentSlot >= ? AND AppointmentSlot < ? AND Status = 'active'
+    ORDER BY AppointmentSlot ASC
+    ''', (doctor_id, start_slot, end_slot))
+    return [row[0] for row in heapq.merge(*shard_results)]
+
+# Patient UI
+def is_doctor_slot_booked(doctor_id, appointment_date):
+    """
+    Checks whether the doctor already has an active appointment at the given time.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor.
+        appointment_date (str): The date and time of the appointment. Format: 'YYYY-MM-DD HH:MM:SS'
+    """
+    shard_results = _query_all_shards('''
+    SELECT 1 FROM Appointments WHERE DoctorID = ? AND AppointmentSlot = ? AND Status = 'active' LIMIT 1
+    ''', (doctor_id, database.appointment_slot(appointment_date)))
+    return any(shard_results)
+
+# Patient UI
+def is_patient_slot_booked(patient_id, appointment_date):
+    """
+    Checks whether the patient already has an active appointment (with any doctor) at the given time.
+
+    Parameters:
+        patient_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        appointment_date (str): The date and time of the appointment. Format: 'YYYY-MM-DD HH:MM:SS'
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT 1 FROM Appointments WHERE PatientID = ? AND AppointmentSlot = ? AND Status = 'active' LIMIT 1
+    ''', (patient_id, database.appointment_slot(appointment_date)))
+    result = cursor.fetchone()
     connection.close()
-    return results
+    return result is not None
 
 # Doctor UI 
 def get_appointment_by_doctor_for_specific_patient(doctor_id, patient_id):
@@ -86,30 +278,84 @@ def get_appointment_by_doctor_for_specific_patient(doctor_id, patient_id):
     Returns:
         list of tuples: Appointments with patient names and details.
     """
-    connection = create_connection()
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
     cursor.execute('''
         SELECT AppointmentID FROM Appointments
-        WHERE PatientID = ? AND DoctorID = ?
-        ORDER BY AppointmentDate DESC LIMIT 1
+        WHERE PatientID = ? AND DoctorID = ? AND Status <> 'cancelled'
+        ORDER BY AppointmentSlot DESC, AppointmentID DESC LIMIT 1
     ''', (patient_id, doctor_id,))
     result = cursor.fetchone()
     connection.close()
     return result[0] if result else None
 
+# Doctor UI
+def get_doctor_roster(doctor_id):
+    """
+    Retrieves every patient of the doctor with their latest appointment that is not cancelled, from the DoctorRoster
+    rollup. Load it once per session and search it in memory, see roster.py.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+
+    Returns:
+        list of models.RosterEntry: One entry per patient, in no particular order.
+    """
+    shard_results = _query_all_shards('''
+    SELECT r.PatientID, p.FirstName || ' ' || p.LastName AS PatientName, r.AppointmentID, r.AppointmentSlot
+    FROM DoctorRoster r
+    JOIN Patients p ON p.NationalID = r.PatientID
+    WHERE r.DoctorID = ?
+    ''', (doctor_id,), model=RosterEntry)
+    return [entry for entries in shard_results for entry in entries]
+
+# Doctor UI
+def get_roster_entry(doctor_id, patient_id):
+    """
+    Retrieves the DoctorRoster entry of one patient, for a patient booked after the doctor's roster was loaded.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor.
+        patient_id (int): The National ID of the patient.
+
+    Returns:
+        models.RosterEntry: None if the patient has no appointment with the doctor.
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.row_factory = row_factory(RosterEntry)
+    cursor.execute('''
+    SELECT r.PatientID, p.FirstName || ' ' || p.LastName AS PatientName, r.AppointmentID, r.AppointmentSlot
+    FROM DoctorRoster r
+    JOIN Patients p ON p.NationalID = r.PatientID
+    WHERE r.DoctorID = ? AND r.PatientID = ?
+    ''', (doctor_id, patient_id))
+    result = cursor.fetchone()
+    connection.close()
+    return result
+
 # Patient UI
-def cancel_appointment(appointment_id):
+def cancel_appointment(patient_id, appointment_id):
     """
-    Cancels (deletes) an appointment by its ID. Get the relevant appointment ID from the get_appointments_by_patient function.
+    Cancels an appointment of a patient: it becomes 'cancelled' and frees its slot, but stays in the patient's history
+    and in the statistics. Get the relevant appointment ID from the get_appointments_by_patient function.
 
     Parameters:
+        patient_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
         appointment_id (int): The ID of the appointment to cancel. Get appointment_id from the get_appointments_by_patient function.
+
+    Returns:
+        bool: True if the appointment was cancelled, False if the patient has no such active appointment.
     """
-    connection = create_connection()
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
-    cursor.execute('DELETE FROM Appointments WHERE AppointmentID = ?', (appointment_id,))
+    cursor.execute('''
+    UPDATE Appointments SET Status = 'cancelled', CancelledAt = CURRENT_TIMESTAMP
+    WHERE AppointmentID = ? AND PatientID = ? AND Status = 'active'
+    ''', (appointment_id, patient_id))
     connection.commit()
     connection.close()
+    return cursor.rowcount > 0
 
 # ** Test Types **
 
@@ -119,11 +365,12 @@ def get_all_test_types():
     Retrieves all defined test types available for lab results.
     
     Returns:
-        list of tuples: All test types available in the system.
+        list of models.TestType: All test types available in the system.
     """
     connection = create_connection()
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM TestTypes')
+    cursor.row_factory = row_factory(TestType)
+    cursor.execute('SELECT TestTypeID, TestType, Description FROM TestTypes')
     results = cursor.fetchall()
     connection.close()
     return results
@@ -171,7 +418,7 @@ def add_lab_result(patient_id, doctor_id, test_type_id, result_data, test_date,
         test_date (str): The date the test was conducted. Format: 'YYYY-MM-DD HH:MM:SS'
         appointment_id (int): The ID of the appointment. Get appointment_id from the get_appointments_by_doctor_for_specific_patient function.
     """
-    connection = create_connection()
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
     cursor.execute('''
     INSERT INTO LabResults (PatientID, DoctorID, TestTypeID, ResultData, TestDate, AppointmentID)
@@ -196,16 +443,93 @@ def get_lab_results_by_patient(national_id):
         national_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
     
     Returns:
-        list of tuples: Lab results belonging to the patient.
+        list of models.LabResult: Lab results belonging to the patient.
     """
-    connection = create_connection()
+    connection = create_connection(national_id)
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM LabResults WHERE PatientID = ?', (national_id,))
+    cursor.row_factory = row_factory(LabResult)
+    # The analyte columns added by add_analyte_columns are derived from ResultData and left out
+    cursor.execute('''
+    SELECT ResultID, PatientID, DoctorID, TestTypeID, ResultData, TestDate, AppointmentID FROM LabResults
+    WHERE PatientID = ?
+    ''', (national_id,))
     results = cursor.fetchall()
     connection.close()
     return results
+
+def _lab_field_expression(field):
+    # Analytes are read from their generated columns, any other key (e.g. doctor_comment) with json_extract
+    if field in database.all_analytes():
+        return database.analyte_column(field), ()
+    return 'json_extract(ResultData, ?)', (f'$.{field}',)
+
+def _select_lab_result_fields(national_id, fields, result_ids, model):
+    expressions = []
+    params = []
+    for field in fields:
+        expression, expression_params = _lab_field_expression(field)
+        expressions.append(expression)
+        params.extend(expression_params)
+    selected = ''.join(f', {expression}' for expression in expressions)
+    id_filter, id_params = _in_filter('ResultID', result_ids)
+
+    connection = create_connection(national_id)
+    cursor = connection.cursor()
+    if model is not None:
+        cursor.row_factory = row_factory(model)
+    cursor.execute(f'SELECT ResultID, TestTypeID, TestDate{selected} FROM LabResults WHERE PatientID = ?{id_filter}',
+                   params + [national_id] + list(id_params))
+    results = cursor.fetchall()
+    connection.close()
+    return results
+
+# Patient UI
+def get_lab_result_fields_by_patient(national_id, fields, result_ids=None):
+    """
+    Retrieves only the requested ResultData fields of a patient's lab results, extracted on the SQL side.
+    Use it instead of get_lab_results_by_patient + json.loads when only some values are needed.
+
+    Parameters:
+        national_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        fields (list of str): ResultData keys to return, e.g. ["doctor_comment", "CRP"].
+        result_ids (list of int): Only return these lab results (incremental refresh). None for all.
+
+    Returns:
+        list of tuples: (ResultID, TestTypeID, TestDate, <one value per field, None if the test has no such field>)
+    """
+    return _select_lab_result_fields(national_id, fields, result_ids, None)
+
+def lab_result_value_fields():
+    """
+    Field names of the values returned by get_lab_result_values_by_patient, in order.
+    """
+    return ["doctor_comment"] + database.all_analytes()
+
+# Patient UI
+def get_lab_result_values_by_patient(national_id, result_ids=None):
+    """
+    Retrieves a patient's lab results with the doctor comment and every analyte value already extracted.
+    Analytes that do not belong to the test type are None.
+
+    Parameters:
+        national_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        result_ids (list of int): Only return these lab results (incremental refresh). None for all.
+
+    Returns:
+        tuple: (field names, list of models.LabResultValues)
+    """
+    fields = lab_result_value_fields()
+    return fields, _select_lab_result_fields(national_id, fields, result_ids, LabResultValues)
 # ** Medical Records Page **
 
+def _insert_medical_record(cursor, patient_id, doctor_id, diagnosis, treatment, notes, created_date, appointment_id):
+    # Treatment and Notes are compressed while a text dictionary is active, see clinical_text
+    encode = clinical_text.encoder(cursor.connection)
+    cursor.execute('''
+    INSERT INTO MedicalRecords (PatientID, DoctorID, Diagnosis, Treatment, Notes, CreatedDate, AppointmentID)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (patient_id, doctor_id, diagnosis, encode(treatment), encode(notes), created_date, appointment_id))
+
 # Doctor UI
 def add_medical_record(patient_id, doctor_id, diagnosis, treatment, notes, created_date, appointment_id):
     """
@@ -220,32 +544,33 @@ def add_medical_record(patient_id, doctor_id, diagnosis, treatment, notes, creat
         created_date (str): The date the record was created. Format: 'YYYY-MM-DD HH:MM:SS'
         appointment_id (int): The ID of the appointment. Get appointment_id from the get_appointments_by_doctor_for_specific_patient function.
     """
-    connection = create_connection()
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
     
-    cursor.execute('''
-    INSERT INTO MedicalRecords (PatientID, DoctorID, Diagnosis, Treatment, Notes, CreatedDate, AppointmentID)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (patient_id, doctor_id, diagnosis, treatment, notes, created_date, appointment_id))
+    _insert_medical_record(cursor, patient_id, doctor_id, diagnosis, treatment, notes, created_date, appointment_id)
     
     connection.commit()
     connection.close()
 
 # Patient UI
-def get_medical_records_by_patient(patient_id):
+def get_medical_records_by_patient(patient_id, record_ids=None):
     """
     Retrieves all medical records for a specific patient, including doctor names.
+    Compressed Treatment and Notes are decoded (see clinical_text), lists use get_medical_record_summaries_by_patient.
     
     Parameters:
         patient_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        record_ids (list of int): Only return these records (incremental refresh). None for all.
     
     Returns:
-        list of tuples: Medical records along with doctor details.
+        list of models.MedicalRecord: Medical records along with doctor details.
     """
-    connection = create_connection()
+    id_filter, id_params = _in_filter('mr.RecordID', record_ids)
+    connection = create_connection(patient_id)
     cursor = connection.cursor()
+    cursor.row_factory = row_factory(MedicalRecord)
     
-    cursor.execute('''
+    cursor.execute(f'''
     SELECT 
         mr.RecordID, 
         mr.Diagnosis, 
@@ -255,10 +580,37 @@ def get_medical_records_by_patient(patient_id):
         d.FirstName || ' ' || d.LastName AS DoctorName
     FROM MedicalRecords AS mr
     INNER JOIN Doctors AS d ON mr.DoctorID = d.DoctorID
-    WHERE mr.PatientID = ?
+    WHERE mr.PatientID = ?{id_filter}
     ORDER BY mr.CreatedDate DESC
-    ''', (patient_id,))
+    ''', (patient_id,) + id_params)
     
+    records = clinical_text.decode_records(connection, cursor.fetchall())
+    connection.close()
+    return records
+
+def get_medical_record_summaries_by_patient(patient_id, record_ids=None):
+    """
+    Retrieves the list view of a patient's medical records: no Treatment and Notes, so they are neither sent nor
+    decompressed (see clinical_text). Read the full records with get_medical_records_by_patient.
+
+    Parameters:
+        patient_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        record_ids (list of int): Only return these records (incremental refresh). None for all.
+
+    Returns:
+        list of models.MedicalRecordSummary: Medical records along with doctor details.
+    """
+    id_filter, id_params = _in_filter('mr.RecordID', record_ids)
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.row_factory = row_factory(MedicalRecordSummary)
+    cursor.execute(f'''
+    SELECT mr.RecordID, mr.Diagnosis, mr.CreatedDate, d.FirstName || ' ' || d.LastName AS DoctorName
+    FROM MedicalRecords AS mr
+    INNER JOIN Doctors AS d ON mr.DoctorID = d.DoctorID
+    WHERE mr.PatientID = ?{id_filter}
+    ORDER BY mr.CreatedDate DESC
+    ''', (patient_id,) + id_params)
     records = cursor.fetchall()
     connection.close()
     return records
@@ -266,10 +618,53 @@ def get_medical_records_by_patient(patient_id):
 # ** Prescriptions Page **
 
 # Doctor UI
-def add_prescription(patient_id, doctor_id, appointment_id, medicines, prescription_date):
+def add_medicines(names):
+    """
+    Adds the medicine names not in the Medicines catalog yet and returns the catalog IDs of all of them.
+    New medicines are created on the reference shard and copied with the same ID to every other shard.
+
+    Parameters:
+        names (list of str): Medicine names as typed, spelling variants of a catalog name are matched to it.
+
+    Returns:
+        dict: Normalized name (database.normalize_medicine_name) -> MedicineID
+    """
+    names = {database.normalize_medicine_name(name): database.display_medicine_name(name) for name in names}
+    names.pop('', None)
+    if not names:
+        return {}
+    placeholders = ', '.join('?' for _ in names)
+    query = f'SELECT MedicineID, Name, NormalizedName FROM Medicines WHERE NormalizedName IN ({placeholders})'
     connection = create_connection()
     cursor = connection.cursor()
+    cursor.execute(query, tuple(names))
+    medicines = cursor.fetchall()
+    known = {row[2] for row in medicines}
+    if len(known) < len(names):
+        # OR IGNORE only for a concurrent insert of the same name, an ignored insert still uses up an ID
+        cursor.executemany('INSERT OR IGNORE INTO Medicines (Name, NormalizedName) VALUES (?, ?)',
+                           [(name, normalized) for normalized, name in names.items() if normalized not in known])
+        connection.commit()
+        cursor.execute(query, tuple(names))
+        medicines = cursor.fetchall()
+    connection.close()
+
+    reference = shard_router.reference_path()
+
+    def replicate(path):
+        if path == reference:
+            return
+        shard_connection = create_shard_connection(path)
+        shard_connection.executemany('INSERT OR IGNORE INTO Medicines (MedicineID, Name, NormalizedName) VALUES (?, ?, ?)',
+                                     medicines)
+        shard_connection.commit()
+        shard_connection.close()
 
+    if len(shard_router.shard_paths()) > 1:
+        shard_router.fan_out(replicate)
+    return {normalized: medicine_id for medicine_id, _, normalized in medicines}
+
+def _insert_prescription(cursor, patient_id, doctor_id, appointment_id, medicines, prescription_date, medicine_ids):
     # Add prescription metadata
     cursor.execute('''
         INSERT INTO Prescriptions (PatientID, DoctorID, AppointmentID, PrescribedDate)
@@ -279,33 +674,185 @@ def add_prescription(patient_id, doctor_id, appointment_id, medicines, prescript
     prescription_id = cursor.lastrowid  # Get the newly created PrescriptionID
 
     # Add medicine details
-    for medicine in medicines:
-        cursor.execute('''
-            INSERT INTO PrescriptionDetails (PrescriptionID, MedicineName, Dosage, Instructions)
-            VALUES (?, ?, ?, ?)
-        ''', (prescription_id, medicine['name'], medicine['dosage'], medicine.get('instructions', '')))
-    
+    cursor.executemany('''
+        INSERT INTO PrescriptionDetails (PrescriptionID, MedicineID, Dosage, Instructions)
+        VALUES (?, ?, ?, ?)
+    ''', [
+        (prescription_id,
+         medicine_ids[database.normalize_medicine_name(medicine['name'])] if medicine.get('medicine_id') is None
+         else medicine['medicine_id'],
+         medicine['dosage'], medicine.get('instructions', ''))
+        for medicine in medicines
+    ])
+    return prescription_id
+
+def add_prescription(patient_id, doctor_id, appointment_id, medicines, prescription_date):
+    """
+    Adds a prescription with its medicine lines.
+
+    Parameters:
+        medicines (list of dict): One dict per line with 'dosage', optional 'instructions' and either the catalog
+            'medicine_id' or the 'name' of the medicine (added to the catalog when new, see add_medicines).
+    """
+    medicine_ids = add_medicines([medicine['name'] for medicine in medicines if medicine.get('medicine_id') is None])
+
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    _insert_prescription(cursor, patient_id, doctor_id, appointment_id, medicines, prescription_date, medicine_ids)
     connection.commit()
     connection.close()
 
+# Doctor UI
+def add_visit(patient_id, doctor_id, appointment_id, lab_results=(), medical_record=None, prescription=None,
+              complete=True):
+    """
+    Closes out a visit: writes its lab results, medical record and prescription in one transaction on the patient's
+    shard, so either all of them are stored or none, with a single commit. New medicine names are added to the
+    catalog first (see add_medicines), a catalog entry left by a failed visit is harmless.
+
+    Parameters:
+        patient_id (int): The National ID of the patient.
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+        appointment_id (int): The appointment of the visit, from the doctor's roster (see roster.py).
+        lab_results (list of dict): One dict per test with 'test_type_id', 'result_data' (JSON string, see
+            add_lab_result) and 'test_date' ('YYYY-MM-DD HH:MM:SS').
+        medical_record (dict): 'diagnosis', 'treatment', 'notes' and 'created_date', None to write no record.
+        prescription (dict): 'medicines' (as for add_prescription) and 'prescribed_date' ('YYYY-MM-DD'), None to
+            write no prescription.
+        complete (bool): Mark the appointment as completed, it leaves the doctor's active appointments.
+
+    Raises:
+        ValueError: The appointment does not exist or was cancelled, nothing is written.
+    """
+    medicines = prescription['medicines'] if prescription else []
+    medicine_ids = add_medicines([medicine['name'] for medicine in medicines if medicine.get('medicine_id') is None])
+
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')  # Takes the write lock up front, the checks below cannot go stale
+        cursor.execute('SELECT Status FROM Appointments WHERE AppointmentID = ? AND PatientID = ?',
+                       (appointment_id, patient_id))
+        status = cursor.fetchone()
+        if status is None or status[0] == 'cancelled':
+            raise ValueError(f'Appointment {appointment_id} of patient {patient_id} does not exist or was cancelled')
+
+        cursor.executemany('''
+        INSERT INTO LabResults (PatientID, DoctorID, TestTypeID, ResultData, TestDate, AppointmentID)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(patient_id, doctor_id, lab_result['test_type_id'], lab_result['result_data'], lab_result['test_date'],
+               appointment_id) for lab_result in lab_results])
+        if medical_record:
+            _insert_medical_record(cursor, patient_id, doctor_id, medical_record['diagnosis'],
+                                   medical_record['treatment'], medical_record.get('notes', ''),
+                                   medical_record['created_date'], appointment_id)
+        if medicines:
+            _insert_prescription(cursor, patient_id, doctor_id, appointment_id, medicines,
+                                 prescription['prescribed_date'], medicine_ids)
+        if complete:
+            cursor.execute("UPDATE Appointments SET Status = 'completed' WHERE AppointmentID = ? AND Status = 'active'",
+                           (appointment_id,))
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+def get_active_medicine_ids(patient_id, since_date):
+    """
+    Retrieves the catalog IDs of the medicines prescribed to the patient on or after since_date, the medicines the
+    patient is taking. One query over idx_prescriptions_patient_date and idx_prescriptiondetails_prescription.
+
+    Parameters:
+        patient_id (int): The National ID of the patient.
+        since_date (str): 'YYYY-MM-DD', prescriptions older than this are considered finished.
+
+    Returns:
+        list of int: MedicineIDs, without duplicates.
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT DISTINCT pd.MedicineID
+        FROM Prescriptions p
+        JOIN PrescriptionDetails pd ON pd.PrescriptionID = p.PrescriptionID
+        WHERE p.PatientID = ? AND p.PrescribedDate >= ?
+    ''', (patient_id, since_date))
+    medicine_ids = [row[0] for row in cursor.fetchall()]
+    connection.close()
+    return medicine_ids
+
 # Patient UI
-def get_prescriptions_by_patient(national_id):
+def get_prescriptions_by_patient(national_id, prescription_ids=None):
     """
     Retrieves all prescriptions for a specific patient.
     
     Parameters:
         national_id (int): The National ID of the patient. Get patient_id from st.session_state.user_id
+        prescription_ids (list of int): Only return these prescriptions (incremental refresh). None for all.
     
     Returns:
-        list of tuples: Prescriptions belonging to the patient.
+        list of models.Prescription: Prescriptions belonging to the patient.
     """
-    connection = create_connection()
+    id_filter, id_params = _in_filter('PrescriptionID', prescription_ids)
+    connection = create_connection(national_id)
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM Prescriptions WHERE PatientID = ?', (national_id,))
+    cursor.row_factory = row_factory(Prescription)
+    cursor.execute(f'''
+    SELECT PrescriptionID, DoctorID, AppointmentID, PrescribedDate FROM Prescriptions WHERE PatientID = ?{id_filter}
+    ''', (national_id,) + id_params)
     results = cursor.fetchall()
     connection.close()
     return results
 
+# Patient UI
+def get_prescription_details_by_id(prescription_id, patient_id):
+    """
+    Retrieves the details of a specific prescription.
+    
+    Parameters:
+        prescription_id (int): The ID of the prescription to retrieve details for.
+        patient_id (int): The National ID of the patient the prescription belongs to, selects the shard.
+    
+    Returns:
+        list of models.PrescriptionLine: Details of the prescription including medicine name, dosage, and instructions.
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.row_factory = row_factory(PrescriptionLine)
+    cursor.execute('''
+        SELECT m.Name, pd.Dosage, pd.Instructions
+        FROM PrescriptionDetails pd
+        JOIN Medicines m ON m.MedicineID = pd.MedicineID
+        WHERE pd.PrescriptionID = ?
+    ''', (prescription_id,))
+    details = cursor.fetchall()
+    connection.close()
+    return details
+
+# Doctor UI, the autocomplete index of medicine_catalog
+def get_medicine_catalog():
+    """
+    Retrieves the whole Medicines catalog.
+
+    Returns:
+        list of tuple: (MedicineID, Name, NormalizedName) of every medicine.
+    """
+    connection = create_connection()
+    medicines = connection.execute('SELECT MedicineID, Name, NormalizedName FROM Medicines').fetchall()
+    connection.close()
+    return medicines
+
+def get_latest_medicine_id():
+    """
+    Returns the highest MedicineID of the catalog, 0 when it is empty. It moves whenever a medicine is added.
+    """
+    connection = create_connection()
+    latest = connection.execute('SELECT MAX(MedicineID) FROM Medicines').fetchone()[0]
+    connection.close()
+    return latest or 0
+
 # ** Specializations **
 
 # Patient UI
@@ -314,11 +861,12 @@ def get_all_specializations():
     Retrieves all specializations available for doctors.
     
     Returns:
-        list of tuples: All doctor specializations.
+        list of models.Specialization: All doctor specializations.
     """
     connection = create_connection()
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM DoctorsSpecializations')
+    cursor.row_factory = row_factory(Specialization)
+    cursor.execute('SELECT SpecializationID, Specialization FROM DoctorsSpecializations')
     results = cursor.fetchall()
     connection.close()
     return results
@@ -334,10 +882,11 @@ def get_doctors_by_specialization(specialization):
         specialization (str): The specialization to filter by (e.g., "Cardiology"). Get specialization from get_all_specializations function.
     
     Returns:
-        list of tuples: Doctors matching the specified specialization.
+        list of models.Doctor: Doctors matching the specified specialization.
     """
     connection = create_connection()
     cursor = connection.cursor()
+    cursor.row_factory = row_factory(Doctor)
 
     cursor.execute('''
     SELECT d.DoctorID, d.FirstName, d.LastName, ds.Specialization, d.ContactInfo, d.HireDate
@@ -351,6 +900,249 @@ def get_doctors_by_specialization(specialization):
     return doctors
 
 
+def _candidate_slots(start, days):
+    """
+    Bookable slot keys of the weekdays in the next `days` days, in ascending order, none before `start`.
+    """
+    first_slot = database.appointment_slot(start)
+    candidates = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        if day.weekday() >= 5:
+            continue
+        day_start, _ = database.day_slot_range(day)
+        for appointment_time in APPOINTMENT_TIMES:
+            hour, minute = appointment_time.split(":")
+            slot = day_start + int(hour) * 60 + int(minute)
+            if slot >= first_slot:
+                candidates.append(slot)
+    return candidates
+
+def _free_slots(doctor_id, candidates, booked):
+    for slot in candidates:
+        if slot not in booked:
+            yield slot, doctor_id
+
+# Patient UI
+def find_earliest_available_slots(specialization, k=5, days=14, patient_id=None, now=None):
+    """
+    Finds the k earliest free appointment times across every doctor of a specialization.
+    Occupancy of all the doctors is read with one range query (per shard), the free slots of each doctor are then merged with a heap,
+    so only as many slots as needed are ever generated.
+
+    Parameters:
+        specialization (str): The specialization to search (e.g., "Cardiology"). Get specialization from get_all_specializations function.
+        k (int): Number of options to return.
+        days (int): How many days ahead to search, starting today.
+        patient_id (int): If given, times at which this patient already has an appointment are skipped.
+        now (datetime): Search start, defaults to the current time.
+
+    Returns:
+        list of tuples: (appointment_date 'YYYY-MM-DD HH:MM:SS', doctor_id, doctor name) in ascending time order.
+    """
+    now = now or datetime.now()
+    candidates = _candidate_slots(now, days)
+    if not candidates:
+        return []
+    start_slot, end_slot = candidates[0], candidates[-1] + 1
+
+    connection = create_connection()
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT d.DoctorID, d.FirstName || ' ' || d.LastName AS DoctorName
+    FROM Doctors d
+    INNER JOIN DoctorsSpecializations ds ON d.SpecializationID = ds.SpecializationID
+    WHERE ds.Specialization = ?
+    ''', (specialization,))
+    doctor_names = dict(cursor.fetchall())
+    connection.close()
+
+    booked = {doctor_id: set() for doctor_id in doctor_names}
+    shard_results = _query_all_shards('''
+    SELECT a.DoctorID, group_concat(a.AppointmentSlot)
+    FROM Appointments a
+    WHERE a.DoctorID IN (
+        SELECT d.DoctorID FROM Doctors d
+        INNER JOIN DoctorsSpecializations ds ON d.SpecializationID = ds.SpecializationID
+        WHERE ds.Specialization = ?
+    ) AND a.AppointmentSlot >= ? AND a.AppointmentSlot < ? AND a.Status = 'active'
+    GROUP BY a.DoctorID
+    ''', (specialization, start_slot, end_slot))
+    for rows in shard_results:
+        for doctor_id, slots in rows:
+            booked[doctor_id].update(int(slot) for slot in slots.split(","))
+
+    if patient_id is not None:
+        connection = create_connection(patient_id)
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT AppointmentSlot FROM Appointments
+        WHERE PatientID = ? AND AppointmentSlot >= ? AND AppointmentSlot < ? AND Status = 'active'
+        ''', (patient_id, start_slot, end_slot))
+        patient_booked = {row[0] for row in cursor.fetchall()}
+        connection.close()
+        candidates = [slot for slot in candidates if slot not in patient_booked]
+
+    merged = heapq.merge(*(_free_slots(doctor_id, candidates, slots) for doctor_id, slots in booked.items()))
+    return [
+        (database.slot_to_text(slot), doctor_id, doctor_names[doctor_id])
+        for slot, doctor_id in islice(merged, k)
+    ]
+
+
+# ** Change Feed **
+
+# Patient UI
+def get_change_feed_position(patient_id):
+    """
+    Retrieves the current position of the change feed, read it before loading a full history.
+
+    Parameters:
+        patient_id (int): The National ID of the patient.
+
+    Returns:
+        tuple: (latest sequence number, highest sequence number removed by compaction)
+    """
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT (SELECT seq FROM sqlite_sequence WHERE name = 'ChangeLog'),
+           (SELECT CompactedThroughSeq FROM ChangeLogCompaction WHERE ID = 1)
+    ''')
+    latest_seq, compacted_through_seq = cursor.fetchone()
+    connection.close()
+    return latest_seq or 0, compacted_through_seq or 0
+
+# Patient UI
+def get_changes_since(patient_id, since_seq, tables=None):
+    """
+    Retrieves the changes made to a patient's rows after a sequence number.
+    If since_seq is below the compacted position (see get_change_feed_position) changes may be missing and
+    the caller has to reload everything instead.
+
+    Parameters:
+        patient_id (int): The National ID of the patient.
+        since_seq (int): Last sequence number the caller has already applied.
+        tables (list of str): Only return changes of these tables. None for all.
+
+    Returns:
+        list of tuples: (Seq, TableName, RowID, Operation) in sequence order, Operation is 'I', 'U' or 'D'.
+    """
+    table_filter, table_params = _in_filter('TableName', tables)
+    connection = create_connection(patient_id)
+    cursor = connection.cursor()
+    cursor.execute(f'''
+    SELECT Seq, TableName, RowID, Operation FROM ChangeLog
+    WHERE PatientID = ? AND Seq > ?{table_filter}
+    ORDER BY Seq ASC
+    ''', (patient_id, since_seq) + table_params)
+    results = cursor.fetchall()
+    connection.close()
+    return results
+
+
+# ** Doctor Statistics **
+
+# Doctor UI
+def get_doctor_totals(doctor_id):
+    """
+    Retrieves the doctor's all-time totals from the DoctorTotals rollup.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+
+    Returns:
+        tuple: (AppointmentCount, LabResultCount, MedicalRecordCount, PrescriptionCount, CancelledAppointmentCount).
+            AppointmentCount counts the active and completed appointments, cancelled ones are counted apart.
+    """
+    # Every shard keeps rollups of its own rows, a doctor's totals are the sum over the shards
+    shard_results = _query_all_shards('''
+    SELECT AppointmentCount, LabResultCount, MedicalRecordCount, PrescriptionCount, CancelledAppointmentCount
+    FROM DoctorTotals WHERE DoctorID = ?
+    ''', (doctor_id,))
+    totals = [0, 0, 0, 0, 0]
+    for rows in shard_results:
+        for row in rows:
+            totals = [total + count for total, count in zip(totals, row)]
+    return tuple(totals)
+
+# Doctor UI
+def get_doctor_daily_appointment_counts(doctor_id, start_day, end_day):
+    """
+    Retrieves the doctor's number of appointments per day from the DoctorDailyAppointments rollup.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+        start_day (date): First day of the range.
+        end_day (date): Day right after the range.
+
+    Returns:
+        list of tuples: (date 'YYYY-MM-DD', AppointmentCount) for the days with at least one appointment.
+    """
+    start = database.day_slot_range(start_day)[0] // database.MINUTES_PER_DAY
+    end = database.day_slot_range(end_day)[0] // database.MINUTES_PER_DAY
+    shard_results = _query_all_shards('''
+    SELECT Day, AppointmentCount FROM DoctorDailyAppointments
+    WHERE DoctorID = ? AND Day >= ? AND Day < ? AND AppointmentCount > 0
+    ORDER BY Day ASC
+    ''', (doctor_id, start, end))
+    counts = {}
+    for day, count in heapq.merge(*shard_results):
+        counts[day] = counts.get(day, 0) + count
+    return [
+        (database.slot_to_datetime(day * database.MINUTES_PER_DAY).strftime('%Y-%m-%d'), count)
+        for day, count in counts.items()
+    ]
+
+# Doctor UI
+def get_doctor_no_show_counts(doctor_id, start_day, end_day):
+    """
+    Counts the doctor's no-shows from the DoctorDailyAppointments rollup: appointments that were neither cancelled
+    nor closed out as a visit (add_visit marks them completed). Only meaningful for days that are over.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+        start_day (date): First day of the range.
+        end_day (date): Day right after the range, at most today.
+
+    Returns:
+        tuple: (AppointmentCount, NoShowCount) of the range, cancelled appointments are not counted.
+    """
+    start = database.day_slot_range(start_day)[0] // database.MINUTES_PER_DAY
+    end = database.day_slot_range(end_day)[0] // database.MINUTES_PER_DAY
+    shard_results = _query_all_shards('''
+    SELECT COALESCE(SUM(AppointmentCount), 0), COALESCE(SUM(AppointmentCount - CompletedCount), 0)
+    FROM DoctorDailyAppointments
+    WHERE DoctorID = ? AND Day >= ? AND Day < ?
+    ''', (doctor_id, start, end))
+    appointment_count = sum(rows[0][0] for rows in shard_results)
+    no_show_count = sum(rows[0][1] for rows in shard_results)
+    return appointment_count, no_show_count
+
+# Doctor UI
+def get_doctor_test_type_counts(doctor_id):
+    """
+    Retrieves how many lab results of each test type the doctor has ordered, from the DoctorTestTypeCounts rollup.
+
+    Parameters:
+        doctor_id (int): The ID of the doctor. Get doctor_id from st.session_state.user_id
+
+    Returns:
+        list of tuples: (TestType, ResultCount)
+    """
+    shard_results = _query_all_shards('''
+    SELECT tt.TestType, c.ResultCount
+    FROM DoctorTestTypeCounts c
+    INNER JOIN TestTypes tt ON c.TestTypeID = tt.TestTypeID
+    WHERE c.DoctorID = ? AND c.ResultCount > 0
+    ''', (doctor_id,))
+    counts = {}
+    for rows in shard_results:
+        for test_type, count in rows:
+            counts[test_type] = counts.get(test_type, 0) + count
+    return sorted(counts.items(), key=lambda item: item[1], reverse=True)
+
+
 # Doctor UI
 def get_doctor_name_from_id(doctor_id):
     """
@@ -372,3 +1164,51 @@ def get_doctor_name_from_id(doctor_id):
     result = cursor.fetchone()
     connection.close()
     return result[0] if result else None
+
+# ** Login **
+
+def authenticate_user(username, password):
+    """
+    Finds the patient or doctor with these credentials.
+
+    Returns:
+        tuple: (NationalID, 'patient') or (DoctorID, 'doctor'), None when nobody matches.
+    """
+    # Patients are spread over the shards, only the username is known here so every shard is asked
+    def find_patient(path):
+        connection = create_shard_connection(path)
+        patient = connection.execute('SELECT NationalID FROM Patients WHERE Username = ? AND Password = ?',
+                                     (username, password)).fetchone()
+        connection.close()
+        return patient
+
+    for patient in shard_router.fan_out(find_patient):
+        if patient:
+            return patient[0], 'patient'
+
+    connection = create_connection()
+    doctor = connection.execute('SELECT DoctorID FROM Doctors WHERE Username = ? AND Password = ?',
+                                (username, password)).fetchone()
+    connection.close()
+    if doctor:
+        return doctor[0], 'doctor'
+    return None
+
+# ** Patient Cohorts **
+
+# Doctor UI
+def find_cohort(value_conditions=(), change_conditions=(), doctor_id=None, test_type_id=None,
+                since=None, until=None, page=1, page_size=20):
+    """
+    cohort_query.find_cohort as a query function, so that the data service runs it. See there for the parameters.
+    """
+    import cohort_query  # cohort_query uses this module's connections
+    return cohort_query.find_cohort(value_conditions, change_conditions, doctor_id, test_type_id, since, until,
+                                    page, page_size)
+
+
+# Drop-in client mode: with HEALTH_MONITORING_DATA_SERVICE set to the socket of a running data service,
+# every public query function of this module is replaced by a stub calling the service (see data_service).
+if os.environ.get('HEALTH_MONITORING_DATA_SERVICE'):
+    import data_service
+    data_service.install_client(globals(), os.environ['HEALTH_MONITORING_DATA_SERVICE'])
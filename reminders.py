@@ -0,0 +1,267 @@
+"""
+Appointment reminder job.
+
+Every run sends a reminder for each appointment starting within the next lead minutes that has not been reminded
+yet, joined with the patient's ContactInfo, in batches to a sink:
+
+    python reminders.py run [--lead 1440] [--sink file --directory reminders/]
+    python reminders.py schedule --every 60           (runs every 60 seconds until stopped)
+    python reminders.py status
+
+A run only reads the appointments that are new since the previous one, so it is cheap to run every minute:
+    - the window between the previous run's upper bound and now + lead, a range scan on
+      idx_appointments_slot_active;
+    - appointments booked since the previous run into the part of the window already covered, a range scan on
+      AppointmentID (IDs only grow).
+The bounds are kept per job and per shard in ReminderWatermarks (see database.create_reminder_watermarks). They are
+recorded as pending before sending, together with the AppointmentIDs of every batch (ReminderBatches), and become
+the watermark once every batch is sent. A run that dies halfway is redone from the recorded batches on the next run,
+so a batch ID always stands for the same appointments however the table changed in between. Sinks ignore a batch
+ID they already have, which makes delivery exactly-once.
+
+Only active appointments are reminded; one cancelled after its run was planned is left out of the batches not sent
+yet. Appointments moved to another slot after their window was covered are not reminded again, and one cancelled
+after its reminder was sent gets no notice from this job.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime
+from itertools import groupby
+
+import database
+import shard_router
+from query_func import create_shard_connection
+
+DEFAULT_JOB = 'reminders'
+DEFAULT_LEAD_MINUTES = 24 * 60
+BATCH_SIZE = 500
+REMINDER_DIR = 'reminders'
+
+Reminder = namedtuple('Reminder', [
+    'appointment_id', 'appointment_date', 'patient_id', 'first_name', 'last_name', 'contact_info', 'doctor_name',
+    'reason',
+])
+
+_PLAN_QUERY = '''
+    SELECT a.AppointmentID FROM Appointments a
+    WHERE {condition}
+    ORDER BY {order}
+'''
+# Appointments starting in (from slot, to slot], booked up to the planned AppointmentID
+_WINDOW_QUERY = _PLAN_QUERY.format(
+    condition="a.AppointmentSlot > ? AND a.AppointmentSlot <= ? AND a.AppointmentID <= ? AND a.Status = 'active'",
+    order='a.AppointmentSlot, a.AppointmentID',
+)
+# Appointments booked since the previous run that start in the already covered part of the window. The unary +
+# keeps SQLite on the AppointmentID range, which holds a minute's worth of bookings, rather than the slot index.
+_LATE_QUERY = _PLAN_QUERY.format(
+    condition="a.AppointmentID > ? AND a.AppointmentID <= ? AND +a.AppointmentSlot > ? AND +a.AppointmentSlot <= ? "
+              "AND a.Status = 'active'",
+    order='a.AppointmentID',
+)
+# The reminders of the planned batches, in batch order
+_BATCH_QUERY = '''
+    SELECT b.BatchNumber, a.AppointmentID, a.AppointmentDate, a.PatientID, p.FirstName, p.LastName, p.ContactInfo,
+           d.FirstName || ' ' || d.LastName, a.Reason
+    FROM ReminderBatches b
+    JOIN Appointments a ON a.AppointmentID = b.AppointmentID
+    JOIN Patients p ON p.NationalID = a.PatientID
+    LEFT JOIN Doctors d ON d.DoctorID = a.DoctorID
+    WHERE b.Job = ? AND a.Status = 'active'
+    ORDER BY b.Position
+'''
+
+
+class FileSink:
+    """
+    Writes every batch to <directory>/<batch ID>.jsonl, one reminder per line. A batch file is written under a
+    temporary name and renamed, so it is either complete or absent, and an existing batch is not written again.
+    """
+    def __init__(self, directory=REMINDER_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, batch_id, reminders):
+        path = os.path.join(self.directory, f'{batch_id}.jsonl')
+        if os.path.exists(path):
+            return False
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            for reminder in reminders:
+                file.write(json.dumps(reminder._asdict(), ensure_ascii=False) + '\n')
+        os.replace(path + '.tmp', path)
+        return True
+
+
+class StubSink:
+    """
+    Keeps the batches in memory (or only counts them with keep=False), for tests and benchmarks.
+    """
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.batches = {}
+        self.reminder_count = 0
+
+    def send(self, batch_id, reminders):
+        if batch_id in self.batches:
+            return False
+        self.batches[batch_id] = list(reminders) if self.keep else len(reminders)
+        self.reminder_count += len(reminders)
+        return True
+
+
+def _plan(connection, job, now_slot, lead_minutes):
+    """
+    Returns the bounds of the run to do on one shard: the pending ones of an unfinished run, or new ones whose
+    batches are recorded in ReminderBatches before anything is sent.
+
+    Returns:
+        tuple: (watermark slot, watermark AppointmentID, from slot, to slot, to AppointmentID)
+    """
+    connection.execute('BEGIN IMMEDIATE')  # Two runners of the same job plan one after the other
+    row = connection.execute('''
+        SELECT Slot, AppointmentID, PendingFromSlot, PendingSlot, PendingAppointmentID FROM ReminderWatermarks
+        WHERE Job = ?
+    ''', (job,)).fetchone()
+    if row is None:
+        # First run: nothing before now needs a reminder
+        row = (now_slot, 0, None, None, None)
+        connection.execute('INSERT INTO ReminderWatermarks (Job, Slot, AppointmentID) VALUES (?, ?, ?)',
+                           (job, now_slot, 0))
+    watermark_slot, watermark_id, from_slot, to_slot, to_id = row
+    if to_slot is None:
+        latest_id = connection.execute('SELECT MAX(AppointmentID) FROM Appointments').fetchone()[0] or 0
+        from_slot, to_slot, to_id = now_slot, max(now_slot + lead_minutes, watermark_slot), max(latest_id, watermark_id)
+        connection.execute('''
+            UPDATE ReminderWatermarks SET PendingFromSlot = ?, PendingSlot = ?, PendingAppointmentID = ?,
+                                          UpdatedAt = CURRENT_TIMESTAMP
+            WHERE Job = ?
+        ''', (from_slot, to_slot, to_id, job))
+    # A run left pending before ReminderBatches existed has no batches recorded, it is planned like a new one
+    if connection.execute('SELECT 1 FROM ReminderBatches WHERE Job = ? LIMIT 1', (job,)).fetchone() is None:
+        appointment_ids = []
+        if watermark_id < to_id and from_slot < watermark_slot:
+            appointment_ids += connection.execute(_LATE_QUERY, (watermark_id, to_id, from_slot, watermark_slot))
+        appointment_ids += connection.execute(_WINDOW_QUERY, (max(watermark_slot, from_slot), to_slot, to_id))
+        connection.executemany('''
+            INSERT INTO ReminderBatches (Job, Position, BatchNumber, AppointmentID) VALUES (?, ?, ?, ?)
+        ''', ((job, position, position // BATCH_SIZE, appointment_id)
+              for position, (appointment_id,) in enumerate(appointment_ids)))
+    connection.commit()
+    return watermark_slot, watermark_id, from_slot, to_slot, to_id
+
+
+def run_shard(path, shard, sink, job=DEFAULT_JOB, lead_minutes=DEFAULT_LEAD_MINUTES, now=None):
+    """
+    Sends the reminders due on one shard and moves its watermark.
+
+    Returns:
+        dict: reminders and batches sent, batches skipped because the sink already had them.
+    """
+    now_slot = database.appointment_slot(now or datetime.now())
+    stats = {'reminders': 0, 'batches': 0, 'skipped_batches': 0}
+    connection = create_shard_connection(path)
+    try:
+        watermark_slot, watermark_id, from_slot, to_slot, to_id = _plan(connection, job, now_slot, lead_minutes)
+        # The bounds and the recorded batch numbers name the batches, a rerun of an unfinished run sends the same ones
+        batch_prefix = f'{job}-{shard}-{watermark_slot}-{watermark_id}-{from_slot}-{to_slot}-{to_id}'
+        for batch_number, rows in groupby(connection.execute(_BATCH_QUERY, (job,)), key=lambda row: row[0]):
+            reminders = [Reminder(*row[1:]) for row in rows]
+            if sink.send(f'{batch_prefix}-{batch_number:05d}', reminders):
+                stats['batches'] += 1
+                stats['reminders'] += len(reminders)
+            else:
+                stats['skipped_batches'] += 1
+        connection.execute('DELETE FROM ReminderBatches WHERE Job = ?', (job,))
+        connection.execute('''
+            UPDATE ReminderWatermarks SET Slot = PendingSlot, AppointmentID = PendingAppointmentID,
+                                          PendingFromSlot = NULL, PendingSlot = NULL, PendingAppointmentID = NULL,
+                                          UpdatedAt = CURRENT_TIMESTAMP
+            WHERE Job = ?
+        ''', (job,))
+        connection.commit()
+    finally:
+        connection.close()
+    return stats
+
+
+def run_once(sink, job=DEFAULT_JOB, lead_minutes=DEFAULT_LEAD_MINUTES, now=None):
+    """
+    Sends the reminders due on every shard, one shard after the other (sinks need not be thread safe).
+
+    Returns:
+        dict: Totals of run_shard plus the seconds taken.
+    """
+    started = time.perf_counter()
+    totals = {'reminders': 0, 'batches': 0, 'skipped_batches': 0}
+    for shard, path in enumerate(shard_router.shard_paths()):
+        for key, value in run_shard(path, shard, sink, job, lead_minutes, now).items():
+            totals[key] += value
+    totals['seconds'] = time.perf_counter() - started
+    return totals
+
+
+def watermarks(job=DEFAULT_JOB):
+    """
+    Returns the ReminderWatermarks row of the job on every shard, in shard order (None where it never ran).
+    """
+    def read(path):
+        connection = create_shard_connection(path)
+        row = connection.execute('SELECT * FROM ReminderWatermarks WHERE Job = ?', (job,)).fetchone()
+        connection.close()
+        return row
+
+    return shard_router.fan_out(read)
+
+
+def run_schedule(every_seconds, sink, job=DEFAULT_JOB, lead_minutes=DEFAULT_LEAD_MINUTES):
+    """
+    Runs the job every every_seconds seconds until interrupted. A failed run is reported and redone by the next one.
+    """
+    while True:
+        started = time.monotonic()
+        try:
+            stats = run_once(sink, job, lead_minutes)
+            if stats['reminders']:
+                print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {stats['reminders']} reminder(s) in {stats['batches']} batch(es)")
+        except (OSError, sqlite3.Error) as error:
+            print(f'{datetime.now():%Y-%m-%d %H:%M:%S} reminder run failed: {error}')
+        time.sleep(max(every_seconds - (time.monotonic() - started), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--job', default=DEFAULT_JOB)
+    parser.add_argument('--lead', type=int, default=DEFAULT_LEAD_MINUTES, help='Minutes before the appointment')
+    parser.add_argument('--sink', choices=['file', 'stub'], default='file')
+    parser.add_argument('--directory', default=REMINDER_DIR, help='Where the file sink writes the batches')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run')
+    schedule_parser = commands.add_parser('schedule')
+    schedule_parser.add_argument('--every', type=float, default=60, help='Seconds between runs')
+    commands.add_parser('status')
+    args = parser.parse_args()
+
+    sink = FileSink(args.directory) if args.sink == 'file' else StubSink()
+    if args.command == 'run':
+        stats = run_once(sink, args.job, args.lead)
+        print(f"{stats['reminders']} reminder(s) in {stats['batches']} batch(es), {stats['seconds']:.2f} s")
+    elif args.command == 'schedule':
+        try:
+            run_schedule(args.every, sink, args.job, args.lead)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'status':
+        for path, row in zip(shard_router.shard_paths(), watermarks(args.job)):
+            if row is None:
+                print(f'{path}: never ran')
+            else:
+                pending = f', pending up to {database.slot_to_text(row[4])}' if row[4] is not None else ''
+                print(f'{path}: sent up to {database.slot_to_text(row[1])} / AppointmentID {row[2]}{pending}')
+
+
+if __name__ == '__main__':
+    main()
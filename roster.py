@@ -0,0 +1,128 @@
+"""
+Patient search of the doctor pages that add rows for a patient (lab results, medical records, prescriptions).
+
+A doctor's patients are read once per session from the DoctorRoster rollup (see database.ROLLUP_TABLES) into a
+PatientRoster kept in st.session_state. Searching by name or National ID prefix is a bisect over sorted keys, and the
+selected entry already holds the appointment the new rows are linked to, so a widget change costs no query.
+A National ID missing from the roster (a patient booked after it was loaded) is looked up once with get_roster_entry
+and added. The roster is reloaded after ROSTER_MAX_AGE_SECONDS or when the doctor asks for it.
+
+The cached appointment may have been cancelled or superseded by a later booking since the roster was loaded, so the
+pages re-read the entry with current_entry before writing rows linked to it.
+"""
+import time
+from bisect import bisect_left, insort
+
+import streamlit as st
+
+from query_func import get_doctor_roster, get_roster_entry
+
+ROSTER_MAX_AGE_SECONDS = 300
+
+
+# Turkish dotless ı and dotted İ (casefolded to i and a combining dot) both match a plain i
+_TURKISH_I = str.maketrans({'ı': 'i', '\u0307': None})
+
+
+def normalize_name(name):
+    return ' '.join(name.split()).casefold().translate(_TURKISH_I)
+
+
+class PatientRoster:
+    """
+    A doctor's roster entries by PatientID, plus sorted (search key, PatientID) pairs: the National ID, the full
+    name and every later word of the name, so "yil", "yıl" and "YIL" all find "Ahmet Yılmaz".
+    """
+    def __init__(self, entries=()):
+        self._entries = {entry.patient_id: entry for entry in entries}
+        self._keys = sorted((key, patient_id) for patient_id, entry in self._entries.items()
+                            for key in self._search_keys(entry))
+        self.unknown_ids = set()  # National IDs already looked up and not found
+
+    @staticmethod
+    def _search_keys(entry):
+        words = normalize_name(entry.patient_name).split(' ')
+        return [str(entry.patient_id)] + [' '.join(words[position:]) for position in range(len(words))]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, patient_id):
+        return self._entries.get(patient_id)
+
+    def add(self, entry):
+        if entry.patient_id not in self._entries:
+            for key in self._search_keys(entry):
+                insort(self._keys, (key, entry.patient_id))
+        self._entries[entry.patient_id] = entry
+
+    def remove(self, patient_id):
+        entry = self._entries.pop(patient_id, None)
+        if entry is not None:
+            self._keys = [pair for pair in self._keys if pair[1] != patient_id]
+
+    def search(self, text, limit=20):
+        """
+        Returns up to limit entries whose National ID or a word of whose name starts with text, ignoring case and
+        the dots of the Turkish i.
+        """
+        prefix = normalize_name(text)
+        if not prefix:
+            return []
+        found = {}
+        for position in range(bisect_left(self._keys, (prefix,)), len(self._keys)):
+            key, patient_id = self._keys[position]
+            if not key.startswith(prefix) or len(found) == limit:
+                break
+            found.setdefault(patient_id, self._entries[patient_id])
+        return list(found.values())
+
+
+def doctor_roster(doctor_id, reload=False):
+    """
+    The doctor's roster kept in st.session_state, loaded on first use, when older than ROSTER_MAX_AGE_SECONDS and
+    when reload is set.
+    """
+    cached = st.session_state.get("doctor_roster")
+    if reload or cached is None or cached[0] != doctor_id or time.monotonic() - cached[1] > ROSTER_MAX_AGE_SECONDS:
+        cached = (doctor_id, time.monotonic(), PatientRoster(get_doctor_roster(doctor_id)))
+        st.session_state["doctor_roster"] = cached
+    return cached[2]
+
+
+def current_entry(doctor_id, patient_id):
+    """
+    Re-reads one patient's roster entry from the database, bypassing the session's roster, and updates the roster
+    with it.
+
+    Returns:
+        models.RosterEntry: The patient's latest appointment that is not cancelled, None if there is none any more.
+    """
+    entry = get_roster_entry(doctor_id, patient_id)
+    roster = doctor_roster(doctor_id)
+    if entry is None:
+        roster.remove(patient_id)
+    else:
+        roster.add(entry)
+    return entry
+
+
+def find_patients(doctor_id, text, limit=20):
+    """
+    Roster entries matching a name or National ID prefix. A whole National ID that matches nothing is looked up in
+    the database once, then remembered either way.
+
+    Returns:
+        list of models.RosterEntry: The matching patients with their latest appointment.
+    """
+    roster = doctor_roster(doctor_id)
+    matches = roster.search(text, limit)
+    national_id = text.strip()
+    if not matches and national_id.isdigit() and int(national_id) not in roster.unknown_ids:
+        entry = get_roster_entry(doctor_id, int(national_id))
+        if entry is None:
+            roster.unknown_ids.add(int(national_id))
+        else:
+            roster.add(entry)
+            matches = [entry]
+    return matches
@@ -0,0 +1,205 @@
+"""
+Routes the data layer to the SQLite file(s) holding the data.
+
+Patient-owned rows (Patients, Appointments, LabResults, MedicalRecords, Prescriptions, PrescriptionDetails and their
+ChangeLog entries) are hash-partitioned by NationalID across N shard files, every other table is replicated to all of them.
+Without configuration there is a single shard, database.DB_PATH, and nothing changes for the rest of the code.
+
+Shards are configured with the HEALTH_MONITORING_SHARDS environment variable (comma separated paths, order matters)
+or with configure(). An existing database is split with:
+    python shard_router.py reshard health_monitoring.db shards/ 4
+"""
+import os
+import sqlite3
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+# New rows of shard i get IDs from i * SHARD_ID_SPAN on, so IDs stay unique across shards
+SHARD_ID_SPAN = 10 ** 12
+
+# Patient-owned tables and how to find the NationalID of a row
+PATIENT_TABLES = {
+    'Patients': 'NationalID',
+    'Appointments': 'PatientID',
+    'LabResults': 'PatientID',
+    'MedicalRecords': 'PatientID',
+    'Prescriptions': 'PatientID',
+    'ChangeLog': 'PatientID',
+}
+# Child tables that follow their parent row: table -> (column, parent table, parent key)
+PATIENT_CHILD_TABLES = {
+    'PrescriptionDetails': ('PrescriptionID', 'Prescriptions', 'PrescriptionID'),
+}
+# Patient-owned tables with AUTOINCREMENT IDs, which every shard hands out from its own range
+ID_RANGE_TABLES = ['Appointments', 'LabResults', 'MedicalRecords', 'Prescriptions', 'PrescriptionDetails', 'ChangeLog']
+# Tables derived from the others on every shard, rebuilt instead of copied
+DERIVED_TABLES = {'DoctorDailyAppointments', 'DoctorTestTypeCounts', 'DoctorTotals', 'DoctorRoster'}
+
+_configured_paths = None
+_executor = None
+
+
+def configure(paths):
+    """
+    Uses the given shard files, in this order. None goes back to the environment / single file default.
+    """
+    global _configured_paths, _executor
+    _configured_paths = list(paths) if paths else None
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def shard_paths():
+    if _configured_paths:
+        return _configured_paths
+    configured = os.environ.get('HEALTH_MONITORING_SHARDS')
+    if configured:
+        return [path.strip() for path in configured.split(',') if path.strip()]
+    return [database.DB_PATH]
+
+
+def shard_index(national_id, shard_count=None):
+    """
+    Shard number of a patient. A stable hash (crc32), so it does not depend on the Python process.
+    """
+    shard_count = shard_count or len(shard_paths())
+    if shard_count == 1:
+        return 0
+    try:
+        key = str(int(national_id))
+    except (TypeError, ValueError):
+        key = str(national_id)  # Not a valid National ID, it has no rows on any shard anyway
+    return zlib.crc32(key.encode()) % shard_count
+
+
+def path_for_patient(national_id):
+    return shard_paths()[shard_index(national_id)]
+
+
+def reference_path():
+    """
+    Shard used to read replicated reference data (doctors, specializations, test types...).
+    """
+    return shard_paths()[0]
+
+
+def fan_out(function):
+    """
+    Calls function(path) for every shard, in parallel when there are several, and returns the results in shard order.
+    """
+    global _executor
+    paths = shard_paths()
+    if len(paths) == 1:
+        return [function(paths[0])]
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix='shard')
+    return list(_executor.map(function, paths))
+
+
+# ** ID ranges **
+
+def _raise_sequence(connection, table, seq):
+    # sqlite_sequence has no key on name, a table gets its row on its first insert
+    connection.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (seq, table))
+    connection.execute('INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? '
+                       'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)', (table, seq, table))
+
+
+def _seed_id_range(connection, index):
+    for table in ID_RANGE_TABLES:
+        _raise_sequence(connection, table, index * SHARD_ID_SPAN)
+
+
+def seed_id_range(path):
+    """
+    Moves the AUTOINCREMENT sequences of a shard's patient-owned tables into the shard's ID range, so a new shard
+    does not hand out the IDs another shard uses. Run by database.migrate on every shard, a file that is not one of
+    the configured shards is left alone.
+    """
+    paths = [os.path.abspath(shard_path) for shard_path in shard_paths()]
+    if os.path.abspath(path) not in paths:
+        return
+    connection = sqlite3.connect(path)
+    _seed_id_range(connection, paths.index(os.path.abspath(path)))
+    connection.commit()
+    connection.close()
+
+
+# ** Resharding **
+
+def _columns(connection, schema, table):
+    # table_info leaves out generated columns, which cannot be inserted into
+    return [row[1] for row in connection.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def _copy_shard(source_path, shard_path, index, shard_count):
+    connection = sqlite3.connect(shard_path)
+    connection.create_function('shard_of', 1, lambda national_id: shard_index(national_id, shard_count), deterministic=True)
+    connection.execute('ATTACH DATABASE ? AS src', (source_path,))
+    cursor = connection.cursor()
+
+    cursor.execute("SELECT type, name, sql FROM src.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'")
+    schema = cursor.fetchall()
+    tables = [(name, sql) for kind, name, sql in schema if kind == 'table']
+
+    # Tables first, data next and indexes/triggers last, so triggers do not fire while copying
+    for _, sql in tables:
+        cursor.execute(sql)
+    for table, _ in tables:
+        if table in DERIVED_TABLES:
+            continue
+        columns = ', '.join(_columns(connection, 'main', table))
+        if table in PATIENT_TABLES:
+            where = f'WHERE shard_of({PATIENT_TABLES[table]}) = {index}'
+        elif table in PATIENT_CHILD_TABLES:
+            column, parent, parent_key = PATIENT_CHILD_TABLES[table]
+            where = (f'WHERE {column} IN (SELECT {parent_key} FROM src.{parent} '
+                     f'WHERE shard_of({PATIENT_TABLES[parent]}) = {index})')
+        else:
+            where = ''
+        cursor.execute(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} {where}')
+    for kind, _, sql in schema:
+        if kind in ('index', 'trigger'):
+            cursor.execute(sql)
+
+    # Keep AUTOINCREMENT sequences of every shard in its own ID range, above every ID copied from the source
+    cursor.execute('SELECT name, seq FROM src.sqlite_sequence')
+    for table, seq in cursor.fetchall():
+        if table in ID_RANGE_TABLES:
+            _raise_sequence(cursor, table, seq)
+    _seed_id_range(cursor, index)
+
+    connection.commit()
+    connection.execute('DETACH DATABASE src')
+    connection.close()
+    database.rebuild_rollups(shard_path)
+
+
+def reshard(source_path, directory, shard_count):
+    """
+    Splits an existing database into shard_count new files in directory. The source file is not modified.
+    Stop the application while it runs, then point HEALTH_MONITORING_SHARDS at the returned paths.
+
+    Returns:
+        list of str: The shard paths, in shard order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f'shard_{index}.db') for index in range(shard_count)]
+    for path in paths:
+        if os.path.exists(path):
+            raise FileExistsError(f'{path} already exists')
+    for index, path in enumerate(paths):
+        _copy_shard(source_path, path, index, shard_count)
+    return paths
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'reshard':
+        print('Usage: python shard_router.py reshard <source.db> <directory> <shard count>')
+        sys.exit(1)
+    shard_files = reshard(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    print('HEALTH_MONITORING_SHARDS=' + ','.join(shard_files))
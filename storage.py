@@ -0,0 +1,314 @@
+"""
+Storage tuning and maintenance of the database files.
+
+Tuning profiles: every connection the query functions open (query_func.create_shard_connection) gets the PRAGMAs of
+the active profile, chosen with the HEALTH_MONITORING_PROFILE environment variable or set_profile():
+    default       SQLite's own defaults, no PRAGMA is set (the default)
+    interactive   the application: WAL journal, synchronous=NORMAL, 32 MB page cache, 256 MB mmap
+    read-mostly   reporting / cohort work: larger page cache and mmap
+    bulk-load     imports and migrations: synchronous=OFF and rare checkpoints, not crash safe
+The tuned profiles trade durability for speed: with WAL and synchronous=NORMAL a commit is not synced to disk, so
+the last transactions before a power loss or OS crash can be lost (never the file's consistency). A deployment
+that accepts this opts in, e.g. HEALTH_MONITORING_PROFILE=interactive for the Streamlit and data service processes.
+
+Maintenance: ANALYZE statistics, PRAGMA optimize, incremental vacuum and a WAL checkpoint, run on every shard when
+the database has been quiet (no change logged) for a while:
+    python storage.py report
+    python storage.py maintain
+    python storage.py schedule --every 60 --quiet-minutes 5
+    python storage.py enable-incremental-vacuum     (one-time, rewrites the file, stop the application first)
+"""
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import database
+
+PROFILES = {
+    'interactive': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -32768,  # Negative values are KiB: 32 MB
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        'wal_autocheckpoint': 1000,
+    },
+    'read-mostly': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -131072,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        'wal_autocheckpoint': 1000,
+    },
+    'bulk-load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -262144,
+        'mmap_size': 0,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+        'wal_autocheckpoint': 10000,
+    },
+    'default': {},
+}
+DEFAULT_PROFILE = 'default'
+# Stored in the database file rather than per connection, set once per file and process
+FILE_SETTINGS = {'journal_mode'}
+# Only worth their setup cost on connections kept open (query_func.use_persistent_connections):
+# a connection opened for one query never fills a large cache, and mapping the file costs more than the query
+LONG_LIVED_SETTINGS = {'cache_size', 'mmap_size'}
+
+_profile = os.environ.get('HEALTH_MONITORING_PROFILE', DEFAULT_PROFILE)
+_configured_files = set()
+
+
+def set_profile(name):
+    global _profile
+    if name not in PROFILES:
+        raise ValueError(f'Unknown storage profile: {name}')
+    _profile = name
+    _configured_files.clear()
+
+
+def active_profile():
+    return _profile
+
+
+def configure_connection(connection, path, persistent=False):
+    """
+    Applies the active profile to a new connection to the database file at path.
+    persistent tells whether the connection is kept open for many queries, see LONG_LIVED_SETTINGS.
+    """
+    settings = PROFILES[_profile]
+    if path not in _configured_files:
+        try:
+            for name in FILE_SETTINGS & settings.keys():
+                connection.execute(f'PRAGMA {name} = {settings[name]}')
+            _configured_files.add(path)
+        except sqlite3.OperationalError:
+            pass  # Another connection holds a lock, tried again on the next connection
+    for name, value in settings.items():
+        if name in FILE_SETTINGS or (name in LONG_LIVED_SETTINGS and not persistent):
+            continue
+        connection.execute(f'PRAGMA {name} = {value}')
+    return connection
+
+
+# ** Maintenance **
+
+def enable_incremental_vacuum(path):
+    """
+    Switches a file to auto_vacuum=INCREMENTAL, so maintenance can return free pages to the file system a few at a
+    time. Takes effect through a full VACUUM, which rewrites the file: run it with the application stopped.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def run_maintenance(path, vacuum_pages=1000):
+    """
+    ANALYZE when the file has no statistics yet, PRAGMA optimize otherwise, then an incremental vacuum of up to
+    vacuum_pages free pages (when enabled) and a WAL checkpoint.
+
+    Returns:
+        dict: What was done, for the maintenance log.
+    """
+    connection = sqlite3.connect(path, timeout=30)
+    done = {}
+    started = time.perf_counter()
+    has_statistics = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    ).fetchone() is not None
+    if has_statistics:
+        # Limits the rows each re-analysis reads, so optimize stays cheap on large tables
+        connection.execute('PRAGMA analysis_limit = 1000')
+        connection.execute('PRAGMA optimize')
+        done['optimize'] = True
+    else:
+        connection.execute('ANALYZE')
+        done['analyze'] = True
+
+    if connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        free_pages = connection.execute('PRAGMA freelist_count').fetchone()[0]
+        connection.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+        done['vacuumed_pages'] = min(free_pages, vacuum_pages)
+    connection.commit()
+
+    if connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        done['checkpoint'] = connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    connection.close()
+    done['seconds'] = round(time.perf_counter() - started, 3)
+    return done
+
+
+def _last_change(path):
+    # Latest ChangeLog sequence number: every write to patient data moves it (see database.create_change_log)
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ChangeLog'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    connection.close()
+    return row[0] if row else 0
+
+
+def run_schedule(every_minutes=60, quiet_minutes=5, poll_seconds=30, vacuum_pages=1000):
+    """
+    Runs maintenance on every shard at most once every every_minutes minutes, waiting until no change has been
+    logged on any shard for quiet_minutes. Runs until interrupted.
+    """
+    from shard_router import shard_paths
+
+    last_run = None
+    last_seen = None
+    quiet_since = time.monotonic()
+    while True:
+        seen = [_last_change(path) for path in shard_paths()]
+        if seen != last_seen:
+            last_seen = seen
+            quiet_since = time.monotonic()
+        due = last_run is None or time.monotonic() - last_run >= every_minutes * 60
+        if due and time.monotonic() - quiet_since >= quiet_minutes * 60:
+            for path in shard_paths():
+                print(f'{datetime.now():%Y-%m-%d %H:%M:%S} {path}: {run_maintenance(path, vacuum_pages)}')
+            last_run = time.monotonic()
+        time.sleep(poll_seconds)
+
+
+# ** Health report **
+
+# The application's main access paths, checked with EXPLAIN QUERY PLAN to see which indexes they use
+REPRESENTATIVE_QUERIES = {
+    'patient appointments': 'SELECT * FROM Appointments WHERE PatientID = ? ORDER BY AppointmentSlot',
+    'doctor day / slot check': "SELECT 1 FROM Appointments WHERE DoctorID = ? AND AppointmentSlot >= ? AND AppointmentSlot < ? "
+                               "AND Status = 'active'",
+    'doctor roster': 'SELECT PatientID, AppointmentID FROM DoctorRoster WHERE DoctorID = ?',
+    'patient lab results': 'SELECT * FROM LabResults WHERE PatientID = ? ORDER BY TestDate',
+    'cohort, doctor scope': 'SELECT PatientID FROM LabResults WHERE DoctorID = ? AND TestDate >= ?',
+    'cohort, test type scope': 'SELECT PatientID FROM LabResults WHERE TestTypeID = ? AND TestDate >= ?',
+    'patient medical records': 'SELECT * FROM MedicalRecords WHERE PatientID = ? ORDER BY CreatedDate',
+    'patient prescriptions': 'SELECT * FROM Prescriptions WHERE PatientID = ? ORDER BY PrescribedDate',
+    'prescription details': 'SELECT * FROM PrescriptionDetails WHERE PrescriptionID = ?',
+    'patient change feed': 'SELECT * FROM ChangeLog WHERE PatientID = ? AND Seq > ?',
+    'patient login': 'SELECT * FROM Patients WHERE NationalID = ?',
+    'reminder window': "SELECT AppointmentID FROM Appointments WHERE AppointmentSlot > ? AND AppointmentSlot <= ? "
+                       "AND Status = 'active'",
+}
+REPRESENTATIVE_QUERIES.update({
+    f'cohort, {analyte} threshold': f'SELECT PatientID FROM LabResults WHERE {database.analyte_column(analyte)} < ?'
+    for analyte in database.all_analytes()
+})
+
+
+def storage_report(path):
+    """
+    Storage health of one database file: size and fragmentation, row counts, and which indexes the representative
+    queries use. Indexes no representative query uses are candidates for removal, not proof of uselessness.
+
+    Returns:
+        dict
+    """
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    pragma = lambda name: connection.execute(f'PRAGMA {name}').fetchone()[0]
+    page_size, page_count, free_pages = pragma('page_size'), pragma('page_count'), pragma('freelist_count')
+    report = {
+        'path': path,
+        'size_mb': round(page_size * page_count / 1024 / 1024, 2),
+        'free_pages': free_pages,
+        'free_percent': round(100 * free_pages / page_count, 2) if page_count else 0,
+        'journal_mode': pragma('journal_mode'),
+        'auto_vacuum': ('none', 'full', 'incremental')[pragma('auto_vacuum')],
+        'has_statistics': connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None,
+    }
+
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    report['rows'] = {table: connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+
+    # Per table/index size and unused space inside its pages, where SQLite has the dbstat table
+    try:
+        report['objects'] = {
+            name: {'mb': round(size / 1024 / 1024, 2), 'unused_percent': round(100 * unused / size, 1) if size else 0}
+            for name, size, unused in connection.execute(
+                'SELECT name, SUM(pgsize), SUM(unused) FROM dbstat GROUP BY name ORDER BY SUM(pgsize) DESC'
+            )
+        }
+    except sqlite3.OperationalError:
+        report['objects'] = {}
+
+    indexes = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'"
+    )]
+    plans = {}
+    used = set()
+    for label, sql in REPRESENTATIVE_QUERIES.items():
+        try:
+            details = [row[3] for row in connection.execute(f'EXPLAIN QUERY PLAN {sql}', [0] * sql.count('?'))]
+        except sqlite3.OperationalError as error:
+            details = [f'not available: {error}']  # e.g. a column added by a later migration
+        plans[label] = details
+        used.update(index for index in indexes for detail in details if f'INDEX {index} ' in f'{detail} ')
+    report['plans'] = plans
+    report['unused_indexes'] = sorted(set(indexes) - used)
+    connection.close()
+    return report
+
+
+def print_report(report):
+    print(f"{report['path']}: {report['size_mb']} MB, {report['free_pages']} free pages ({report['free_percent']}%), "
+          f"journal {report['journal_mode']}, auto_vacuum {report['auto_vacuum']}, "
+          f"statistics {'yes' if report['has_statistics'] else 'no (run maintain)'}")
+    print('  Rows:')
+    for table, count in report['rows'].items():
+        print(f'    {table:<32} {count:>12}')
+    if report['objects']:
+        print('  Largest objects:')
+        for name, stats in list(report['objects'].items())[:15]:
+            print(f"    {name:<40} {stats['mb']:>10} MB  {stats['unused_percent']:>5}% unused")
+    print('  Query plans:')
+    for label, details in report['plans'].items():
+        print(f"    {label:<28} {' | '.join(details)}")
+    print(f"  Indexes not used by any representative query: {', '.join(report['unused_indexes']) or 'none'}")
+
+
+def main():
+    from shard_router import shard_paths
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('report')
+    maintain_parser = commands.add_parser('maintain')
+    maintain_parser.add_argument('--vacuum-pages', type=int, default=1000)
+    schedule_parser = commands.add_parser('schedule')
+    schedule_parser.add_argument('--every', type=float, default=60, help='Minutes between maintenance runs')
+    schedule_parser.add_argument('--quiet-minutes', type=float, default=5)
+    schedule_parser.add_argument('--vacuum-pages', type=int, default=1000)
+    commands.add_parser('enable-incremental-vacuum')
+    args = parser.parse_args()
+
+    if args.command == 'report':
+        for path in shard_paths():
+            print_report(storage_report(path))
+    elif args.command == 'maintain':
+        for path in shard_paths():
+            print(f'{path}: {run_maintenance(path, args.vacuum_pages)}')
+    elif args.command == 'schedule':
+        try:
+            run_schedule(args.every, args.quiet_minutes, vacuum_pages=args.vacuum_pages)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'enable-incremental-vacuum':
+        for path in shard_paths():
+            enable_incremental_vacuum(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import streamlit as st
+from query_func import get_change_feed_position, get_changes_since
+
+
+def refresh_rows(view, patient_id, tables, fetch, key=lambda row: row[0], sort_key=None, reverse=False):
+    """
+    Brings a cached list of a patient's rows up to date using the change feed.
+
+    On the first call (or when the change log was compacted past the cached position) every row is loaded with fetch(None).
+    Afterwards only the rows reported changed since the cached sequence number are re-read with fetch(ids)
+    and deleted ones are dropped, so a rerun without changes costs a single small query.
+
+    Parameters:
+        view (dict): Holds the cached state between calls, start with an empty dict.
+        patient_id (int): The National ID of the patient.
+        tables (list of str): Tables whose changes affect the rows, see database.CHANGE_LOG_TABLES.
+        fetch (function): fetch(ids) returns the rows with these IDs, or every row when ids is None.
+        key (function): Returns the row ID of a row, the ID the change log reports.
+        sort_key (function): Order of the returned rows, defaults to key.
+        reverse (bool): Sort in descending order.
+
+    Returns:
+        list: The patient's rows.
+    """
+    latest_seq, compacted_through_seq = get_change_feed_position(patient_id)
+    cached_seq = view.get("seq")
+
+    if cached_seq is None or cached_seq < compacted_through_seq:
+        view["rows"] = {key(row): row for row in fetch(None)}
+        view["seq"] = latest_seq
+    elif cached_seq < latest_seq:
+        changed_ids = set()
+        deleted_ids = set()
+        new_seq = latest_seq
+        for seq, _, row_id, operation in get_changes_since(patient_id, cached_seq, tables):
+            new_seq = max(new_seq, seq)
+            if operation == "D":
+                deleted_ids.add(row_id)
+                changed_ids.discard(row_id)
+            else:
+                changed_ids.add(row_id)
+                deleted_ids.discard(row_id)
+
+        rows = view["rows"]
+        for row_id in deleted_ids:
+            rows.pop(row_id, None)
+        if changed_ids:
+            fetched = {key(row): row for row in fetch(sorted(changed_ids))}
+            for row_id in changed_ids:
+                if row_id in fetched:
+                    rows[row_id] = fetched[row_id]
+                else:
+                    rows.pop(row_id, None)  # e.g. moved to another patient
+        view["seq"] = new_seq
+        view.pop("list", None)
+
+    if "list" not in view:
+        view["list"] = sorted(view["rows"].values(), key=sort_key or key, reverse=reverse)
+    return view["list"]
+
+
+def load_patient_rows(name, patient_id, tables, fetch, **kwargs):
+    """
+    refresh_rows with the cached state kept in st.session_state, one view per page name and patient.
+    """
+    views = st.session_state.setdefault("patient_views", {})
+    view = views.setdefault((name, patient_id), {})
+    return refresh_rows(view, patient_id, tables, fetch, **kwargs)